@@ -0,0 +1,105 @@
+import argparse
+from datetime import date
+from sqlalchemy import select, insert, update, delete, func
+from models import engine, Bus, Booking, SalesDaily, SalesTotal
+
+# Occupancy and revenue aggregates for the admin dashboard. Every booking
+# and cancellation adds its deltas to sales_daily (bus, booking date) and
+# sales_totals (bus) in the same transaction, so the summary panel reads one
+# row per bus instead of scanning bookings. Revenue is seats x Bus.fare and
+# only active bookings count; a fare changed between a booking and its
+# cancellation leaves a difference that verify reports and rebuild clears.
+#
+#   python aggregates.py verify    # compare with a recount from bookings
+#   python aggregates.py rebuild   # replace with that recount
+
+def _increment(session, model, key, deltas):
+    # Upsert that adds deltas to the counters, in the dialect's native form
+    # where there is one (one round trip, no race between insert and update).
+    table = model.__table__
+    dialect = session.get_bind().dialect.name
+    if dialect in ('sqlite', 'postgresql'):
+        if dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert as upsert
+        else:
+            from sqlalchemy.dialects.postgresql import insert as upsert
+        stmt = upsert(table).values(**key, **deltas)
+        session.execute(stmt.on_conflict_do_update(
+            index_elements=list(key), set_={c: table.c[c] + stmt.excluded[c] for c in deltas}))
+    elif dialect in ('mysql', 'mariadb'):
+        from sqlalchemy.dialects.mysql import insert as upsert
+        stmt = upsert(table).values(**key, **deltas)
+        session.execute(stmt.on_duplicate_key_update({c: table.c[c] + stmt.inserted[c] for c in deltas}))
+    else:
+        where = [table.c[k] == v for k, v in key.items()]
+        if session.execute(update(table).where(*where).values(
+                {c: table.c[c] + v for c, v in deltas.items()})).rowcount == 0:
+            session.execute(insert(table).values(**key, **deltas))
+
+def record(session, changes):
+    # changes: (bus_id, booked_at, bookings, seats, revenue) deltas, negative
+    # for cancellations; applied with one upsert per (bus, day) and per bus
+    daily, totals = {}, {}
+    for bus_id, booked_at, bookings, seats, revenue in changes:
+        if bus_id is None:
+            continue
+        for acc, key in ((daily, (bus_id, booked_at.date())), (totals, bus_id)):
+            d = acc.setdefault(key, [0, 0, 0])
+            d[0] += bookings; d[1] += seats; d[2] += revenue
+    for (bus_id, day), (bookings, seats, revenue) in daily.items():
+        _increment(session, SalesDaily, {'bus_id': bus_id, 'day': day},
+                   {'bookings': bookings, 'seats': seats, 'revenue': revenue})
+    for bus_id, (bookings, seats, revenue) in totals.items():
+        _increment(session, SalesTotal, {'bus_id': bus_id},
+                   {'bookings': bookings, 'seats': seats, 'revenue': revenue})
+
+def record_booking(session, booking):
+    fare = session.execute(select(Bus.fare).where(Bus.id == booking.bus_id)).scalar() or 0
+    record(session, [(booking.bus_id, booking.booked_at, 1, booking.seats, booking.seats * fare)])
+
+def _recount():
+    # sales_daily recomputed from bookings in one grouped pass
+    day = func.date(Booking.booked_at)
+    return (select(Booking.bus_id, day, func.count(), func.sum(Booking.seats),
+                   func.sum(Booking.seats * func.coalesce(Bus.fare, 0)))
+            .outerjoin(Bus, Booking.bus_id == Bus.id)
+            .where(Booking.status == 'active', Booking.bus_id.isnot(None))
+            .group_by(Booking.bus_id, day))
+
+def rebuild(conn=None):
+    # Replace both tables with a recount: INSERT ... SELECT ... GROUP BY, run
+    # inside the database, in conn's transaction if given. Returns the number
+    # of (bus, day) rows.
+    if conn is None:
+        with engine.begin() as conn:
+            return rebuild(conn)
+    conn.execute(delete(SalesDaily))
+    conn.execute(delete(SalesTotal))
+    rows = conn.execute(insert(SalesDaily).from_select(
+        ['bus_id', 'day', 'bookings', 'seats', 'revenue'], _recount())).rowcount
+    conn.execute(insert(SalesTotal).from_select(
+        ['bus_id', 'bookings', 'seats', 'revenue'],
+        select(SalesDaily.bus_id, func.sum(SalesDaily.bookings), func.sum(SalesDaily.seats),
+               func.sum(SalesDaily.revenue)).group_by(SalesDaily.bus_id)))
+    return rows
+
+def verify():
+    # [(bus_id, day, stored (bookings, seats, revenue), recounted)] for rows that differ
+    with engine.connect() as conn:
+        expected = {(r[0], date.fromisoformat(str(r[1])[:10])): tuple(r[2:]) for r in conn.execute(_recount())}
+        stored = {(r.bus_id, r.day): (r.bookings, r.seats, r.revenue)
+                  for r in conn.execute(select(SalesDaily)) if (r.bookings, r.seats, r.revenue) != (0, 0, 0)}
+    return [(key[0], key[1], stored.get(key), expected.get(key))
+            for key in sorted(expected.keys() | stored.keys()) if stored.get(key) != expected.get(key)]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Sales aggregate maintenance')
+    parser.add_argument('command', choices=['rebuild', 'verify'])
+    args = parser.parse_args()
+    if args.command == 'rebuild':
+        print(f'{rebuild()} bus/day rows rebuilt')
+    else:
+        diffs = verify()
+        for bus_id, day, stored, expected in diffs[:50]:
+            print(f'bus {bus_id} {day}: stored {stored}, recount {expected}')
+        print(f'{len(diffs)} rows differ' if diffs else 'aggregates match bookings')
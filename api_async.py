@@ -0,0 +1,236 @@
+import asyncio
+import datetime
+import random
+import time
+from contextlib import asynccontextmanager
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route
+from models import Bus, make_async_engine
+from search import RouteIndex
+import reservations
+import holds
+import idempotency
+import queries
+import config
+
+# JSON booking API for partner agencies, on an asyncio stack so one process
+# can keep thousands of requests in flight while they wait on the database.
+#
+#   API_KEYS="partner-key:3" uvicorn api_async:app --workers 1
+#
+# Every request needs an X-API-Key header; bookings are made as the user the
+# key maps to. POSTs may carry an Idempotency-Key header: a retry with the
+# same key gets the first attempt's response (marked Idempotent-Replayed)
+# without booking again. The booking transactions are the same functions the web app
+# uses (reservations.tx_*), run on an AsyncSession via run_sync.
+
+engine = make_async_engine(config.SQLALCHEMY_DATABASE_URI)
+Session = async_sessionmaker(engine, expire_on_commit=False)
+
+# SQLite runs one writer at a time anyway; queueing writers here instead of
+# in SQLite's busy handler (which sleeps and polls) keeps write tail latency
+# down. Other databases get as many writers as there are pooled connections.
+_writers = asyncio.Semaphore(1 if engine.dialect.name == 'sqlite' else config.DB_POOL_SIZE)
+
+async def run_in_transaction(fn, retries=None):
+    # async twin of reservations.run_in_transaction
+    retries = config.BOOKING_MAX_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        async with _writers, Session() as session:
+            try:
+                result = await session.run_sync(fn)
+                await session.commit()
+                return result
+            except (OperationalError, reservations.Conflict):
+                await session.rollback()
+                attempt += 1
+                if attempt > retries:
+                    raise
+            except Exception:
+                await session.rollback()
+                raise
+        await asyncio.sleep(random.uniform(0, 0.01 * (2 ** attempt)))
+
+# Route index, refreshed after the catalogue TTL (this process never sees the
+# web app's invalidations).
+_index = None
+_index_expires = 0.0
+_index_lock = asyncio.Lock()
+
+async def route_index():
+    global _index, _index_expires
+    if _index is None or _index_expires < time.monotonic():
+        async with _index_lock:
+            if _index is None or _index_expires < time.monotonic():
+                async with Session() as session:
+                    routes = (await session.execute(select(Bus.id, Bus.route).where(Bus.is_active == True))).all()
+                _index = RouteIndex(routes)
+                _index_expires = time.monotonic() + config.CATALOGUE_CACHE_TTL
+    return _index
+
+def error(status, message):
+    return JSONResponse({'error': message}, status_code=status)
+
+def bus_json(bus):
+    return {'id': bus.id, 'name': bus.name, 'route': bus.route, 'total_seats': bus.total_seats,
+            'available_seats': bus.available_seats, 'fare': bus.fare, 'depart_time': bus.depart_time}
+
+def trip_json(trip):
+    return {'id': trip.id, 'bus_id': trip.bus_id, 'name': trip.name, 'route': trip.route,
+            'depart_at': trip.depart_at.isoformat(), 'total_seats': trip.total_seats,
+            'available_seats': trip.available_seats, 'fare': trip.fare}
+
+async def idempotent(key, user_id, scope, body):
+    # body(session) in a transaction, at most once per Idempotency-Key; returns (result, replayed)
+    if not key:
+        return await run_in_transaction(body), False
+    hit = idempotency.cached(user_id, key, scope)
+    if hit is not None:
+        return hit
+    result, replayed = await run_in_transaction(lambda s: idempotency.tx_run(s, user_id, key, scope, body))
+    idempotency.remember(user_id, key, scope, result)
+    return result, replayed
+
+def replay_headers(replayed):
+    return {'Idempotent-Replayed': 'true'} if replayed else None
+
+def authenticate(request):
+    return config.API_KEYS.get(request.headers.get('x-api-key', ''))
+
+async def read_json(request):
+    try:
+        body = await request.json()
+    except ValueError:
+        return None
+    return body if isinstance(body, dict) else None
+
+async def search(request):
+    if authenticate(request) is None:
+        return error(401, 'invalid API key')
+    origin, destination = request.query_params.get('from'), request.query_params.get('to')
+    if not origin and not destination:
+        return error(400, 'from or to is required')
+    index = await route_index()
+    ids = index.lookup(origin, destination)[:config.API_SEARCH_LIMIT]
+    if not ids:
+        return JSONResponse({'buses': [], 'trips': []})
+    date = request.query_params.get('date')
+    try:
+        service_date = datetime.date.fromisoformat(date) if date else None
+    except ValueError:
+        return error(400, 'date must be YYYY-MM-DD')
+    routes = sorted({index.routes[bus_id] for bus_id in ids})
+    async with Session() as session:
+        rows = await session.run_sync(lambda s: queries.buses_by_ids(s, ids, date))
+        trips = await session.run_sync(lambda s: queries.trips_on(s, routes, service_date)) if service_date else []
+    return JSONResponse({'buses': [bus_json(b) for b in rows], 'trips': [trip_json(t) for t in trips]})
+
+async def bus_detail(request):
+    if authenticate(request) is None:
+        return error(401, 'invalid API key')
+    bus_id = request.path_params['bus_id']
+    async with Session() as session:
+        bus, free = await session.run_sync(lambda s: queries.get_bus_with_free_seats(s, bus_id))
+    if bus is None:
+        return error(404, 'bus not found')
+    return JSONResponse(dict(bus_json(bus), free_seats=free))
+
+async def create_hold(request):
+    user_id = authenticate(request)
+    if user_id is None:
+        return error(401, 'invalid API key')
+    body = await read_json(request)
+    if body is None:
+        return error(400, 'JSON object body required')
+    try:
+        bus_id = int(body['bus_id'])
+        trip_id = int(body['trip_id']) if body.get('trip_id') is not None else None
+        seat_numbers = [int(n) for n in body.get('seat_numbers') or []]
+        seats = len(set(seat_numbers)) if seat_numbers else int(body.get('seats', 1))
+        passenger_name = str(body['passenger_name'])
+    except (KeyError, TypeError, ValueError):
+        return error(400, 'bus_id, passenger_name and seats or seat_numbers are required')
+    if seats <= 0:
+        return error(400, 'seats must be positive')
+    phone = str(body.get('passenger_phone') or '')
+    key = request.headers.get('Idempotency-Key', '')
+    if key and not idempotency.valid_key(key):
+        return error(400, 'Idempotency-Key must be at most 64 printable characters')
+    try:
+        hold, replayed = await idempotent(key, user_id, 'hold', lambda s: holds.hold_json(
+            reservations.tx_hold(s, bus_id, user_id, seats, passenger_name, phone, seat_numbers, trip_id=trip_id)))
+    except reservations.SeatsUnavailable:
+        return error(409, 'seats not available')
+    except idempotency.KeyReused:
+        return error(422, 'Idempotency-Key already used for another request')
+    if not replayed:
+        holds.hold_created(hold['hold_id'], datetime.datetime.fromisoformat(hold['expires_at']))
+    return JSONResponse({'hold_id': hold['hold_id'], 'bus_id': bus_id, 'trip_id': trip_id,
+                         'seat_numbers': hold['seat_numbers'], 'expires_at': hold['expires_at'] + 'Z'},
+                        status_code=201, headers=replay_headers(replayed))
+
+async def confirm_hold(request):
+    user_id = authenticate(request)
+    if user_id is None:
+        return error(401, 'invalid API key')
+    hold_id = request.path_params['hold_id']
+    key = request.headers.get('Idempotency-Key', '')
+    if key and not idempotency.valid_key(key):
+        return error(400, 'Idempotency-Key must be at most 64 printable characters')
+    try:
+        booking_id, replayed = await idempotent(key, user_id, 'confirm',
+                                                lambda s: reservations.tx_confirm(s, hold_id, user_id))
+    except idempotency.KeyReused:
+        return error(422, 'Idempotency-Key already used for another request')
+    if booking_id is None:
+        return error(409, 'hold not found, expired or already used')
+    if not replayed:
+        holds.hold_finished(hold_id, 'confirmed')
+    return JSONResponse({'hold_id': hold_id, 'booking_id': booking_id}, status_code=201,
+                        headers=replay_headers(replayed))
+
+async def cancel_hold(request):
+    user_id = authenticate(request)
+    if user_id is None:
+        return error(401, 'invalid API key')
+    hold_id = request.path_params['hold_id']
+    bus_id = await run_in_transaction(lambda s: reservations.tx_release(s, hold_id, user_id))
+    if bus_id is None:
+        return error(409, 'hold not found or no longer held')
+    holds.hold_finished(hold_id, 'released')
+    return JSONResponse({'hold_id': hold_id, 'status': 'released'})
+
+async def cancel_booking(request):
+    user_id = authenticate(request)
+    if user_id is None:
+        return error(401, 'invalid API key')
+    booking_id = request.path_params['booking_id']
+    cancelled, refund = await run_in_transaction(
+        lambda s: reservations.tx_cancel(s, booking_ids=[booking_id], user_id=user_id,
+                                         refund_percent=config.CANCEL_REFUND_PERCENT))
+    if not cancelled:
+        return error(409, 'booking not found or already cancelled')
+    return JSONResponse({'booking_id': booking_id, 'status': 'cancelled', 'refund_amount': refund})
+
+@asynccontextmanager
+async def lifespan(app):
+    # expired holds are reclaimed by the same reaper thread the web app runs
+    await asyncio.to_thread(holds.start_reaper)
+    yield
+    await engine.dispose()
+
+routes = [
+    Route('/api/search', search, methods=['GET']),
+    Route('/api/buses/{bus_id:int}', bus_detail, methods=['GET']),
+    Route('/api/holds', create_hold, methods=['POST']),
+    Route('/api/holds/{hold_id:int}/confirm', confirm_hold, methods=['POST']),
+    Route('/api/holds/{hold_id:int}', cancel_hold, methods=['DELETE']),
+    Route('/api/bookings/{booking_id:int}', cancel_booking, methods=['DELETE']),
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
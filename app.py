@@ -1,19 +1,90 @@
-from flask import Flask, render_template, redirect, url_for, request, flash, send_file, make_response
+from flask import Flask, render_template, redirect, url_for, request, flash, Response, abort
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user, UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import SessionLocal, User, Bus, Booking, init_db
+from models import db_session as db, engine, User, Bus, Schedule, pool_status
 import config
-from io import BytesIO
 import utils
+import auth
+import reservations
+import holds
+import catalog
+import queries
+from search import search_buses, search_trips
+import trips
+import aggregates
+import reports
+import seatmap
+import instrumentation
+import events
+import idempotency
+import group_commit
+import migrations
+import uuid
 import csv
+import threading
+import time
+from datetime import datetime, timedelta
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = config.SECRET_KEY
 
+def runtime_gauges():
+    # pool, hold, cache and group-commit figures for /metrics next to the per-request ones
+    pool, cache, held = pool_status(), catalog.catalogue.stats(), holds.metrics.snapshot()
+    rows = [('db_pool_checked_out', 'gauge', pool.get('checked_out', 0), 'Connections in use.'),
+            ('db_pool_checkout_timeouts_total', 'counter', pool.get('timeouts', 0), 'Checkouts that timed out.'),
+            ('db_pool_wait_seconds_total', 'counter', round(pool.get('wait_total', 0), 6), 'Time spent waiting for a connection.'),
+            ('catalogue_cache_hits_total', 'counter', cache['hits'], 'Catalogue cache hits.'),
+            ('catalogue_cache_misses_total', 'counter', cache['misses'], 'Catalogue cache misses.'),
+            ('seat_holds_pending', 'gauge', holds.reaper.pending(), 'Holds waiting to be confirmed or expire.')]
+    rows += [(f'seat_holds_{name}_total', 'counter', n, f'Holds {name}.') for name, n in held.items()]
+    if group_commit.enabled():
+        batched = group_commit.writer.snapshot()
+        rows += [('group_commit_queued', 'gauge', group_commit.writer.queued(), 'Holds waiting for the writer.'),
+                 ('group_commit_batches_total', 'counter', batched['batches'], 'Batches committed.'),
+                 ('group_commit_committed_total', 'counter', batched['committed'], 'Holds committed in batches.'),
+                 ('group_commit_rejected_total', 'counter', batched['rejected'], 'Holds turned away by the seat counter.'),
+                 ('group_commit_largest_batch', 'gauge', batched['largest_batch'], 'Largest batch so far.')]
+    return rows
+
+if config.INSTRUMENTATION:
+    instrumentation.install(app, engine, runtime_gauges)
+
+# Process startup runs on the first request (or from __main__), not at
+# import, so tests, the benchmarks and the JSON API can import this module
+# without touching the database or starting threads. This is what
+# before_first_request did before Flask 2.3 removed it.
+_started = False
+_start_lock = threading.Lock()
+
+def start():
+    global _started
+    with _start_lock:
+        if _started:
+            return
+        # the schema is checked (an empty database created) before anything is served
+        migrations.check()
+        # seats held on the booking page come back on sale when the hold expires
+        holds.start_reaper()
+        _started = True
+
+@app.before_request
+def start_once():
+    if not _started:
+        start()
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 login_manager.login_view = 'login'
 
+# Session per request: views use `db` (a scoped session) and commit their own
+# writes; whatever is left uncommitted when the request ends is rolled back
+# and the session goes back to the pool here.
+@app.teardown_appcontext
+def remove_session(exc=None):
+    if exc is not None:
+        db.rollback()
+    db.remove()
+
 # Simple user class wrapper for Flask-Login
 class FLUser(UserMixin):
     def __init__(self, user):
@@ -21,40 +92,63 @@ class FLUser(UserMixin):
         self.username = user.username
         self.is_admin = user.is_admin
 
+class PrincipalCache:
+    # Short-lived cache of logged-in users so each authenticated page view does
+    # not cost an extra query. Oldest entries are dropped past max_entries.
+    # Nothing in the web app changes a user row after registration; a change
+    # made elsewhere (is_admin, a deleted user) shows after USER_CACHE_TTL.
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = {}  # user_id -> (expires_at, FLUser)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry and entry[0] > time.monotonic():
+            return entry[1]
+        return None
+
+    def put(self, user_id, principal):
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._entries[user_id] = (time.monotonic() + self.ttl, principal)
+            while len(self._entries) > self.max_entries:
+                del self._entries[next(iter(self._entries))]
+
+principals = PrincipalCache(config.USER_CACHE_TTL, config.USER_CACHE_SIZE)
+
 @login_manager.user_loader
 def load_user(user_id):
-    session = SessionLocal()
-    u = session.query(User).filter_by(id=int(user_id)).first()
-    session.close()
-    if u:
-        return FLUser(u)
-    return None
-
-@app.before_first_request
-def ensure_db():
-    init_db()
+    principal = principals.get(user_id)
+    if principal is None:
+        u = queries.get_user(db, int(user_id))
+        if not u:
+            return None
+        principal = FLUser(u)
+        principals.put(user_id, principal)
+    return principal
 
 @app.route('/')
 def index():
-    session = SessionLocal()
-    buses = session.query(Bus).all()
-    session.close()
-    return render_template('index.html', buses=buses)
+    return render_template('index.html', buses=catalog.list_buses())
 
 @app.route('/register', methods=['GET','POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
-        session = SessionLocal()
-        if session.query(User).filter_by(username=username).first():
+        if queries.get_user_by_name(db, username):
             flash('Username already exists', 'danger')
-            session.close()
             return redirect(url_for('register'))
-        u = User(username=username, password=generate_password_hash(password), is_admin=False)
-        session.add(u)
-        session.commit()
-        session.close()
+        try:
+            hashed = auth.run(auth.hash_password, password)
+        except auth.Busy:
+            flash('Server busy, please try again', 'danger')
+            return redirect(url_for('register'))
+        u = User(username=username, password=hashed, is_admin=False)
+        db.add(u)
+        db.commit()
         flash('Registered successfully. Please login.', 'success')
         return redirect(url_for('login'))
     return render_template('register.html')
@@ -64,10 +158,15 @@ def login():
     if request.method == 'POST':
         username=request.form['username']
         password=request.form['password']
-        session = SessionLocal()
-        u = session.query(User).filter_by(username=username).first()
-        session.close()
-        if u and check_password_hash(u.password, password):
+        try:
+            u = auth.authenticate(db, username, password, request.remote_addr)
+        except auth.Throttled:
+            flash('Too many login attempts, please wait a moment', 'danger')
+            return render_template('login.html'), 429
+        except auth.Busy:
+            flash('Server busy, please try again', 'danger')
+            return render_template('login.html'), 503
+        if u:
             login_user(FLUser(u))
             flash('Logged in', 'success')
             return redirect(url_for('index'))
@@ -88,11 +187,23 @@ def admin_dashboard():
     if not current_user.is_authenticated or not getattr(current_user, 'is_admin', False):
         flash('Admin access required', 'danger')
         return redirect(url_for('index'))
-    session = SessionLocal()
-    buses = session.query(Bus).all()
-    bookings = session.query(Booking).all()
-    session.close()
-    return render_template('admin_dashboard.html', buses=buses, bookings=bookings)
+    filters = {k: request.args.get(k, '') for k in ('bus_id', 'user', 'date_from', 'date_to')}
+    try:
+        after = queries.parse_cursor(request.args.get('after'))
+        bus_id = int(filters['bus_id']) if filters['bus_id'] else None
+        date_from = datetime.strptime(filters['date_from'], '%Y-%m-%d') if filters['date_from'] else None
+        date_to = datetime.strptime(filters['date_to'], '%Y-%m-%d') + timedelta(days=1) if filters['date_to'] else None
+    except ValueError:
+        flash('Invalid filter', 'danger'); return redirect(url_for('admin_dashboard'))
+    bookings, next_after = queries.bookings_page(db, after=after, bus_id=bus_id, username=filters['user'] or None,
+                                                 date_from=date_from, date_to=date_to)
+    sales = queries.sales_summary(db, datetime.utcnow().date())
+    return render_template('admin_dashboard.html', buses=catalog.list_buses(), bookings=bookings,
+                           schedules=queries.list_schedules(db), sales=sales, route_sales=queries.sales_by_route(sales),
+                           filters=filters, next_after=next_after, cache_stats=catalog.catalogue.stats(),
+                           pool_stats=pool_status(), hold_stats=dict(holds.metrics.snapshot(),
+                                                                     active=holds.reaper.pending()),
+                           profiler=instrumentation.profiler if config.INSTRUMENTATION else None)
 
 # CRUD for buses
 @app.route('/admin/bus/add', methods=['GET','POST'])
@@ -101,14 +212,14 @@ def add_bus():
     if not current_user.is_admin:
         flash('Admin only', 'danger'); return redirect(url_for('index'))
     if request.method == 'POST':
-        session = SessionLocal()
         name = request.form['name']
         route = request.form['route']
         total = int(request.form.get('total_seats') or 40)
         fare = int(request.form.get('fare') or 0)
         depart_time = request.form.get('depart_time','')
         b = Bus(name=name, route=route, total_seats=total, available_seats=total, fare=fare, depart_time=depart_time)
-        session.add(b); session.commit(); session.close()
+        db.add(b); db.commit()
+        catalog.invalidate()
         flash('Bus added', 'success'); return redirect(url_for('admin_dashboard'))
     return render_template('bus_form.html', action='Add', bus=None)
 
@@ -117,18 +228,16 @@ def add_bus():
 def edit_bus(bus_id):
     if not current_user.is_admin:
         flash('Admin only', 'danger'); return redirect(url_for('index'))
-    session = SessionLocal()
-    bus = session.query(Bus).filter_by(id=bus_id).first()
     if request.method == 'POST':
-        bus.name = request.form['name']
-        bus.route = request.form['route']
-        bus.total_seats = int(request.form.get('total_seats') or bus.total_seats)
-        bus.available_seats = max(0, bus.total_seats - sum([bk.seats for bk in bus.bookings]))
-        bus.fare = int(request.form.get('fare') or bus.fare)
-        bus.depart_time = request.form.get('depart_time','')
-        session.commit(); session.close()
+        total = request.form.get('total_seats')
+        fare = request.form.get('fare')
+        # a compare-and-set on the seat counts, so bookings made meanwhile are kept
+        if not reservations.edit_bus(bus_id, request.form['name'], request.form['route'],
+                                     int(total) if total else None, int(fare) if fare else None,
+                                     request.form.get('depart_time', '')):
+            flash('Bus not found', 'danger'); return redirect(url_for('admin_dashboard'))
         flash('Bus updated', 'success'); return redirect(url_for('admin_dashboard'))
-    session.close()
+    bus = queries.get_bus(db, bus_id)
     return render_template('bus_form.html', action='Edit', bus=bus)
 
 @app.route('/admin/bus/delete/<int:bus_id>', methods=['POST'])
@@ -136,14 +245,88 @@ def edit_bus(bus_id):
 def delete_bus(bus_id):
     if not current_user.is_admin:
         flash('Admin only', 'danger'); return redirect(url_for('index'))
-    session = SessionLocal()
-    bus = session.query(Bus).filter_by(id=bus_id).first()
-    if bus:
-        session.delete(bus); session.commit()
-        flash('Bus deleted', 'info')
-    session.close()
+    # soft delete: bookings are cancelled and refunded, the bus row stays for their history
+    result = reservations.delete_bus(bus_id)
+    if result is not None:
+        flash(f'Bus deleted, {result[0]} bookings cancelled, ₹{result[1]} refunded', 'info')
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/bus/<int:bus_id>/cancel_bookings', methods=['POST'])
+@login_required
+def cancel_bus_bookings(bus_id):
+    if not current_user.is_admin:
+        flash('Admin only', 'danger'); return redirect(url_for('index'))
+    cancelled, refund = reservations.cancel_bookings(bus_id=bus_id)
+    flash(f'{cancelled} bookings cancelled, ₹{refund} refunded', 'info')
+    return redirect(url_for('admin_dashboard'))
+
+# Schedules and dated trips
+@app.route('/admin/schedules/add', methods=['POST'])
+@login_required
+def add_schedule():
+    if not current_user.is_admin:
+        flash('Admin only', 'danger'); return redirect(url_for('index'))
+    try:
+        schedule = Schedule(bus_id=int(request.form['bus_id']),
+                            depart_time=trips.parse_time(request.form['depart_time']).strftime('%H:%M'),
+                            weekdays=trips.parse_weekdays(request.form.get('weekdays') or '0123456'),
+                            start_date=datetime.strptime(request.form['start_date'], '%Y-%m-%d').date(),
+                            end_date=datetime.strptime(request.form['end_date'], '%Y-%m-%d').date()
+                            if request.form.get('end_date') else None)
+    except (KeyError, ValueError):
+        flash('Invalid schedule', 'danger'); return redirect(url_for('admin_dashboard'))
+    db.add(schedule); db.commit()
+    created = trips.generate_trips(schedule_ids=[schedule.id])
+    flash(f'Schedule added, {created} trips created', 'success')
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/trips/generate', methods=['POST'])
+@login_required
+def generate_trips():
+    if not current_user.is_admin:
+        flash('Admin only', 'danger'); return redirect(url_for('index'))
+    days = int(request.form.get('days') or config.TRIP_HORIZON_DAYS)
+    flash(f'{trips.generate_trips(days=days)} trips created', 'success')
     return redirect(url_for('admin_dashboard'))
 
+@app.route('/admin/trips/archive', methods=['POST'])
+@login_required
+def archive_trips():
+    if not current_user.is_admin:
+        flash('Admin only', 'danger'); return redirect(url_for('index'))
+    flash(f'{trips.archive_trips()} past trips archived', 'info')
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/aggregates/rebuild', methods=['POST'])
+@login_required
+def rebuild_aggregates():
+    if not current_user.is_admin:
+        flash('Admin only', 'danger'); return redirect(url_for('index'))
+    diffs = aggregates.verify()
+    aggregates.rebuild()
+    flash(f'Sales aggregates rebuilt ({len(diffs)} rows were out of date)', 'info')
+    return redirect(url_for('admin_dashboard'))
+
+@app.route('/admin/report')
+@login_required
+def booking_report():
+    if not current_user.is_admin:
+        flash('Admin only', 'danger'); return redirect(url_for('index'))
+    month = request.args.get('month', '')
+    try:
+        start, end = reports.month_range(month) if month else (None, None)
+    except ValueError:
+        flash('Month must be YYYY-MM', 'danger'); return redirect(url_for('admin_dashboard'))
+    report = reports.build_report(start, end)
+    name = f"bookings-report-{month or 'all'}"
+    if request.args.get('format') == 'json':
+        response = Response(report.to_json(), mimetype='application/json')
+        response.headers['Content-Disposition'] = f'attachment; filename={name}.json'
+    else:
+        response = Response(report.to_csv(), mimetype='text/csv')
+        response.headers['Content-Disposition'] = f'attachment; filename={name}.csv'
+    return response
+
 # Import buses CSV
 @app.route('/admin/import_buses', methods=['POST'])
 @login_required
@@ -153,8 +336,10 @@ def import_buses():
     file = request.files.get('file')
     if not file:
         flash('No file provided', 'danger'); return redirect(url_for('admin_dashboard'))
-    added = utils.import_buses_csv(file)
-    flash(f'Imported {added} buses', 'success')
+    result = utils.import_buses_csv(file, upsert=bool(request.form.get('upsert')))
+    flash(f'Import finished: {result}', 'success' if not result.failed else 'warning')
+    for line, message in result.errors[:10]:
+        flash(f'Line {line}: {message}', 'danger')
     return redirect(url_for('admin_dashboard'))
 
 # Export bookings CSV
@@ -163,55 +348,132 @@ def import_buses():
 def export_bookings():
     if not current_user.is_admin:
         flash('Admin only', 'danger'); return redirect(url_for('index'))
-    csv_text = utils.export_bookings_csv()
-    response = make_response(csv_text)
-    response.headers['Content-Disposition'] = 'attachment; filename=bookings.csv'
-    response.mimetype = 'text/csv'
+    # streamed chunk by chunk; ?gzip=1 compresses on the fly
+    if request.args.get('gzip'):
+        response = Response(utils.gzip_chunks(utils.iter_bookings_csv()), mimetype='application/gzip')
+        response.headers['Content-Disposition'] = 'attachment; filename=bookings.csv.gz'
+    else:
+        response = Response(utils.iter_bookings_csv(), mimetype='text/csv')
+        response.headers['Content-Disposition'] = 'attachment; filename=bookings.csv'
     return response
 
 # User pages
 @app.route('/buses')
 def buses():
-    session = SessionLocal()
-    buses = session.query(Bus).all()
-    session.close()
-    return render_template('bus_list.html', buses=buses)
+    return render_template('bus_list.html', buses=catalog.list_buses())
+
+@app.route('/search')
+def search():
+    origin, destination, date = (request.args.get(k, '').strip() for k in ('from', 'to', 'date'))
+    results = search_buses(origin, destination, date) if origin or destination else []
+    # dated departures on that day; buses above are the undated ones whose depart_time matches
+    day_trips = search_trips(origin, destination, date) if date and (origin or destination) else []
+    return render_template('bus_list.html', buses=results, trips=day_trips, searched=True)
+
+def idempotency_key():
+    # the Idempotency-Key header, or the token the form was rendered with; '' if none
+    key = request.headers.get('Idempotency-Key') or request.form.get('idempotency_key', '')
+    if key and not idempotency.valid_key(key):
+        abort(400)
+    return key
 
 @app.route('/book/<int:bus_id>', methods=['GET','POST'])
+@app.route('/book/<int:bus_id>/trip/<int:trip_id>', methods=['GET','POST'])
 @login_required
-def book(bus_id):
-    session = SessionLocal()
-    bus = session.query(Bus).filter_by(id=bus_id).first()
-    if not bus:
-        session.close()
+def book(bus_id, trip_id=None):
+    # a trip is one dated departure of the bus with its own seats
+    if trip_id is None:
+        bus, free_seats = queries.get_bus_with_free_seats(db, bus_id)
+    else:
+        bus, free_seats = queries.get_trip_with_free_seats(db, trip_id)
+    if not bus or (trip_id is not None and bus.bus_id != bus_id):
         flash('Bus not found', 'danger'); return redirect(url_for('buses'))
     if request.method == 'POST':
         seats = int(request.form.get('seats', 1))
         passenger_name = request.form.get('passenger_name', current_user.username)
         passenger_phone = request.form.get('passenger_phone','')
-        if seats <= 0 or seats > bus.available_seats:
-            flash('Invalid seat count', 'danger'); session.close(); return redirect(url_for('book', bus_id=bus_id))
-        # create booking
-        u_session = SessionLocal()
-        user = u_session.query(User).filter_by(id=int(current_user.id)).first()
-        booking = Booking(user=user, bus=bus, seats=seats, passenger_name=passenger_name, passenger_phone=passenger_phone)
-        bus.available_seats -= seats
-        u_session.add(booking)
-        u_session.commit()
-        u_session.close()
-        flash('Booking successful', 'success')
-        return redirect(url_for('my_bookings'))
-    session.close()
-    return render_template('book.html', bus=bus)
+        back = url_for('book', bus_id=bus_id, trip_id=trip_id)
+        try:
+            seat_numbers = seatmap.parse_seats(request.form.get('seat_numbers', ''))
+        except ValueError:
+            flash('Seat numbers must be comma separated numbers', 'danger'); return redirect(back)
+        if seats <= 0 and not seat_numbers:
+            flash('Invalid seat count', 'danger'); return redirect(back)
+        # seats are taken off sale by the hold; the booking is only written on confirm
+        # a double click or a retried POST carries the same key and gets the same hold back
+        try:
+            hold = holds.create_hold(bus_id, int(current_user.id), seats, passenger_name, passenger_phone,
+                                     seat_numbers=seat_numbers, trip_id=trip_id, idempotency_key=idempotency_key())
+        except idempotency.KeyReused:
+            abort(422)
+        except group_commit.Busy:
+            flash('Server busy, please try again', 'danger'); return redirect(back)
+        if hold is None:
+            flash('Those seats are not available', 'danger'); return redirect(back)
+        return redirect(url_for('view_hold', hold_id=hold[0]))
+    return render_template('book.html', bus=bus, free_seats=free_seats, trip=trip_id is not None,
+                           idempotency_key=uuid.uuid4().hex)
+
+@app.route('/hold/<int:hold_id>')
+@login_required
+def view_hold(hold_id):
+    hold = queries.get_hold(db, hold_id)
+    if not hold or hold.user_id != int(current_user.id):
+        flash('Hold not found', 'danger'); return redirect(url_for('buses'))
+    return render_template('hold.html', hold=hold, now=datetime.utcnow(), idempotency_key=uuid.uuid4().hex)
+
+@app.route('/hold/<int:hold_id>/confirm', methods=['POST'])
+@login_required
+def confirm_hold(hold_id):
+    try:
+        booking_id = holds.confirm_hold(hold_id, int(current_user.id), idempotency_key=idempotency_key())
+    except idempotency.KeyReused:
+        abort(422)
+    if booking_id is None:
+        flash('This hold has expired or was already used', 'danger'); return redirect(url_for('buses'))
+    flash('Booking successful', 'success')
+    return redirect(url_for('my_bookings'))
+
+@app.route('/hold/<int:hold_id>/release', methods=['POST'])
+@login_required
+def release_hold(hold_id):
+    if holds.release_hold(hold_id, int(current_user.id)):
+        flash('Seats released', 'info')
+    return redirect(url_for('buses'))
+
+@app.route('/booking/<int:booking_id>/cancel', methods=['POST'])
+@login_required
+def cancel_booking(booking_id):
+    # admins may cancel any booking, with a full refund
+    if current_user.is_admin:
+        refund = reservations.cancel_booking(booking_id, refund_percent=100)
+    else:
+        refund = reservations.cancel_booking(booking_id, int(current_user.id))
+    if refund is None:
+        flash('Booking not found or already cancelled', 'danger')
+    else:
+        flash(f'Booking cancelled, ₹{refund} refunded', 'info')
+    return redirect(url_for('admin_dashboard' if current_user.is_admin else 'my_bookings'))
+
+@app.route('/events/availability')
+def availability_events():
+    # Server-Sent Events: seat counts of buses/trips as they change (see events.py)
+    sub = events.feed.subscribe()
+
+    def stream():
+        try:
+            yield from events.sse_stream(sub)
+        finally:
+            events.feed.unsubscribe(sub)
+    return Response(stream(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
 
 @app.route('/my_bookings')
 @login_required
 def my_bookings():
-    session = SessionLocal()
-    user = session.query(User).filter_by(id=int(current_user.id)).first()
-    bookings = user.bookings if user else []
-    session.close()
+    bookings = queries.user_bookings(db, int(current_user.id))
     return render_template('bookings.html', bookings=bookings)
 
 if __name__ == "__main__":
+    start()
     app.run(debug=True)
@@ -0,0 +1,132 @@
+import hmac
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy import update
+from models import User
+import queries
+import instrumentation
+import config
+
+# Password hashing and login checks, shared by the web app, the desktop
+# client and the CLI.
+#
+# - Hash cost is PASSWORD_HASH_METHOD. Hashes made with older parameters (or
+#   legacy plaintext passwords from the old CLI database) still verify and
+#   are replaced with a fresh hash on the next successful login.
+# - Hashing runs on a small thread pool (hashlib releases the GIL), so at
+#   most AUTH_WORKERS hashes burn CPU at once however many logins arrive;
+#   past AUTH_QUEUE waiting jobs callers get Busy straight away.
+# - Token buckets per username and per client address reject floods before
+#   any hashing is done.
+
+class Throttled(Exception):
+    pass
+
+class Busy(Exception):
+    pass
+
+_HASH_METHODS = ('pbkdf2:', 'scrypt:')
+
+def hash_password(password):
+    return generate_password_hash(password, method=config.PASSWORD_HASH_METHOD,
+                                  salt_length=config.PASSWORD_SALT_LENGTH)
+
+@lru_cache(maxsize=None)
+def _reference_hash():
+    # One hash with the current settings, made on first use rather than at
+    # import (each costs a full PBKDF2/scrypt run), so only call it from a job
+    # on the auth pool. Its method prefix, e.g. "pbkdf2:sha256:600000", is
+    # what needs_rehash compares against, and it is verified against for
+    # unknown usernames so they take as long as real ones.
+    return hash_password('not a password')
+
+def is_hashed(stored):
+    return bool(stored) and stored.startswith(_HASH_METHODS) and '$' in stored
+
+def verify_password(stored, password):
+    if not stored:
+        return False
+    if is_hashed(stored):
+        return check_password_hash(stored, password)
+    # plaintext left over from the old CLI schema
+    return hmac.compare_digest(stored.encode(), password.encode())
+
+def needs_rehash(stored):
+    # may hash once (the reference); run it on the auth pool
+    reference = _reference_hash()
+    return not is_hashed(stored) or stored[:stored.index('$')] != reference[:reference.index('$')]
+
+def _check(stored, password):
+    # auth pool job: (password matches, stored hash should be replaced)
+    return verify_password(stored, password), needs_rehash(stored)
+
+_pool = ThreadPoolExecutor(max_workers=config.AUTH_WORKERS, thread_name_prefix='auth')
+_slots = threading.BoundedSemaphore(config.AUTH_WORKERS + config.AUTH_QUEUE)
+
+def submit(fn, *args):
+    # run a hashing job on the auth pool; raises Busy when the queue is full
+    if not _slots.acquire(blocking=False):
+        raise Busy()
+    try:
+        future = _pool.submit(fn, *args)
+    except BaseException:
+        _slots.release()
+        raise
+    future.add_done_callback(lambda f: _slots.release())
+    return future
+
+def run(fn, *args):
+    started = time.perf_counter()
+    try:
+        return submit(fn, *args).result()
+    finally:
+        instrumentation.add_hash_time(time.perf_counter() - started)
+
+class TokenBucket:
+    # rate tokens/second up to burst per key; the least recently used keys
+    # are dropped past max_keys (a dropped key simply starts full again)
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  # key -> (tokens, last refill)
+        self._lock = threading.Lock()
+
+    def allow(self, key, cost=1):
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            allowed = tokens >= cost
+            if allowed:
+                tokens -= cost
+            self._buckets[key] = (tokens, now)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return allowed
+
+user_buckets = TokenBucket(config.LOGIN_USER_RATE, config.LOGIN_USER_BURST)
+address_buckets = TokenBucket(config.LOGIN_IP_RATE, config.LOGIN_IP_BURST)
+
+def authenticate(session, username, password, address=None):
+    # Returns the queries.UserRow, or None for bad credentials. Raises
+    # Throttled or Busy without hashing anything. A hash made with old
+    # parameters is upgraded in the caller's session (committed here).
+    if (address is not None and not address_buckets.allow(address)) or not user_buckets.allow(username.lower()):
+        raise Throttled()
+    user = queries.get_user_by_name(session, username)
+    if user:
+        ok, stale = run(_check, user.password, password)
+    else:
+        ok = run(lambda: verify_password(_reference_hash(), password))
+    if not user or not ok:
+        return None
+    if stale:
+        session.execute(update(User).where(User.id == user.id, User.password == user.password)
+                        .values(password=run(hash_password, password)))
+        session.commit()
+    return user
@@ -0,0 +1,175 @@
+# Load generator for the partner JSON API (api_async.py).
+# Keeps --concurrency requests in flight and reports throughput and p50/p99
+# latency per operation. By default the ASGI app is driven in-process
+# against a scratch SQLite database; --url targets a running server instead
+# (e.g. uvicorn api_async:app), which then uses its own database.
+#
+#   python bench/api_load.py --requests 5000 --concurrency 200
+#   python bench/api_load.py --url http://127.0.0.1:8000 --api-key partner-key
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from urllib.parse import urlsplit
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+class InProcessClient:
+    # minimal ASGI caller, no HTTP stack in between
+    def __init__(self, app):
+        self.app = app
+
+    async def request(self, method, path, headers, body=None):
+        path, _, query = path.partition('?')
+        raw = json.dumps(body).encode() if body is not None else b''
+        scope = {'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1', 'method': method,
+                 'scheme': 'http', 'path': path, 'raw_path': path.encode(), 'query_string': query.encode(),
+                 'root_path': '', 'headers': [(k.lower().encode(), v.encode()) for k, v in headers.items()]
+                 + [(b'content-type', b'application/json')], 'client': ('bench', 0), 'server': ('bench', 80)}
+        messages = [{'type': 'http.request', 'body': raw, 'more_body': False}]
+        status, chunks = None, []
+
+        async def receive():
+            return messages.pop(0) if messages else {'type': 'http.disconnect'}
+
+        async def send(message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif message['type'] == 'http.response.body':
+                chunks.append(message.get('body', b''))
+
+        await self.app(scope, receive, send)
+        return status, json.loads(b''.join(chunks) or b'null')
+
+class HTTPClient:
+    # one short-lived HTTP/1.1 connection per request over asyncio streams
+    def __init__(self, url):
+        parts = urlsplit(url)
+        self.host, self.port = parts.hostname, parts.port or 80
+
+    async def request(self, method, path, headers, body=None):
+        raw = json.dumps(body).encode() if body is not None else b''
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        head = [f"{method} {path} HTTP/1.1", f"Host: {self.host}", "Connection: close",
+                "Content-Type: application/json", f"Content-Length: {len(raw)}"]
+        head += [f"{k}: {v}" for k, v in headers.items()]
+        writer.write(('\r\n'.join(head) + '\r\n\r\n').encode() + raw)
+        await writer.drain()
+        data = await reader.read()
+        writer.close()
+        header, _, payload = data.partition(b'\r\n\r\n')
+        status = int(header.split(b' ', 2)[1])
+        if b'transfer-encoding: chunked' in header.lower():
+            payload = _unchunk(payload)
+        return status, json.loads(payload or b'null')
+
+def _unchunk(payload):
+    out = b''
+    while payload:
+        size, _, rest = payload.partition(b'\r\n')
+        n = int(size, 16)
+        if n == 0:
+            break
+        out, payload = out + rest[:n], rest[n + 2:]
+    return out
+
+def seed(buses, seats):
+    from models import SessionLocal, User, Bus, init_db
+    init_db()
+    session = SessionLocal()
+    user = User(username=f'partner-{time.time_ns()}', password='x')
+    session.add(user)
+    cities = [f"City {i}" for i in range(50)]
+    rng = random.Random(1)
+    session.add_all(Bus(name=f'Bus {i}', route=' - '.join(rng.sample(cities, 4)), total_seats=seats,
+                        available_seats=seats, fare=100) for i in range(buses))
+    session.commit()
+    user_id = user.id
+    session.close()
+    return user_id, cities
+
+async def run(args):
+    api_key = args.api_key
+    cities = [f"City {i}" for i in range(50)]
+    if args.url:
+        client = HTTPClient(args.url)
+    else:
+        if not os.environ.get('DATABASE_URL'):
+            tmpdir = tempfile.mkdtemp(prefix='bus_api_bench_')
+            os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+        user_id, cities = seed(args.buses, args.seats)
+        api_key = 'bench-key'
+        import config
+        config.API_KEYS[api_key] = user_id
+        import api_async
+        client = InProcessClient(api_async.app)
+    headers = {'X-API-Key': api_key}
+    rng = random.Random(args.seed)
+    latencies = {}
+    statuses = {}
+    queue = asyncio.Queue()
+    for i in range(args.requests):
+        queue.put_nowait(i)
+
+    async def timed(op, method, path, body=None):
+        start = time.perf_counter()
+        status, payload = await client.request(method, path, headers, body)
+        latencies.setdefault(op, []).append(time.perf_counter() - start)
+        statuses[(op, status)] = statuses.get((op, status), 0) + 1
+        return status, payload
+
+    async def worker():
+        while True:
+            try:
+                queue.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+            roll = rng.random()
+            if roll < args.search_ratio:
+                a, b = rng.sample(cities, 2)
+                await timed('search', 'GET', f"/api/search?from={a.replace(' ', '+')}&to={b.replace(' ', '+')}")
+                continue
+            bus_id = rng.randint(1, args.buses)
+            status, payload = await timed('hold', 'POST', '/api/holds',
+                                          {'bus_id': bus_id, 'seats': rng.randint(1, 3), 'passenger_name': 'load'})
+            if status != 201:
+                continue
+            if rng.random() < 0.8:
+                await timed('confirm', 'POST', f"/api/holds/{payload['hold_id']}/confirm")
+            else:
+                await timed('cancel', 'DELETE', f"/api/holds/{payload['hold_id']}")
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+    elapsed = time.perf_counter() - start
+
+    total = sum(len(v) for v in latencies.values())
+    print(f"requests:     {total} in {elapsed:.2f}s, concurrency {args.concurrency}")
+    print(f"throughput:   {total / elapsed:.1f} req/s")
+    for op, values in sorted(latencies.items()):
+        values.sort()
+        p50 = values[len(values) // 2] * 1000
+        p99 = values[min(len(values) - 1, int(len(values) * 0.99))] * 1000
+        codes = ', '.join(f"{code}x{n}" for (o, code), n in sorted(statuses.items()) if o == op)
+        print(f"{op:<8}      n={len(values):<6} p50={p50:7.1f} ms  p99={p99:7.1f} ms  [{codes}]")
+
+def main():
+    parser = argparse.ArgumentParser(description='Partner API load generator')
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=200)
+    parser.add_argument('--buses', type=int, default=200, help='buses to seed (in-process mode)')
+    parser.add_argument('--seats', type=int, default=40, help='seats per seeded bus')
+    parser.add_argument('--search-ratio', type=float, default=0.7)
+    parser.add_argument('--url', help='base URL of a running API server')
+    parser.add_argument('--api-key', default='', help='API key for --url mode')
+    parser.add_argument('--seed', type=int, default=7)
+    asyncio.run(run(parser.parse_args()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,86 @@
+# Concurrency stress test for reservations.book_seats.
+# Fires many concurrent bookings at a single bus from a thread pool and checks
+# that the bus is never oversold, no decrement is lost and no seat is
+# assigned twice.
+#
+#   python bench/booking_stress.py --threads 32 --bookings 5000 --seats 1000
+#
+# Runs against a throwaway SQLite file unless DATABASE_URL is already set.
+import argparse
+import os
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def main():
+    parser = argparse.ArgumentParser(description='Concurrent booking stress test')
+    parser.add_argument('--threads', type=int, default=32)
+    parser.add_argument('--bookings', type=int, default=5000, help='booking attempts to fire')
+    parser.add_argument('--seats', type=int, default=1000, help='capacity of the bus under test')
+    parser.add_argument('--per-booking', type=int, default=1, help='seats requested per booking')
+    args = parser.parse_args()
+
+    tmpdir = None
+    if not os.environ.get('DATABASE_URL'):
+        tmpdir = tempfile.mkdtemp(prefix='bus_bench_')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+
+    from sqlalchemy import func
+    from models import SessionLocal, Bus, Booking, User, init_db
+    import reservations
+    import seatmap
+
+    init_db()
+    session = SessionLocal()
+    user = User(username=f'bench-{time.time_ns()}', password='x')
+    bus = Bus(name='Stress Bus', route='A-B', total_seats=args.seats, available_seats=args.seats, fare=1)
+    session.add_all([user, bus]); session.commit()
+    user_id, bus_id = user.id, bus.id
+    session.close()
+
+    def attempt(i):
+        try:
+            return reservations.book_seats(bus_id, user_id, args.per_booking, f'p{i}') is not None, None
+        except Exception as exc:  # retries exhausted
+            return False, exc
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        results = list(pool.map(attempt, range(args.bookings)))
+    elapsed = time.perf_counter() - start
+
+    ok = sum(1 for r, _ in results if r)
+    errors = [e for _, e in results if e is not None]
+
+    session = SessionLocal()
+    available = session.query(Bus.available_seats).filter_by(id=bus_id).scalar()
+    booked = session.query(func.coalesce(func.sum(Booking.seats), 0)).filter_by(bus_id=bus_id).scalar()
+    seat_map = session.query(Bus.seat_map).filter_by(id=bus_id).scalar()
+    assigned = [n for (text,) in session.query(Booking.seat_numbers).filter_by(bus_id=bus_id)
+                for n in seatmap.parse_seats(text)]
+    session.close()
+    bits = seatmap.load(seat_map, args.seats, available)
+
+    print(f"attempts:        {args.bookings} ({args.threads} threads)")
+    print(f"successful:      {ok}")
+    print(f"rejected:        {args.bookings - ok - len(errors)}")
+    print(f"errors:          {len(errors)}" + (f" (first: {errors[0]!r})" if errors else ''))
+    print(f"seats booked:    {booked} / {args.seats}, available now {available}")
+    print(f"seat map:        {seatmap.taken_count(bits)} taken, {len(assigned)} assigned, {len(set(assigned))} distinct")
+    print(f"elapsed:         {elapsed:.2f}s")
+    print(f"bookings/sec:    {ok / elapsed:.1f}")
+    print(f"attempts/sec:    {args.bookings / elapsed:.1f}")
+
+    consistent = (available >= 0 and booked + available == args.seats and booked == ok * args.per_booking
+                  and len(assigned) == len(set(assigned)) == booked == seatmap.taken_count(bits))
+    print("consistency:     " + ("OK" if consistent else "FAILED (oversell or lost update)"))
+    if tmpdir:
+        print(f"database:        {os.environ['DATABASE_URL']}")
+    return 0 if consistent else 1
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,159 @@
+# Synthetic data generator for benchmarks: users, buses and bookings written
+# straight into the models schema with executemany inserts, chunk by chunk,
+# so even the largest scale runs in flat memory. Seat inventory stays
+# consistent (each booking takes the next free seats of its bus, available
+# seats and the sales aggregates match the bookings). Same seed, same data.
+#
+#   python bench/datagen.py --scale medium
+#   DATABASE_URL=sqlite:////tmp/big.db python bench/datagen.py --scale xl
+#   python bench/datagen.py --users 5000 --buses 2000 --bookings 50000
+#
+# Every generated user has the password "bench"; "bench-admin" / "bench" is
+# created as an admin if missing.
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+# users, buses, bookings; seats per bus grow with scale so the bookings fit
+SCALES = {
+    'tiny':   (100, 50, 1000),
+    'small':  (1000, 500, 10000),
+    'medium': (10000, 2500, 100000),
+    'large':  (100000, 25000, 1000000),
+    'xl':     (1000000, 250000, 10000000),
+}
+PASSWORD = 'bench'
+ADMIN = 'bench-admin'
+CHUNK_ROWS = 10000
+
+FIRST = ['Aarav', 'Priya', 'Rohan', 'Ananya', 'Vikram', 'Meera', 'Arjun', 'Kavya', 'Ishaan', 'Diya', 'Kabir',
+         'Sara', 'Aditya', 'Neha', 'Rahul', 'Pooja']
+LAST = ['Sharma', 'Verma', 'Iyer', 'Reddy', 'Gupta', 'Nair', 'Singh', 'Das', 'Mehta', 'Khan', 'Patel', 'Joshi']
+
+def scale_counts(args):
+    users, buses, bookings = SCALES[args.scale]
+    return (args.users or users, args.buses or buses, args.bookings or bookings)
+
+def _insert(conn, table, rows):
+    if rows:
+        conn.execute(table.insert(), rows)
+    return len(rows)
+
+def generate(users, buses, bookings, seed=42, cities=300, days=90, seats=None, chunk_rows=CHUNK_ROWS, log=print):
+    # Appends to whatever is already in the database (ids continue from the
+    # current maximum). Returns {'users': n, 'buses': n, 'bookings': n, 'seconds': s}.
+    from sqlalchemy import select, func
+    from models import engine, User, Bus, Booking
+    import aggregates
+    import auth
+    import migrations
+
+    migrations.check()
+    rng = random.Random(seed)
+    started = time.perf_counter()
+    # bookings average 2 seats; sized so buses end up about two thirds full
+    seats = seats or max(40, -(-bookings * 3 // buses))
+    password = auth.hash_password(PASSWORD)
+    names = [f'City {i}' for i in range(cities)]
+
+    with engine.begin() as conn:
+        first_user = (conn.execute(select(func.max(User.id))).scalar() or 0) + 1
+        first_bus = (conn.execute(select(func.max(Bus.id))).scalar() or 0) + 1
+        if not conn.execute(select(User.id).where(User.username == ADMIN)).first():
+            conn.execute(User.__table__.insert(), {'username': ADMIN, 'password': password, 'is_admin': True})
+            first_user += 1
+
+    for start in range(0, users, chunk_rows):
+        with engine.begin() as conn:
+            _insert(conn, User.__table__, [{'id': first_user + i, 'username': f'user{first_user + i}',
+                                            'password': password, 'is_admin': False}
+                                           for i in range(start, min(users, start + chunk_rows))])
+    log(f"users:    {users}")
+
+    # Seats are handed out in order, so a bus only needs (total, sold). The
+    # allocation is replayed from its own seed: once to learn what each bus
+    # sells (buses go in first, with the right available_seats), then again
+    # while writing the bookings.
+    totals = [rng.randint(seats // 2, seats * 3 // 2) for _ in range(buses)]
+
+    def allocate():
+        pick = random.Random(seed + 1)
+        used = [0] * buses
+        for _ in range(bookings):
+            b = pick.randrange(buses)
+            n = pick.choice((1, 1, 1, 2, 2, 3, 4))
+            tried = 0
+            while used[b] + n > totals[b]:
+                b, n, tried = (b + 1) % buses, 1, tried + 1
+                if tried > buses:
+                    raise ValueError(f"{bookings} bookings do not fit in {buses} buses of ~{seats} seats")
+            yield b, used[b], n
+            used[b] += n
+
+    sold = [0] * buses
+    for b, first_seat, n in allocate():
+        sold[b] += n
+    for start in range(0, buses, chunk_rows):
+        rows = []
+        for b in range(start, min(buses, start + chunk_rows)):
+            stops = rng.sample(names, rng.randint(2, 5))
+            rows.append({'id': first_bus + b, 'name': f'Bus {first_bus + b}', 'route': ' - '.join(stops),
+                         'total_seats': totals[b], 'available_seats': totals[b] - sold[b],
+                         'fare': rng.randrange(100, 2000, 10),
+                         'depart_time': f'{rng.randrange(24):02d}:{rng.choice((0, 15, 30, 45)):02d}'})
+        with engine.begin() as conn:
+            _insert(conn, Bus.__table__, rows)
+    log(f"buses:    {buses}")
+
+    now = datetime.utcnow().replace(microsecond=0)
+    span = days * 86400
+    rows = []
+    for b, first_seat, n in allocate():
+        rows.append({'user_id': first_user + rng.randrange(users), 'bus_id': first_bus + b, 'seats': n,
+                     'passenger_name': f'{rng.choice(FIRST)} {rng.choice(LAST)}',
+                     'passenger_phone': f'9{rng.randrange(10 ** 9):09d}',
+                     'seat_numbers': ','.join(str(s) for s in range(first_seat + 1, first_seat + n + 1)),
+                     'booked_at': now - timedelta(seconds=rng.randrange(span)), 'status': 'active'})
+        if len(rows) >= chunk_rows:
+            with engine.begin() as conn:
+                _insert(conn, Booking.__table__, rows)
+            rows = []
+    with engine.begin() as conn:
+        _insert(conn, Booking.__table__, rows)
+    log(f"bookings: {bookings}")
+
+    aggregates.rebuild()
+    seconds = time.perf_counter() - started
+    log(f"done in {seconds:.1f}s ({(users + buses + bookings) / seconds:,.0f} rows/s)")
+    return {'users': users, 'buses': buses, 'bookings': bookings, 'seconds': round(seconds, 3)}
+
+def add_arguments(parser):
+    parser.add_argument('--scale', choices=list(SCALES), default='small')
+    parser.add_argument('--users', type=int, help='override the scale')
+    parser.add_argument('--buses', type=int, help='override the scale')
+    parser.add_argument('--bookings', type=int, help='override the scale')
+    parser.add_argument('--seed', type=int, default=42)
+
+def main():
+    parser = argparse.ArgumentParser(description='Generate synthetic users, buses and bookings')
+    add_arguments(parser)
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS)
+    args = parser.parse_args()
+
+    tmpdir = None
+    if not os.environ.get('DATABASE_URL'):
+        import tempfile
+        tmpdir = tempfile.mkdtemp(prefix='bus_bench_')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    users, buses, bookings = scale_counts(args)
+    generate(users, buses, bookings, seed=args.seed, chunk_rows=args.chunk_rows)
+    print(f"database: {os.environ['DATABASE_URL']}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+# Route search benchmark: builds search.RouteIndex over a synthetic catalogue
+# and times origin/destination lookups.
+#
+#   python bench/route_search.py --buses 100000 --cities 500 --queries 20000
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+def synthetic_routes(n, cities, rng):
+    names = [f"City {i}" for i in range(cities)]
+    for bus_id in range(1, n + 1):
+        stops = rng.sample(names, rng.randint(2, 6))
+        yield bus_id, ' - '.join(stops)
+
+def main():
+    parser = argparse.ArgumentParser(description='Route search index benchmark')
+    parser.add_argument('--buses', type=int, default=100000)
+    parser.add_argument('--cities', type=int, default=500)
+    parser.add_argument('--queries', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    from search import RouteIndex
+
+    rng = random.Random(args.seed)
+    routes = list(synthetic_routes(args.buses, args.cities, rng))
+    start = time.perf_counter()
+    index = RouteIndex(routes)
+    build = time.perf_counter() - start
+
+    pairs = [tuple(rng.sample(range(args.cities), 2)) for _ in range(args.queries)]
+    timings, found = [], 0
+    for a, b in pairs:
+        t = time.perf_counter()
+        found += len(index.lookup(f"City {a}", f"city {b}"))
+        timings.append(time.perf_counter() - t)
+    timings.sort()
+
+    print(f"catalogue:       {args.buses} buses, {args.cities} cities, {len(index.postings)} stops indexed")
+    print(f"index build:     {build * 1000:.0f} ms")
+    print(f"queries:         {args.queries}, avg {found / args.queries:.1f} matches")
+    print(f"lookup mean:     {statistics.mean(timings) * 1e6:.1f} us")
+    print(f"lookup p50:      {timings[len(timings) // 2] * 1e6:.1f} us")
+    print(f"lookup p99:      {timings[int(len(timings) * 0.99)] * 1e6:.1f} us")
+    print(f"lookup max:      {timings[-1] * 1e6:.1f} us")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,218 @@
+# Benchmark runner: times the real entry points of the web app (through the
+# Flask test client, no HTTP server in between) and the CSV export/import in
+# utils against a database filled by bench/datagen.py, and writes the
+# results as JSON. --compare diffs two result files and exits non-zero when
+# an entry point got slower than --threshold allows.
+#
+#   python bench/run.py --scale medium -o before.json
+#   python bench/run.py --scale medium -o after.json
+#   python bench/run.py --compare before.json after.json --threshold 0.10
+#
+# Without DATABASE_URL a scratch SQLite database is generated at --scale;
+# with it, --no-generate benchmarks whatever that database already holds.
+import argparse
+import io
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import datagen
+
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return 0.0
+    k = (len(sorted_values) - 1) * p
+    lo = int(k)
+    hi = min(lo + 1, len(sorted_values) - 1)
+    return sorted_values[lo] + (sorted_values[hi] - sorted_values[lo]) * (k - lo)
+
+def measure(fn, iterations, warmup):
+    # fn() runs the operation once and returns the rows it handled (or None)
+    for _ in range(warmup):
+        fn()
+    times, rows = [], 0
+    for _ in range(iterations):
+        start = time.perf_counter()
+        n = fn()
+        times.append(time.perf_counter() - start)
+        rows += n or 0
+    times.sort()
+    total = sum(times)
+    result = {'iterations': iterations, 'min': times[0], 'p50': percentile(times, 0.5),
+              'p95': percentile(times, 0.95), 'mean': total / iterations, 'max': times[-1],
+              'ops_per_sec': iterations / total if total else 0.0}
+    if rows:
+        result['rows_per_sec'] = rows / total if total else 0.0
+    return {k: round(v, 6) if isinstance(v, float) else v for k, v in result.items()}
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+def client_for(app, username, password):
+    client = app.test_client()
+    r = client.post('/login', data={'username': username, 'password': password})
+    if r.status_code != 302:
+        raise SystemExit(f"could not log in as {username} (status {r.status_code})")
+    return client
+
+def run_benchmarks(args):
+    from sqlalchemy import select, func
+    from models import SessionLocal, engine, User, Bus, Booking
+    import app as webapp
+    import holds
+    import utils
+
+    app = webapp.app
+    if args.template_folder:
+        app.template_folder = args.template_folder
+    app.config['TESTING'] = True
+
+    session = SessionLocal()
+    try:
+        counts = {'users': session.execute(select(func.count(User.id))).scalar(),
+                  'buses': session.execute(select(func.count(Bus.id))).scalar(),
+                  'bookings': session.execute(select(func.count(Booking.id))).scalar()}
+        # a bus with seats left, and the user with the most bookings
+        bus_id = session.execute(select(Bus.id).where(Bus.available_seats >= 5, Bus.is_active == True)
+                                 .order_by(Bus.id).limit(1)).scalar()
+        top_user = session.execute(select(User.username).join(Booking, Booking.user_id == User.id)
+                                   .where(User.is_admin == False).group_by(User.id)
+                                   .order_by(func.count(Booking.id).desc()).limit(1)).scalar()
+    finally:
+        session.close()
+    if bus_id is None or top_user is None:
+        raise SystemExit("the database has no bookable bus or no user with bookings; generate data first")
+
+    admin = client_for(app, datagen.ADMIN, datagen.PASSWORD)
+    user = client_for(app, top_user, datagen.PASSWORD)
+
+    def get(client, path):
+        def fn():
+            r = client.get(path)
+            if r.status_code != 200:
+                raise RuntimeError(f"GET {path} returned {r.status_code}")
+        return fn
+
+    def hold_and_release():
+        r = user.post(f'/book/{bus_id}', data={'seats': '1', 'passenger_name': 'Bench'})
+        if r.status_code != 302 or '/hold/' not in r.headers.get('Location', ''):
+            raise RuntimeError(f"POST /book/{bus_id} did not create a hold")
+        holds.release_hold(int(r.headers['Location'].rstrip('/').split('/')[-1]))
+
+    def export():
+        return utils.export_bookings_csv().count('\n') - 1
+
+    import_csv = ''.join(['name,route,total_seats,fare,depart_time,extra\n'] +
+                         [f'Import {i},City {i % 97} - City {i % 89 + 100},40,{100 + i % 50},{i % 24:02d}:00,\n'
+                          for i in range(args.import_rows)]).encode()
+
+    def import_buses():
+        result = utils.import_buses_csv(io.BytesIO(import_csv))
+        if result.failed:
+            raise RuntimeError(f"import rejected {result.failed} rows")
+        return result.inserted
+
+    benchmarks = [
+        ('GET /', get(user, '/'), args.iterations, args.warmup),
+        ('GET /buses', get(user, '/buses'), args.iterations, args.warmup),
+        ('GET /admin', get(admin, '/admin'), args.iterations, args.warmup),
+        ('GET /book/<id>', get(user, f'/book/{bus_id}'), args.iterations, args.warmup),
+        ('POST /book/<id>', hold_and_release, args.iterations, args.warmup),
+        ('GET /my_bookings', get(user, '/my_bookings'), args.iterations, args.warmup),
+        ('utils.export_bookings_csv', export, args.bulk_iterations, 1),
+        # last: it adds buses, which would change what the pages above list
+        ('utils.import_buses_csv', import_buses, args.bulk_iterations, 1),
+    ]
+    results = {}
+    for name, fn, iterations, warmup in benchmarks:
+        if args.only and not any(part in name for part in args.only):
+            continue
+        results[name] = measure(fn, iterations, warmup)
+        r = results[name]
+        extra = f", {r['rows_per_sec']:,.0f} rows/s" if 'rows_per_sec' in r else ''
+        print(f"{name:28} p50 {r['p50'] * 1000:9.2f} ms  p95 {r['p95'] * 1000:9.2f} ms{extra}", file=sys.stderr)
+
+    meta = {'timestamp': datetime.utcnow().isoformat(timespec='seconds') + 'Z', 'commit': git_commit(),
+            'python': platform.python_version(), 'platform': platform.platform(),
+            'database': engine.dialect.name, 'scale': args.scale if args.generated else None,
+            'seed': args.seed, 'counts': counts, 'iterations': args.iterations,
+            'bulk_iterations': args.bulk_iterations}
+    return {'meta': meta, 'results': results}
+
+def compare(base_path, new_path, threshold):
+    # p50 is compared; returns the number of regressions
+    with open(base_path) as f:
+        base = json.load(f)
+    with open(new_path) as f:
+        new = json.load(f)
+    if base['meta'].get('counts') != new['meta'].get('counts'):
+        print(f"warning: different data sizes ({base['meta'].get('counts')} vs {new['meta'].get('counts')})")
+    regressions = 0
+    print(f"{'benchmark':28} {'base p50':>11} {'new p50':>11} {'change':>8}")
+    for name in list(base['results']) + [n for n in new['results'] if n not in base['results']]:
+        old, cur = base['results'].get(name), new['results'].get(name)
+        if not old or not cur:
+            print(f"{name:28} {'only in ' + ('base' if old else 'new'):>32}")
+            continue
+        change = cur['p50'] / old['p50'] - 1 if old['p50'] else 0.0
+        flag = ''
+        if change > threshold:
+            flag = 'REGRESSION'
+            regressions += 1
+        elif change < -threshold:
+            flag = 'improved'
+        print(f"{name:28} {old['p50'] * 1000:9.2f}ms {cur['p50'] * 1000:9.2f}ms {change:+8.1%} {flag}")
+    print(f"{regressions} regression(s) beyond {threshold:.0%}" if regressions else "no regressions")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the web entry points and CSV export/import')
+    datagen.add_arguments(parser)
+    parser.add_argument('--no-generate', action='store_true', help='use the data already in DATABASE_URL')
+    parser.add_argument('--iterations', type=int, default=200, help='timed runs per page')
+    parser.add_argument('--bulk-iterations', type=int, default=3, help='timed runs of export and import')
+    parser.add_argument('--warmup', type=int, default=10)
+    parser.add_argument('--import-rows', type=int, default=10000)
+    parser.add_argument('--only', nargs='*', help='run benchmarks whose name contains any of these')
+    parser.add_argument('--template-folder', help='templates directory, if not the app default')
+    parser.add_argument('-o', '--output', help='write the JSON results here (default stdout)')
+    parser.add_argument('--compare', nargs=2, metavar=('BASE', 'NEW'), help='compare two result files')
+    parser.add_argument('--threshold', type=float, default=0.10, help='allowed p50 slowdown (0.10 = 10%%)')
+    args = parser.parse_args()
+
+    if args.compare:
+        return 1 if compare(args.compare[0], args.compare[1], args.threshold) else 0
+
+    if args.no_generate and not os.environ.get('DATABASE_URL'):
+        parser.error('--no-generate needs DATABASE_URL')
+    if not os.environ.get('DATABASE_URL'):
+        tmpdir = tempfile.mkdtemp(prefix='bus_bench_')
+        os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(tmpdir, 'bench.db')
+    args.generated = not args.no_generate
+    if args.generated:
+        users, buses, bookings = datagen.scale_counts(args)
+        datagen.generate(users, buses, bookings, seed=args.seed, log=lambda msg: print(msg, file=sys.stderr))
+
+    report = json.dumps(run_benchmarks(args), indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(report + '\n')
+    else:
+        print(report)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
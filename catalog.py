@@ -0,0 +1,76 @@
+import threading
+import time
+from collections import OrderedDict
+from models import SessionLocal
+import queries
+import config
+
+# In-process read-through cache for the bus catalogue (/, /buses, /admin).
+# Every write that changes what those pages show (bus add/edit/delete, CSV
+# import, bookings) calls invalidate(), which bumps the version and drops all
+# entries. The TTL only bounds staleness from writers in *other* processes
+# (other web workers, the desktop client), which cannot reach this cache.
+# route_version only moves when buses themselves change, not on bookings, so
+# structures built from routes alone (search.RouteIndex) survive seat sales.
+
+class CatalogueCache:
+    def __init__(self, ttl, max_entries):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.version = 0
+        self.route_version = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self._entries = OrderedDict()  # key -> (version, expires_at, value)
+        self._lock = threading.Lock()
+
+    def get(self, key, loader):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry[0] == self.version and entry[1] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            version = self.version
+        value = loader()
+        with self._lock:
+            # an invalidation while we were loading means value may already be stale
+            if version == self.version:
+                self._entries[key] = (version, now + self.ttl, value)
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+        return value
+
+    def invalidate(self, routes=True):
+        with self._lock:
+            self.version += 1
+            if routes:
+                self.route_version += 1
+            self.invalidations += 1
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'version': self.version, 'route_version': self.route_version, 'entries': len(self._entries),
+                    'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations}
+
+catalogue = CatalogueCache(config.CATALOGUE_CACHE_TTL, config.CATALOGUE_CACHE_SIZE)
+
+def _load_buses():
+    # queries.BusRow tuples are immutable and safe to share between requests
+    session = SessionLocal()
+    try:
+        return tuple(queries.list_buses(session))
+    finally:
+        session.close()
+
+def list_buses():
+    return catalogue.get('buses', _load_buses)
+
+def invalidate(routes=True):
+    # routes=False when only seat counts changed (bookings)
+    catalogue.invalidate(routes)
@@ -2,10 +2,15 @@ import os
 
 BASE_DIR = os.path.abspath(os.path.dirname(__file__))
 
+# DATABASE_URL overrides everything below (handy for benchmarks and throwaway databases)
+DATABASE_URL = os.environ.get('DATABASE_URL')
+
 # Choose sqlite by default. To use MySQL, set DB_TYPE='mysql' and provide MYSQL_USER/PASS/DB/HOST
 DB_TYPE = os.environ.get('DB_TYPE', 'sqlite')  # 'sqlite' or 'mysql'
 
-if DB_TYPE == 'mysql':
+if DATABASE_URL:
+    SQLALCHEMY_DATABASE_URI = DATABASE_URL
+elif DB_TYPE == 'mysql':
     MYSQL_USER = os.environ.get('MYSQL_USER', 'root')
     MYSQL_PASS = os.environ.get('MYSQL_PASS', '')
     MYSQL_HOST = os.environ.get('MYSQL_HOST', 'localhost')
@@ -15,3 +20,98 @@ else:
     SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(BASE_DIR, 'bus_reservation.db')
 
 SECRET_KEY = os.environ.get('SECRET_KEY', 'change-this-secret')
+
+# Engine / connection pool (models.make_engine). Pool settings apply to MySQL and file-backed SQLite.
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 10))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 20))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))      # seconds to wait for a free connection
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))      # MySQL: reconnect before wait_timeout
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', '1') == '1'   # MySQL: test connections on checkout
+
+# SQLite pragmas applied to every new connection
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+
+# Booking engine: how many times a booking transaction is retried on lock/deadlock errors
+BOOKING_MAX_RETRIES = int(os.environ.get('BOOKING_MAX_RETRIES', 5))
+
+# In-process bus catalogue cache (catalog.py): seconds an entry may live, and max entries
+CATALOGUE_CACHE_TTL = float(os.environ.get('CATALOGUE_CACHE_TTL', 30))
+CATALOGUE_CACHE_SIZE = int(os.environ.get('CATALOGUE_CACHE_SIZE', 64))
+
+# Web app: how long (seconds) and how many logged-in user records load_user keeps in memory
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 60))
+USER_CACHE_SIZE = int(os.environ.get('USER_CACHE_SIZE', 10000))
+
+# Seat holds: how long a hold keeps seats off sale before it must be confirmed
+HOLD_TTL_SECONDS = int(os.environ.get('HOLD_TTL_SECONDS', 600))
+# how often the hold reaper also sweeps for expired holds made by other processes
+HOLD_SWEEP_INTERVAL = float(os.environ.get('HOLD_SWEEP_INTERVAL', 60))
+
+# share of the fare refunded when a passenger cancels; operator cancellations refund in full
+CANCEL_REFUND_PERCENT = int(os.environ.get('CANCEL_REFUND_PERCENT', 100))
+
+# Dated trips: how far ahead schedules are expanded, and how long past trips stay in the hot table
+TRIP_HORIZON_DAYS = int(os.environ.get('TRIP_HORIZON_DAYS', 30))
+TRIP_ARCHIVE_AFTER_DAYS = int(os.environ.get('TRIP_ARCHIVE_AFTER_DAYS', 7))
+
+# Passwords: werkzeug hash method ("pbkdf2:sha256:<iterations>" or "scrypt:<n>:<r>:<p>"); existing
+# hashes with other parameters are rehashed on the next login
+PASSWORD_HASH_METHOD = os.environ.get('PASSWORD_HASH_METHOD', 'pbkdf2:sha256:600000')
+PASSWORD_SALT_LENGTH = int(os.environ.get('PASSWORD_SALT_LENGTH', 16))
+# hashing threads, and how many more logins may wait for one before being turned away
+AUTH_WORKERS = int(os.environ.get('AUTH_WORKERS', 2))
+AUTH_QUEUE = int(os.environ.get('AUTH_QUEUE', 32))
+# login attempts: token bucket per username and per client address (refill per second, burst)
+LOGIN_USER_RATE = float(os.environ.get('LOGIN_USER_RATE', 0.2))
+LOGIN_USER_BURST = int(os.environ.get('LOGIN_USER_BURST', 10))
+LOGIN_IP_RATE = float(os.environ.get('LOGIN_IP_RATE', 1))
+LOGIN_IP_BURST = int(os.environ.get('LOGIN_IP_BURST', 30))
+
+# Request instrumentation (instrumentation.py): per-request SQL/render/hash timing and /metrics.
+# /metrics is only served with METRICS_TOKEN set, to requests sending "Authorization: Bearer <token>".
+INSTRUMENTATION = os.environ.get('INSTRUMENTATION', '0') == '1'
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+SLOW_QUERY_COUNT = int(os.environ.get('SLOW_QUERY_COUNT', 50))  # log requests running more queries than this
+# sampling profiler: on at startup?, seconds between samples, requests slower than this are dumped, where to
+PROFILER = os.environ.get('PROFILER', '0') == '1'
+PROFILER_INTERVAL = float(os.environ.get('PROFILER_INTERVAL', 0.005))
+PROFILER_SLOW_MS = float(os.environ.get('PROFILER_SLOW_MS', 500))
+PROFILER_DIR = os.environ.get('PROFILER_DIR', os.path.join(BASE_DIR, 'profiles'))
+
+# Idempotency keys on booking writes: how long a key's result is replayed, and how many results
+# each process keeps in memory in front of the idempotency_keys table
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 3600))
+IDEMPOTENCY_CACHE_SIZE = int(os.environ.get('IDEMPOTENCY_CACHE_SIZE', 10000))
+
+# Schema migrations (migrations.py): apply pending ones when the app starts instead of refusing to run
+MIGRATE_ON_START = os.environ.get('MIGRATE_ON_START', '0') == '1'
+
+# Booking mode for holds made on /book/<id>: "direct" runs each in its own transaction, "queue"
+# hands them to the group-commit writer (group_commit.py), which commits up to GROUP_COMMIT_BATCH
+# per transaction and waits up to GROUP_COMMIT_WAIT_MS to fill one. Past GROUP_COMMIT_QUEUE waiting
+# requests, or GROUP_COMMIT_TIMEOUT seconds without a commit, callers get "busy"; a seat counter
+# younger than GROUP_COMMIT_REFRESH_MS turns requests for seats it does not have away up front.
+BOOKING_MODE = os.environ.get('BOOKING_MODE', 'direct')
+GROUP_COMMIT_BATCH = int(os.environ.get('GROUP_COMMIT_BATCH', 256))
+GROUP_COMMIT_WAIT_MS = float(os.environ.get('GROUP_COMMIT_WAIT_MS', 2))
+GROUP_COMMIT_QUEUE = int(os.environ.get('GROUP_COMMIT_QUEUE', 10000))
+GROUP_COMMIT_TIMEOUT = float(os.environ.get('GROUP_COMMIT_TIMEOUT', 10))
+GROUP_COMMIT_REFRESH_MS = float(os.environ.get('GROUP_COMMIT_REFRESH_MS', 1000))
+
+# Live seat availability (events.py): updates per bus are coalesced over this many ms; a
+# subscriber further behind than EVENTS_QUEUE updates is told to reload; SSE keepalive seconds.
+# EVENTS_URL: the web app's /events/availability, followed by the desktop client when set.
+EVENTS_COALESCE_MS = int(os.environ.get('EVENTS_COALESCE_MS', 100))
+EVENTS_QUEUE = int(os.environ.get('EVENTS_QUEUE', 100))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+EVENTS_URL = os.environ.get('EVENTS_URL', '')
+
+# Partner JSON API (api_async.py). API_KEYS="key1:user_id,key2:user_id"; bookings are made as that user.
+API_KEYS = dict(
+    (k.strip(), int(v)) for k, v in
+    (pair.split(':', 1) for pair in os.environ.get('API_KEYS', '').split(',') if ':' in pair)
+)
+API_SEARCH_LIMIT = int(os.environ.get('API_SEARCH_LIMIT', 100))
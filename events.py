@@ -0,0 +1,195 @@
+import json
+import queue
+import threading
+import time
+import urllib.request
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+from models import engine, Bus, Trip
+import config
+
+# Live seat availability. Every change to a bus's or trip's seats marks it
+# dirty: reservations.reserve_seats/release_seats note it on the session and
+# it is published when that transaction commits (nothing for a rollback);
+# bus edits and CSV imports publish directly. Every EVENTS_COALESCE_MS a
+# flusher thread reads the current counts of everything marked since the
+# last flush, in one query, and hands that single update to each
+# subscriber, so a burst of sales on one bus costs one message per tick.
+#
+# The web app streams updates to browsers as Server-Sent Events; the
+# desktop client subscribes in-process and, with EVENTS_URL set, also
+# follows the web app's stream to see sales made there. The feed is per
+# process: changes made by another process are only seen through such a
+# stream.
+#
+# An update is {"buses": {id: [available, total]}, "trips": {id: [available, total]}}.
+# A subscriber that falls EVENTS_QUEUE updates behind gets RESYNC instead and
+# should reload.
+
+RESYNC = object()
+_PENDING = 'events_pending'  # session.info key: {(bus_id, trip_id)}
+QUERY_CHUNK = 500
+
+class Subscription:
+    def __init__(self, maxsize):
+        self._queue = queue.Queue(maxsize)
+        self._overflowed = False
+
+    def put(self, update):
+        if self._overflowed:
+            return
+        try:
+            self._queue.put_nowait(update)
+        except queue.Full:
+            # drop what is queued, the reader has to reload anyway
+            self._overflowed = True
+            try:
+                while True:
+                    self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            self._queue.put_nowait(RESYNC)
+
+    def get(self, timeout=None):
+        # next update, RESYNC, or None after timeout seconds without one
+        try:
+            update = self._queue.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if update is RESYNC:
+            self._overflowed = False
+        return update
+
+class AvailabilityFeed:
+    def __init__(self, interval):
+        self.interval = interval
+        self._dirty_buses = set()
+        self._dirty_trips = set()
+        self._subscribers = set()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, maxsize=None):
+        sub = Subscription(maxsize or config.EVENTS_QUEUE)
+        with self._lock:
+            self._subscribers.add(sub)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name='events', daemon=True)
+                self._thread.start()
+        return sub
+
+    def unsubscribe(self, sub):
+        with self._lock:
+            self._subscribers.discard(sub)
+
+    def publish(self, bus_ids=(), trip_ids=()):
+        # nobody listening, nothing to remember
+        if not self._subscribers:
+            return
+        with self._lock:
+            self._dirty_buses.update(bus_ids)
+            self._dirty_trips.update(trip_ids)
+
+    def deliver(self, update):
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for sub in subscribers:
+            sub.put(update)
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                if not self._subscribers:
+                    # last one left; the next subscribe starts a new thread
+                    self._thread = None
+                    self._dirty_buses, self._dirty_trips = set(), set()
+                    return
+                buses, self._dirty_buses = self._dirty_buses, set()
+                trips, self._dirty_trips = self._dirty_trips, set()
+            if not buses and not trips:
+                continue
+            try:
+                update = self._read(buses, trips)
+            except Exception:
+                # database hiccup: try these again next tick
+                with self._lock:
+                    self._dirty_buses |= buses
+                    self._dirty_trips |= trips
+                continue
+            self.deliver(update)
+
+    def _read(self, buses, trips):
+        update = {'buses': {}, 'trips': {}}
+        with engine.connect() as conn:
+            for model, ids, out in ((Bus, sorted(buses), update['buses']), (Trip, sorted(trips), update['trips'])):
+                for i in range(0, len(ids), QUERY_CHUNK):
+                    for row in conn.execute(select(model.id, model.available_seats, model.total_seats)
+                                            .where(model.id.in_(ids[i:i + QUERY_CHUNK]))):
+                        out[row.id] = [row.available_seats, row.total_seats]
+        return update
+
+feed = AvailabilityFeed(config.EVENTS_COALESCE_MS / 1000)
+
+def publish(bus_ids=(), trip_ids=()):
+    feed.publish(bus_ids, trip_ids)
+
+def touch(session, bus_id, trip_id=None):
+    # the seats of this bus (or trip) change in session's transaction
+    session.info.setdefault(_PENDING, set()).add((bus_id, trip_id))
+
+@event.listens_for(Session, 'after_commit')
+def _committed(session):
+    pending = session.info.pop(_PENDING, None)
+    if pending:
+        feed.publish({b for b, t in pending if t is None}, {t for b, t in pending if t is not None})
+
+@event.listens_for(Session, 'after_rollback')
+def _rolled_back(session):
+    session.info.pop(_PENDING, None)
+
+def sse_stream(sub, heartbeat=None):
+    # Server-Sent Events text for a subscription, with a comment line every
+    # heartbeat seconds so proxies keep the connection open
+    heartbeat = config.EVENTS_HEARTBEAT if heartbeat is None else heartbeat
+    yield 'retry: 3000\n\n'
+    while True:
+        update = sub.get(timeout=heartbeat)
+        if update is None:
+            yield ': keepalive\n\n'
+        elif update is RESYNC:
+            yield 'event: resync\ndata: {}\n\n'
+        else:
+            yield f'data: {json.dumps(update, separators=(",", ":"))}\n\n'
+
+def _parse(data):
+    update = json.loads(data)
+    return {kind: {int(k): v for k, v in update.get(kind, {}).items()} for kind in ('buses', 'trips')}
+
+def follow(url, retry=5.0):
+    # Relay another process's SSE stream (e.g. the web app's) into this
+    # process's feed, reconnecting after retry seconds; runs in a daemon thread.
+    def run():
+        while True:
+            try:
+                with urllib.request.urlopen(url, timeout=config.EVENTS_HEARTBEAT * 2) as stream:
+                    kind, data = 'message', []
+                    for raw in stream:
+                        line = raw.decode('utf-8').rstrip('\r\n')
+                        if line.startswith('event:'):
+                            kind = line[6:].strip()
+                        elif line.startswith('data:'):
+                            data.append(line[5:].strip())
+                        elif not line:
+                            if kind == 'resync':
+                                feed.deliver(RESYNC)
+                            elif data:
+                                feed.deliver(_parse('\n'.join(data)))
+                            kind, data = 'message', []
+            except Exception:
+                pass
+            feed.deliver(RESYNC)  # anything may have changed while disconnected
+            time.sleep(retry)
+    thread = threading.Thread(target=run, name='events-follow', daemon=True)
+    thread.start()
+    return thread
@@ -0,0 +1,217 @@
+import queue
+import random
+import threading
+import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from sqlalchemy import select
+from sqlalchemy.exc import OperationalError
+from models import SessionLocal, Bus, Trip
+import reservations
+import config
+
+# Write-behind booking queue (BOOKING_MODE=queue). During a flash sale every
+# /book/<id> would otherwise run its own transaction and fight for the one
+# SQLite write lock. Instead requests go onto an in-process queue and wait
+# on a future; a single writer thread takes whatever is queued (up to
+# GROUP_COMMIT_BATCH), runs each request's transaction body in a SAVEPOINT
+# of one shared transaction and commits once, so a batch of N holds costs
+# one commit (one fsync) instead of N. A request that fails (seats gone,
+# hold conflict) only rolls back its savepoint; its future gets the error.
+#
+# Seat checks happen before the queue, against an in-memory counter per bus
+# (or trip): available seats as of the writer's last commit, less what is
+# queued since. A request the counter cannot satisfy is turned away at once
+# with Rejected instead of joining the queue, which is what keeps a sold-out
+# bus cheap. The counter only turns requests away while it is younger than
+# GROUP_COMMIT_REFRESH_MS, so seats given back by other processes or by
+# releases are picked up; the conditional UPDATE in reserve_seats still
+# decides every request that reaches the database.
+
+class Busy(Exception):
+    # the queue is full, or the batch did not commit within GROUP_COMMIT_TIMEOUT
+    pass
+
+class Rejected(reservations.SeatsUnavailable):
+    # turned away by the seat counter without reaching the database
+    pass
+
+class _Request:
+    __slots__ = ('target', 'seats', 'body', 'future')
+
+    def __init__(self, target, seats, body):
+        self.target = target
+        self.seats = seats
+        self.body = body
+        self.future = Future()
+
+class GroupCommitWriter:
+    def __init__(self, max_batch, wait, max_queue, refresh):
+        self.max_batch = max_batch
+        self.wait = wait
+        self.refresh = refresh
+        self._queue = queue.Queue(max_queue)
+        self._counters = {}  # (bus_id, trip_id) -> [available, refreshed at (monotonic)]
+        self._queued = {}    # (bus_id, trip_id) -> seats waiting in the queue
+        self._lock = threading.Lock()
+        self._thread = None
+        self.batches = 0
+        self.committed = 0
+        self.rejected = 0
+        self.largest_batch = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def submit(self, bus_id, trip_id, seats, body):
+        # Queue body(session) to run in the next batch; returns its Future.
+        # Raises Rejected when the counter says the seats are gone, Busy when
+        # the queue is full.
+        target = (bus_id, trip_id)
+        request = _Request(target, seats, body)
+        with self._lock:
+            counter = self._counters.get(target)
+            if counter is not None:
+                if counter[0] < seats and time.monotonic() - counter[1] < self.refresh:
+                    self.rejected += 1
+                    raise Rejected()
+                counter[0] -= seats
+            try:
+                self._queue.put_nowait(request)
+            except queue.Full:
+                if counter is not None:
+                    counter[0] += seats
+                raise Busy()
+            self._queued[target] = self._queued.get(target, 0) + seats
+        self.start()
+        return request.future
+
+    def run(self, bus_id, trip_id, seats, body, timeout=None):
+        # submit and wait; the body's result, or its exception re-raised here
+        future = self.submit(bus_id, trip_id, seats, body)
+        try:
+            return future.result(config.GROUP_COMMIT_TIMEOUT if timeout is None else timeout)
+        except FutureTimeout:
+            # it may still commit; an idempotency key makes the retry safe
+            raise Busy()
+
+    def queued(self):
+        return self._queue.qsize()
+
+    def snapshot(self):
+        with self._lock:
+            return {'batches': self.batches, 'committed': self.committed, 'rejected': self.rejected,
+                    'largest_batch': self.largest_batch}
+
+    def _next_batch(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.wait
+        while len(batch) < self.max_batch:
+            try:
+                remaining = deadline - time.monotonic()
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                outcomes = self._commit(batch)
+            except Exception as exc:
+                outcomes = [(False, exc)] * len(batch)
+            try:
+                self._refresh(batch)
+            except Exception:
+                # no fresh counts: forget the counters, the next batch reloads them
+                with self._lock:
+                    for request in batch:
+                        self._counters.pop(request.target, None)
+                        self._unqueue(request)
+            for request, (ok, value) in zip(batch, outcomes):
+                if ok:
+                    request.future.set_result(value)
+                else:
+                    request.future.set_exception(value)
+
+    def _commit(self, batch):
+        # one transaction for the whole batch, retried like run_in_transaction
+        # when the database is locked or a deadlock kills it
+        attempt = 0
+        while True:
+            session = SessionLocal()
+            try:
+                reservations.begin_write(session)
+                outcomes = [self._apply(session, request) for request in batch]
+                session.commit()
+                with self._lock:
+                    self.batches += 1
+                    self.committed += sum(1 for ok, _ in outcomes if ok)
+                    self.largest_batch = max(self.largest_batch, len(batch))
+                return outcomes
+            except OperationalError:
+                session.rollback()
+                attempt += 1
+                if attempt > config.BOOKING_MAX_RETRIES:
+                    raise
+                time.sleep(random.uniform(0, 0.01 * (2 ** attempt)))
+            except Exception:
+                session.rollback()
+                raise
+            finally:
+                session.close()
+
+    def _apply(self, session, request):
+        # (True, result) or (False, exception) for one request, in its own savepoint
+        for _ in range(config.BOOKING_MAX_RETRIES + 1):
+            try:
+                with session.begin_nested():
+                    return True, request.body(session)
+            except reservations.Conflict:
+                continue  # e.g. a duplicate idempotency key earlier in this batch; now it replays
+            except OperationalError:
+                raise
+            except Exception as exc:
+                return False, exc
+        return False, reservations.Conflict()
+
+    def _refresh(self, batch):
+        # counters := committed available seats - what has been queued since
+        targets = {request.target for request in batch}
+        counts = {}
+        with SessionLocal() as session:
+            for model, ids, trip in ((Bus, [b for b, t in targets if t is None], False),
+                                     (Trip, [t for b, t in targets if t is not None], True)):
+                if ids:
+                    for row in session.execute(select(model.id, model.available_seats).where(model.id.in_(ids))):
+                        counts[row.id, trip] = row.available_seats
+        now = time.monotonic()
+        with self._lock:
+            for request in batch:
+                self._unqueue(request)
+            for bus_id, trip_id in targets:
+                available = counts.get((bus_id, False) if trip_id is None else (trip_id, True))
+                if available is None:
+                    self._counters.pop((bus_id, trip_id), None)
+                else:
+                    self._counters[bus_id, trip_id] = [available - self._queued.get((bus_id, trip_id), 0), now]
+
+    def _unqueue(self, request):
+        left = self._queued.get(request.target, 0) - request.seats
+        if left > 0:
+            self._queued[request.target] = left
+        else:
+            self._queued.pop(request.target, None)
+
+writer = GroupCommitWriter(config.GROUP_COMMIT_BATCH, config.GROUP_COMMIT_WAIT_MS / 1000,
+                           config.GROUP_COMMIT_QUEUE, config.GROUP_COMMIT_REFRESH_MS / 1000)
+
+def enabled():
+    return config.BOOKING_MODE == 'queue'
+
+def run(bus_id, trip_id, seats, body, timeout=None):
+    return writer.run(bus_id, trip_id, seats, body, timeout)
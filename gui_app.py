@@ -1,22 +1,207 @@
+import queue
+import threading
 import tkinter as tk
 from tkinter import ttk, messagebox, simpledialog, filedialog
-from models import SessionLocal, Bus, Booking, User, init_db
-from werkzeug.security import check_password_hash
-from utils import export_bookings_csv
-import os
+from models import SessionLocal, Bus
+import auth
+from utils import write_bookings_csv
+import reservations
+import queries
+import events
+import config
+import migrations
 
-init_db()
+migrations.check()
+
+# Database work never runs on the Tk thread: it goes to a Worker thread,
+# each task with a session of its own that is closed when the task ends, and
+# the result comes back through a queue the Tk thread polls with after().
+# Lists show one page at a time and are refreshed by diffing the new rows
+# against what is on screen, so a refresh touches only the rows that changed.
+# Seat counts follow events.feed (and the web app's feed with EVENTS_URL set).
+
+POLL_MS = 50
+PAGE_SIZE = 200
+
+class Worker:
+    def __init__(self, root):
+        self.root = root
+        self._tasks = queue.Queue()
+        self._results = queue.Queue()
+        threading.Thread(target=self._run, name='gui-worker', daemon=True).start()
+        self.root.after(POLL_MS, self._poll)
+
+    def submit(self, fn, *args, done=None, failed=None):
+        # fn(session, *args) runs on the worker; done(result) / failed(exc) on the Tk thread
+        self._tasks.put((fn, args, done, failed))
+
+    def _run(self):
+        while True:
+            fn, args, done, failed = self._tasks.get()
+            session = SessionLocal()
+            try:
+                result, exc = fn(session, *args), None
+            except Exception as e:
+                session.rollback()
+                result, exc = None, e
+            finally:
+                session.close()
+            self._results.put((done, failed, result, exc))
+
+    def _poll(self):
+        try:
+            while True:
+                done, failed, result, exc = self._results.get_nowait()
+                if exc is not None:
+                    if failed:
+                        failed(exc)
+                    else:
+                        messagebox.showerror("Error", str(exc) or exc.__class__.__name__)
+                elif done:
+                    done(result)
+        except queue.Empty:
+            pass
+        self.root.after(POLL_MS, self._poll)
+
+class PagedTree:
+    # A Treeview showing PAGE_SIZE of the rows handed to set_rows. Rows are
+    # (iid, values); the page is brought in line with a diff (delete, update,
+    # insert, move only where needed) and the selection survives refreshes.
+    def __init__(self, parent, columns, headings, width=120):
+        self.frame = ttk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show='headings')
+        for c, h in zip(columns, headings):
+            self.tree.heading(c, text=h)
+            self.tree.column(c, width=width)
+        self.tree.pack(fill='both', expand=True)
+        nav = ttk.Frame(self.frame); nav.pack(fill='x')
+        ttk.Button(nav, text="< Prev", command=lambda: self.show(self.page - 1)).pack(side='left')
+        self.label = ttk.Label(nav); self.label.pack(side='left', padx=10)
+        ttk.Button(nav, text="Next >", command=lambda: self.show(self.page + 1)).pack(side='left')
+        self.rows = []
+        self.positions = {}  # iid -> index in rows
+        self.page = 0
+
+    def pack(self, **kw):
+        self.frame.pack(**kw)
+
+    def set_rows(self, rows):
+        self.rows = rows
+        self.positions = {iid: i for i, (iid, _) in enumerate(rows)}
+        self.show(self.page)
+
+    def update_row(self, iid, values):
+        i = self.positions.get(iid)
+        if i is None:
+            return
+        self.rows[i] = (iid, values)
+        if self.tree.exists(iid):
+            self.tree.item(iid, values=tuple(str(v) for v in values))
+
+    def show(self, page):
+        pages = max(1, -(-len(self.rows) // PAGE_SIZE))
+        self.page = min(max(page, 0), pages - 1)
+        wanted = self.rows[self.page * PAGE_SIZE:(self.page + 1) * PAGE_SIZE]
+        tree = self.tree
+        keep = {iid for iid, _ in wanted}
+        stale = [iid for iid in tree.get_children() if iid not in keep]
+        if stale:
+            tree.delete(*stale)
+        for index, (iid, values) in enumerate(wanted):
+            values = tuple(str(v) for v in values)
+            if tree.exists(iid):
+                if tuple(tree.item(iid, 'values')) != values:
+                    tree.item(iid, values=values)
+                if tree.index(iid) != index:
+                    tree.move(iid, '', index)
+            else:
+                tree.insert('', index, iid=iid, values=values)
+        self.label.config(text=f"Page {self.page + 1} of {pages} ({len(self.rows)} rows)")
+
+    def selected(self):
+        sel = self.tree.selection()
+        return int(sel[0]) if sel else None
+
+# ----------------------------------------------------
+# DATABASE TASKS (run on the worker thread; those taking a session get the task's own)
+# ----------------------------------------------------
+def _bus_rows(session):
+    return queries.list_buses(session)
+
+def _booking_rows(session, user_id):
+    return queries.user_bookings(session, user_id)
+
+def _add_bus(session, name, route, total, fare):
+    session.add(Bus(name=name, route=route, total_seats=total, available_seats=total, fare=fare))
+    session.commit()
+
+def _import_buses(path, upsert):
+    from utils import import_buses_csv
+    with open(path, 'rb') as f:
+        return import_buses_csv(f, upsert=upsert)
 
 class GUIApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Bus Reservation Pro - Desktop")
-        self.session = SessionLocal()
+        self.worker = Worker(root)
         self.current_user = None
+        self.status = None
+        # the screen showing seat counts sets these: on_seats(update), on_resync()
+        self.on_seats = self.on_resync = None
+        self.seats = events.feed.subscribe()
+        if config.EVENTS_URL:
+            events.follow(config.EVENTS_URL)
+        self.root.after(POLL_MS, self.poll_seats)
         self.build_login()
 
-    def build_login(self):
+    def poll_seats(self):
+        while True:
+            update = self.seats.get(timeout=0)
+            if update is None:
+                break
+            if update is events.RESYNC:
+                if self.on_resync: self.on_resync()
+            elif self.on_seats:
+                self.on_seats(update)
+        self.root.after(POLL_MS, self.poll_seats)
+
+    def follow_buses(self, buses, table, values, reload):
+        # keep a bus table's seat column current: buses is the id -> BusRow cache behind it
+        def apply(update):
+            for bus_id, (available, total) in update['buses'].items():
+                bus = buses.get(bus_id)
+                if bus is not None:
+                    buses[bus_id] = bus = bus._replace(available_seats=available, total_seats=total)
+                    table.update_row(str(bus_id), values(bus))
+        self.on_seats, self.on_resync = apply, reload
+
+    def run(self, fn, *args, done=None, busy="Working..."):
+        # fn(*args) on the worker without a session (reservations/auth manage their own)
+        self.set_status(busy)
+
+        def finished(result):
+            self.set_status('')
+            if done:
+                done(result)
+
+        def failed(exc):
+            self.set_status('')
+            messagebox.showerror("Error", str(exc) or exc.__class__.__name__)
+        self.worker.submit(lambda session: fn(*args), done=finished, failed=failed)
+
+    def set_status(self, text):
+        if self.status is not None and self.status.winfo_exists():
+            self.status.config(text=text)
+
+    def clear(self):
+        self.on_seats = self.on_resync = None
         for w in self.root.winfo_children(): w.destroy()
+        self.status = ttk.Label(self.root, anchor='w')
+        self.status.pack(side='bottom', fill='x')
+
+    def build_login(self):
+        self.clear()
         frame = ttk.Frame(self.root, padding=20)
         frame.pack(fill='both', expand=True)
         ttk.Label(frame, text="Username:").grid(row=0, column=0, sticky='w')
@@ -24,9 +209,8 @@ class GUIApp:
         ttk.Label(frame, text="Password:").grid(row=1, column=0, sticky='w')
         password = ttk.Entry(frame, show='*'); password.grid(row=1, column=1)
 
-        def do_login():
-            u = self.session.query(User).filter_by(username=username.get()).first()
-            if u and check_password_hash(u.password, password.get()):
+        def logged_in(u):
+            if u:
                 self.current_user = u
                 messagebox.showinfo("Welcome", f"Logged in as {u.username}")
                 if u.is_admin:
@@ -35,72 +219,113 @@ class GUIApp:
                     self.build_user()
             else:
                 messagebox.showerror("Error","Invalid credentials")
+
+        def login_failed(exc):
+            self.set_status('')
+            if isinstance(exc, auth.Throttled):
+                messagebox.showerror("Error", "Too many login attempts, please wait a moment")
+            elif isinstance(exc, auth.Busy):
+                messagebox.showerror("Error", "Server busy, please try again")
+            else:
+                messagebox.showerror("Error", str(exc))
+
+        def do_login():
+            # password hashing takes a noticeable moment: keep it off the Tk thread
+            self.set_status("Checking password...")
+            self.worker.submit(auth.authenticate, username.get(), password.get(),
+                               done=lambda u: (self.set_status(''), logged_in(u)), failed=login_failed)
         ttk.Button(frame, text="Login", command=do_login).grid(row=2, column=0, columnspan=2, pady=10)
         ttk.Button(frame, text="Quit", command=self.root.quit).grid(row=3, column=0, columnspan=2)
 
     def build_user(self):
-        for w in self.root.winfo_children(): w.destroy()
+        self.clear()
         top = ttk.Frame(self.root, padding=10); top.pack(fill='x')
         ttk.Label(top, text=f"User: {self.current_user.username}").pack(side='left')
         ttk.Button(top, text="Logout", command=self.logout).pack(side='right')
         ttk.Button(top, text="My Bookings", command=self.show_my_bookings).pack(side='right', padx=5)
 
-        tree = ttk.Treeview(self.root, columns=('route','avail','fare','time'), show='headings')
-        for c,h in [('route','Route'),('avail','Seats'),('fare','Fare'),('time','Depart')]:
-            tree.heading(c, text=h)
-            tree.column(c, width=120)
-        tree.pack(fill='both', expand=True)
+        table = PagedTree(self.root, ('route','avail','fare','time'), ('Route','Seats','Fare','Depart'))
+        table.pack(fill='both', expand=True)
+        buses = {}
+
+        def values(b):
+            return (b.route, f"{b.available_seats}/{b.total_seats}", b.fare, b.depart_time or '')
+
+        def show(rows):
+            buses.clear(); buses.update((b.id, b) for b in rows)
+            table.set_rows([(str(b.id), values(b)) for b in rows])
 
         def load_buses():
-            for i in tree.get_children(): tree.delete(i)
-            buses = self.session.query(Bus).all()
-            for b in buses:
-                tree.insert('', 'end', iid=b.id, values=(b.route, f"{b.available_seats}/{b.total_seats}", b.fare, b.depart_time or ''))
+            self.worker.submit(_bus_rows, done=show)
         load_buses()
+        self.follow_buses(buses, table, values, load_buses)
 
         def do_book():
-            sel = tree.selection()
-            if not sel: messagebox.showwarning("Select", "Select a bus"); return
-            bus_id = int(sel[0]); bus = self.session.query(Bus).get(bus_id)
+            bus_id = table.selected()
+            if bus_id is None: messagebox.showwarning("Select", "Select a bus"); return
+            bus = buses[bus_id]
             q = simpledialog.askinteger("Seats", f"How many seats? (Available {bus.available_seats})", minvalue=1, maxvalue=bus.available_seats)
             if not q: return
             name = simpledialog.askstring("Passenger name", "Passenger name", initialvalue=self.current_user.username)
             phone = simpledialog.askstring("Phone", "Passenger phone")
-            booking = Booking(user=self.current_user, bus=bus, seats=q, passenger_name=name, passenger_phone=phone)
-            bus.available_seats -= q
-            self.session.add(booking); self.session.commit()
-            messagebox.showinfo("Booked", "Booking successful")
-            load_buses()
+
+            def booked(booking_id):
+                if booking_id is None:
+                    messagebox.showerror("Error", "Not enough seats available")
+                else:
+                    messagebox.showinfo("Booked", "Booking successful")
+                load_buses()
+            self.run(reservations.book_seats, bus_id, self.current_user.id, q, name, phone, done=booked, busy="Booking...")
         ttk.Button(self.root, text="Book Selected Bus", command=do_book).pack(pady=5)
 
     def show_my_bookings(self):
         top = tk.Toplevel(self.root); top.title("My bookings")
-        tree = ttk.Treeview(top, columns=('bus','seats','passenger','when'), show='headings')
-        for c in ['bus','seats','passenger','when']:
-            tree.heading(c, text=c.title())
-        tree.pack(fill='both', expand=True)
-        bookings = self.session.query(Booking).filter_by(user_id=self.current_user.id).all()
-        for b in bookings:
-            tree.insert('', 'end', values=(b.bus.name if b.bus else '', b.seats, b.passenger_name, b.booked_at))
+        table = PagedTree(top, ('bus','seats','passenger','when','status'), ('Bus','Seats','Passenger','When','Status'))
+        table.pack(fill='both', expand=True)
+
+        def load():
+            self.worker.submit(_booking_rows, self.current_user.id, done=lambda rows: top.winfo_exists() and table.set_rows(
+                [(str(b.id), (b.bus_name or '', b.seats, b.passenger_name, b.booked_at, b.status)) for b in rows]))
+        load()
+
+        def cancel_selected():
+            booking_id = table.selected()
+            if booking_id is None: messagebox.showwarning("Select", "Select a booking", parent=top); return
+            if not messagebox.askyesno("Confirm", "Cancel selected booking?", parent=top): return
+
+            def cancelled(refund):
+                if refund is None:
+                    messagebox.showerror("Error", "Booking is already cancelled", parent=top)
+                else:
+                    messagebox.showinfo("Cancelled", f"Booking cancelled, {refund} refunded", parent=top)
+                load()
+            self.run(reservations.cancel_booking, booking_id, self.current_user.id, done=cancelled, busy="Cancelling...")
+        ttk.Button(top, text="Cancel Selected Booking", command=cancel_selected).pack(pady=5)
 
     def build_admin(self):
-        for w in self.root.winfo_children(): w.destroy()
+        self.clear()
         top = ttk.Frame(self.root, padding=10); top.pack(fill='x')
         ttk.Label(top, text=f"Admin: {self.current_user.username}").pack(side='left')
         ttk.Button(top, text="Logout", command=self.logout).pack(side='right')
         ttk.Button(top, text="Export Bookings CSV", command=self.export_bookings).pack(side='right', padx=5)
-        ttk.Button(top, text="Import Buses CSV", command=self.import_buses).pack(side='right', padx=5)
+        ttk.Button(top, text="Import Buses CSV", command=lambda: self.import_buses(load)).pack(side='right', padx=5)
 
         columns = ('name','route','seats','fare','time')
-        tree = ttk.Treeview(self.root, columns=columns, show='headings')
-        for c in columns: tree.heading(c, text=c.title())
-        tree.pack(fill='both', expand=True)
+        table = PagedTree(self.root, columns, [c.title() for c in columns])
+        table.pack(fill='both', expand=True)
+        buses = {}
+
+        def values(b):
+            return (b.name, b.route, f"{b.available_seats}/{b.total_seats}", b.fare, b.depart_time or '')
+
+        def show(rows):
+            buses.clear(); buses.update((b.id, b) for b in rows)
+            table.set_rows([(str(b.id), values(b)) for b in rows])
 
         def load():
-            for i in tree.get_children(): tree.delete(i)
-            for b in self.session.query(Bus).all():
-                tree.insert('', 'end', iid=b.id, values=(b.name,b.route,f"{b.available_seats}/{b.total_seats}", b.fare, b.depart_time or ''))
+            self.worker.submit(_bus_rows, done=show)
         load()
+        self.follow_buses(buses, table, values, load)
 
         def add_bus():
             name = simpledialog.askstring("Name","Bus name")
@@ -108,51 +333,63 @@ class GUIApp:
             route = simpledialog.askstring("Route","Route")
             total = simpledialog.askinteger("Seats","Total seats", initialvalue=40, minvalue=1)
             fare = simpledialog.askinteger("Fare","Fare", initialvalue=0)
-            b = Bus(name=name, route=route, total_seats=total, available_seats=total, fare=fare)
-            self.session.add(b); self.session.commit(); load()
+            self.worker.submit(_add_bus, name, route, total, fare, done=lambda _: load())
         ttk.Button(self.root, text="Add Bus", command=add_bus).pack(pady=5)
 
         def delete_selected():
-            sel = tree.selection()
-            if not sel: messagebox.showwarning("Select","Select a bus"); return
-            if not messagebox.askyesno("Confirm","Delete selected?"): return
-            bus = self.session.query(Bus).get(int(sel[0])); self.session.delete(bus); self.session.commit(); load()
+            bus_id = table.selected()
+            if bus_id is None: messagebox.showwarning("Select","Select a bus"); return
+            if not messagebox.askyesno("Confirm","Delete selected? Its bookings are cancelled and refunded."): return
+
+            def deleted(result):
+                if result: messagebox.showinfo("Deleted", f"{result[0]} bookings cancelled, {result[1]} refunded")
+                load()
+            self.run(reservations.delete_bus, bus_id, done=deleted, busy="Deleting...")
         ttk.Button(self.root, text="Delete Selected Bus", command=delete_selected).pack()
 
+        def cancel_bookings_selected():
+            bus_id = table.selected()
+            if bus_id is None: messagebox.showwarning("Select","Select a bus"); return
+            if not messagebox.askyesno("Confirm","Cancel every booking on the selected bus?"): return
+
+            def cancelled(result):
+                messagebox.showinfo("Cancelled", f"{result[0]} bookings cancelled, {result[1]} refunded")
+                load()
+            self.run(lambda: reservations.cancel_bookings(bus_id=bus_id), done=cancelled, busy="Cancelling...")
+        ttk.Button(self.root, text="Cancel Bookings on Selected Bus", command=cancel_bookings_selected).pack()
+
         def edit_selected():
-            sel = tree.selection()
-            if not sel: messagebox.showwarning("Select","Select a bus"); return
-            bus = self.session.query(Bus).get(int(sel[0]))
+            bus_id = table.selected()
+            if bus_id is None: messagebox.showwarning("Select","Select a bus"); return
+            bus = buses[bus_id]
             name = simpledialog.askstring("Name","Bus name", initialvalue=bus.name)
             route = simpledialog.askstring("Route","Route", initialvalue=bus.route)
             total = simpledialog.askinteger("Seats","Total seats", initialvalue=bus.total_seats)
             fare = simpledialog.askinteger("Fare","Fare", initialvalue=bus.fare)
-            if name: bus.name=name; bus.route=route; bus.total_seats=total; bus.fare=fare
-            bus.available_seats = max(0, bus.total_seats - sum([bk.seats for bk in bus.bookings]))
-            self.session.commit(); load()
+            if not name: return
+            self.run(reservations.edit_bus, bus_id, name, route or bus.route, total, fare,
+                     done=lambda _: load(), busy="Saving...")
         ttk.Button(self.root, text="Edit Selected Bus", command=edit_selected).pack()
 
-    def import_buses(self):
+    def import_buses(self, reload):
         path = filedialog.askopenfilename(filetypes=[("CSV","*.csv")])
         if not path: return
-        with open(path, 'rb') as f:
-            from utils import import_buses_csv
-            added = import_buses_csv(f)
-            messagebox.showinfo("Imported", f"Imported {added} buses")
-            self.session.commit()
+        upsert = messagebox.askyesno("Import", "Update existing buses with the same name and departure time?")
+
+        def imported(result):
+            errors = ''.join(f"\nLine {line}: {message}" for line, message in result.errors[:10])
+            messagebox.showinfo("Imported", f"Import finished: {result}{errors}")
+            reload()
+        self.run(_import_buses, path, upsert, done=imported, busy="Importing...")
 
     def export_bookings(self):
-        csv_text = export_bookings_csv()
-        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV","*.csv")])
+        path = filedialog.asksaveasfilename(defaultextension=".csv", filetypes=[("CSV","*.csv"),("Gzipped CSV","*.csv.gz")])
         if not path: return
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(csv_text)
-        messagebox.showinfo("Export", "Bookings exported")
+        self.run(write_bookings_csv, path, path.endswith('.gz'),
+                 done=lambda _: messagebox.showinfo("Export", "Bookings exported"), busy="Exporting...")
 
     def logout(self):
         self.current_user = None
-        self.session.close()
-        self.session = SessionLocal()
         self.build_login()
 
 if __name__ == "__main__":
@@ -0,0 +1,230 @@
+import heapq
+import threading
+import time
+from datetime import datetime
+from sqlalchemy import select, update
+from models import SessionLocal, SeatHold
+import reservations
+import idempotency
+import group_commit
+import catalog
+import config
+
+# Seat holds. A hold takes seats off sale for HOLD_TTL_SECONDS; confirming
+# turns it into a Booking, releasing or expiring puts the seats back.
+# available_seats always counts held seats as taken, so it stays consistent
+# through every transition.
+#
+# Expiry is driven by a min-heap of (expires_at, hold_id): one reaper thread
+# sleeps until the earliest deadline and then releases everything due in one
+# transaction, restoring seats with one UPDATE per bus. Holds made by other
+# processes (other web workers, the JSON API) are picked up by an occasional
+# sweep over the (status, expires_at) index, never by a full table scan.
+
+EXPIRE_BATCH = 1000
+
+class HoldMetrics:
+    def __init__(self):
+        self.created = 0
+        self.confirmed = 0
+        self.released = 0
+        self.expired = 0
+        self._lock = threading.Lock()
+
+    def add(self, name, n=1):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + n)
+
+    def snapshot(self):
+        with self._lock:
+            return {'created': self.created, 'confirmed': self.confirmed,
+                    'released': self.released, 'expired': self.expired}
+
+metrics = HoldMetrics()
+
+def tx_expire(session, hold_ids, now):
+    # Expire the given holds if they are still held and past their deadline.
+    # Returns the number expired.
+    rows = session.execute(
+        select(SeatHold.id, SeatHold.bus_id, SeatHold.trip_id, SeatHold.seats, SeatHold.seat_numbers)
+        .where(SeatHold.id.in_(hold_ids), SeatHold.status == 'held', SeatHold.expires_at <= now)
+        .with_for_update()
+    ).all()
+    if not rows:
+        return 0
+    result = session.execute(
+        update(SeatHold).where(SeatHold.id.in_([r.id for r in rows]), SeatHold.status == 'held')
+        .values(status='expired')
+    )
+    if result.rowcount != len(rows):
+        # a confirm/release got in between our read and write (SQLite has no FOR UPDATE)
+        raise reservations.Conflict()
+    reservations.release_many(session, ((r.bus_id, r.trip_id, r.seats, r.seat_numbers) for r in rows))
+    return len(rows)
+
+class HoldReaper:
+    def __init__(self, sweep_interval):
+        self.sweep_interval = sweep_interval
+        self._heap = []
+        self._live = set()  # confirmed/released holds leave stale heap entries that are skipped
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def start(self):
+        with self._cond:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run, name='hold-reaper', daemon=True)
+        self._thread.start()
+
+    def track(self, hold_id, expires_at):
+        with self._cond:
+            heapq.heappush(self._heap, (expires_at, hold_id))
+            self._live.add(hold_id)
+            if self._heap[0][1] == hold_id:
+                self._cond.notify()
+
+    def forget(self, hold_id):
+        with self._cond:
+            self._live.discard(hold_id)
+
+    def pending(self):
+        return len(self._live)
+
+    def _load_pending(self):
+        session = SessionLocal()
+        try:
+            rows = session.execute(
+                select(SeatHold.expires_at, SeatHold.id).where(SeatHold.status == 'held')
+            ).all()
+        finally:
+            session.close()
+        with self._cond:
+            self._heap.extend(tuple(r) for r in rows)
+            self._live.update(r.id for r in rows)
+            heapq.heapify(self._heap)
+
+    def _due(self):
+        # pop what is due, or wait until the next deadline / sweep
+        with self._cond:
+            now = datetime.utcnow()
+            due = []
+            while self._heap and self._heap[0][0] <= now and len(due) < EXPIRE_BATCH:
+                hold_id = heapq.heappop(self._heap)[1]
+                if hold_id in self._live:
+                    self._live.discard(hold_id)
+                    due.append(hold_id)
+            if not due:
+                timeout = self.sweep_interval
+                if self._heap:
+                    timeout = min(timeout, (self._heap[0][0] - now).total_seconds())
+                self._cond.wait(max(timeout, 0.01))
+            return due
+
+    def _run(self):
+        try:
+            self._load_pending()
+        except Exception:
+            pass  # e.g. tables not created yet; the sweep covers anything held
+        next_sweep = time.monotonic() + self.sweep_interval
+        while True:
+            try:
+                due = self._due()
+                if due:
+                    expire_holds(due)
+                if time.monotonic() >= next_sweep:
+                    next_sweep = time.monotonic() + self.sweep_interval
+                    sweep()
+                    idempotency.purge()
+            except Exception:
+                # keep the reaper alive; the next sweep retries anything missed
+                time.sleep(1)
+
+reaper = HoldReaper(config.HOLD_SWEEP_INTERVAL)
+
+def expire_holds(hold_ids):
+    now = datetime.utcnow()
+    expired = reservations.run_in_transaction(lambda session: tx_expire(session, hold_ids, now))
+    if expired:
+        metrics.add('expired', expired)
+        catalog.invalidate(routes=False)
+    return expired
+
+def sweep():
+    # backstop for holds this process is not tracking; uses the (status, expires_at) index
+    session = SessionLocal()
+    try:
+        ids = session.execute(
+            select(SeatHold.id).where(SeatHold.status == 'held', SeatHold.expires_at <= datetime.utcnow())
+            .limit(EXPIRE_BATCH)
+        ).scalars().all()
+    finally:
+        session.close()
+    return expire_holds(ids) if ids else 0
+
+def start_reaper():
+    reaper.start()
+
+def hold_created(hold_id, expires_at):
+    # bookkeeping for holds made outside these wrappers (the JSON API)
+    metrics.add('created')
+    reaper.track(hold_id, expires_at)
+
+def hold_finished(hold_id, status):
+    metrics.add(status)
+    reaper.forget(hold_id)
+
+def hold_json(hold):
+    hold_id, numbers, expires_at = hold
+    return {'hold_id': hold_id, 'seat_numbers': numbers, 'expires_at': expires_at.isoformat()}
+
+def create_hold(bus_id, user_id, seats, passenger_name, passenger_phone='', seat_numbers=None, ttl=None, retries=None,
+                trip_id=None, idempotency_key=None):
+    # Returns (hold_id, seat numbers, expires_at), or None if the seats are not available.
+    # A repeated idempotency_key returns the hold the first attempt made.
+    if seat_numbers:
+        seats = len(set(seat_numbers))
+    # With BOOKING_MODE=queue the transaction is committed in a batch by the
+    # group-commit writer, which raises group_commit.Busy when overloaded.
+    if seats <= 0:
+        return None
+    transact = None
+    if group_commit.enabled():
+        transact = lambda fn: group_commit.run(bus_id, trip_id, seats, fn)
+    try:
+        result, replayed = idempotency.run(
+            user_id, idempotency_key, 'hold',
+            lambda session: hold_json(reservations.tx_hold(session, bus_id, user_id, seats, passenger_name,
+                                                           passenger_phone, seat_numbers, ttl, trip_id)),
+            retries, transact)
+    except group_commit.Rejected:
+        # turned away before reaching the database, where a retry of this key may already have its hold
+        found = idempotency.stored(user_id, idempotency_key, 'hold') if idempotency_key else None
+        if found is None:
+            return None
+        result, replayed = found
+    except reservations.SeatsUnavailable:
+        return None
+    hold = (result['hold_id'], result['seat_numbers'], datetime.fromisoformat(result['expires_at']))
+    if not replayed:
+        hold_created(hold[0], hold[2])
+        catalog.invalidate(routes=False)
+    return hold
+
+def confirm_hold(hold_id, user_id=None, retries=None, idempotency_key=None):
+    # Returns the booking id, or None if the hold is gone, expired or not the user's.
+    booking_id, replayed = idempotency.run(
+        user_id, idempotency_key, 'confirm', lambda session: reservations.tx_confirm(session, hold_id, user_id),
+        retries)
+    if booking_id is not None and not replayed:
+        hold_finished(hold_id, 'confirmed')
+    return booking_id
+
+def release_hold(hold_id, user_id=None, retries=None):
+    bus_id = reservations.run_in_transaction(
+        lambda session: reservations.tx_release(session, hold_id, user_id), retries)
+    if bus_id is None:
+        return False
+    hold_finished(hold_id, 'released')
+    catalog.invalidate(routes=False)
+    return True
@@ -0,0 +1,140 @@
+import json
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from sqlalchemy import select, delete
+from sqlalchemy.exc import IntegrityError
+from models import SessionLocal, IdempotencyKey
+import reservations
+import config
+
+# Idempotency keys for booking writes. A client (a form's hidden token, or
+# an Idempotency-Key header on the JSON API) sends the same key with every
+# retry of one operation. The first attempt stores its JSON result under
+# (user, key) in the same transaction as the write; a retry within
+# IDEMPOTENCY_TTL gets that stored result back and touches no inventory.
+#
+# Committed results are also kept in a bounded LRU, so a replay hitting the
+# same process needs no query. Two attempts racing each other both try to
+# insert the key; the unique index fails the loser, its transaction (seats
+# included) rolls back, and the retry finds the winner's row.
+
+MAX_KEY_LENGTH = 64
+
+class KeyReused(Exception):
+    # the key was already used for a different operation
+    pass
+
+def valid_key(key):
+    return bool(key) and len(key) <= MAX_KEY_LENGTH and key.isprintable()
+
+class ResultCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()  # (user_id, key) -> (expires_at monotonic, scope, result)
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def get(self, user_id, key):
+        with self._lock:
+            entry = self._entries.get((user_id, key))
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[(user_id, key)]
+                return None
+            self._entries.move_to_end((user_id, key))
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, user_id, key, scope, result, ttl):
+        with self._lock:
+            self._entries[(user_id, key)] = (time.monotonic() + ttl, scope, result)
+            self._entries.move_to_end((user_id, key))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+cache = ResultCache(config.IDEMPOTENCY_CACHE_SIZE)
+
+def _find(session, user_id, key):
+    return session.execute(select(IdempotencyKey.scope, IdempotencyKey.response, IdempotencyKey.expires_at)
+                           .where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key)).first()
+
+def _replay(row, scope, now):
+    # (result, True) for a live stored result, None if there is none
+    if row is None or row.expires_at <= now:
+        return None
+    if row.scope != scope:
+        raise KeyReused()
+    return json.loads(row.response), True
+
+def tx_run(session, user_id, key, scope, body, ttl=None):
+    # Transaction body: the stored result for (user_id, key), or body(session)
+    # run and its result stored. Returns (result, replayed).
+    now = datetime.utcnow()
+    row = _find(session, user_id, key)
+    hit = _replay(row, scope, now)
+    if hit is not None:
+        return hit
+    if row is not None:
+        session.execute(delete(IdempotencyKey).where(IdempotencyKey.user_id == user_id, IdempotencyKey.key == key))
+    result = body(session)
+    session.add(IdempotencyKey(user_id=user_id, key=key, scope=scope, response=json.dumps(result),
+                               expires_at=now + timedelta(seconds=config.IDEMPOTENCY_TTL if ttl is None else ttl)))
+    try:
+        session.flush()
+    except IntegrityError:
+        # another attempt with this key got there first
+        raise reservations.Conflict()
+    return result, False
+
+def stored(user_id, key, scope):
+    # (result, True) if the key already has a live result, else None
+    hit = cached(user_id, key, scope)
+    if hit is not None:
+        return hit
+    session = SessionLocal()
+    try:
+        return _replay(_find(session, user_id, key), scope, datetime.utcnow())
+    finally:
+        session.close()
+
+def cached(user_id, key, scope):
+    # (result, True) from the LRU, or None
+    hit = cache.get(user_id, key)
+    if hit is None:
+        return None
+    if hit[0] != scope:
+        raise KeyReused()
+    return hit[1], True
+
+def remember(user_id, key, scope, result):
+    # after the transaction that stored (or found) the result has committed
+    cache.put(user_id, key, scope, result, config.IDEMPOTENCY_TTL)
+
+def run(user_id, key, scope, body, retries=None, transact=None):
+    # body(session) -> JSON-able result, run at most once per (user_id, key)
+    # within the TTL. Returns (result, replayed). Exceptions from body (e.g.
+    # SeatsUnavailable) store nothing, so the key can be retried. transact(fn)
+    # runs fn in a transaction and commits (default run_in_transaction).
+    transact = transact or (lambda fn: reservations.run_in_transaction(fn, retries))
+    if not key:
+        return transact(body), False
+    hit = cached(user_id, key, scope)
+    if hit is not None:
+        return hit
+    result, replayed = transact(lambda session: tx_run(session, user_id, key, scope, body))
+    remember(user_id, key, scope, result)
+    return result, replayed
+
+def purge():
+    # drop expired keys; called from the hold reaper's periodic sweep
+    session = SessionLocal()
+    try:
+        removed = session.execute(delete(IdempotencyKey).where(IdempotencyKey.expires_at <= datetime.utcnow())
+                                  .execution_options(synchronize_session=False)).rowcount
+        session.commit()
+        return removed
+    finally:
+        session.close()
@@ -1,11 +1,12 @@
-from models import init_db, SessionLocal, User
-from werkzeug.security import generate_password_hash
+from models import SessionLocal, User
+import migrations
+from auth import hash_password
 
 def create_admin():
     session = SessionLocal()
     admin = session.query(User).filter_by(username='admin').first()
     if not admin:
-        a = User(username='admin', password=generate_password_hash('admin123'), is_admin=True)
+        a = User(username='admin', password=hash_password('admin123'), is_admin=True)
         session.add(a)
         session.commit()
         print("Created default admin: username=admin password=admin123")
@@ -14,5 +15,5 @@ def create_admin():
     session.close()
 
 if __name__ == "__main__":
-    init_db()
+    migrations.upgrade()
     create_admin()
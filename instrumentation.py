@@ -0,0 +1,286 @@
+import hmac
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from sqlalchemy import event
+import config
+
+# Opt-in request instrumentation for the Flask app (INSTRUMENTATION=1).
+#
+# - Each request's time is split into SQL (cursor execute events on the
+#   engine), template rendering (Flask's render signals) and password hashing
+#   (auth.run), plus the number of queries it ran. The split goes out in a
+#   Server-Timing header and into per-endpoint metrics at /metrics in the
+#   Prometheus text format; requests running more than SLOW_QUERY_COUNT
+#   queries are logged (an N+1 loop shows up there first).
+# - With the sampling profiler on (PROFILER=1, or POST /admin/profiler) a
+#   background thread samples the stacks of threads serving requests every
+#   PROFILER_INTERVAL seconds; requests slower than PROFILER_SLOW_MS have their
+#   samples written to PROFILER_DIR as folded stacks ("a;b;c 12" lines), the
+#   input format of flamegraph.pl and speedscope.
+#
+# Work done outside a request (hold reaper, CLI) is not attributed to anything.
+
+log = logging.getLogger(__name__)
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500)
+
+class RequestStats:
+    __slots__ = ('started', 'sql_time', 'queries', 'render_time', 'hash_time', 'samples', '_marks')
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sql_time = self.render_time = self.hash_time = 0.0
+        self.queries = 0
+        self.samples = None  # Counter of folded stacks while profiling
+        self._marks = []     # start times of cursor executes / renders in progress
+
+_local = threading.local()
+_active = {}  # thread id -> RequestStats of the request that thread is serving
+
+def current():
+    # the RequestStats of the request running on this thread, or None
+    return getattr(_local, 'stats', None)
+
+def add_hash_time(seconds):
+    stats = current()
+    if stats is not None:
+        stats.hash_time += seconds
+
+# ----------------------------------------------------
+# METRICS
+# ----------------------------------------------------
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+
+class Metrics:
+    # per-endpoint counters and histograms, guarded by one lock
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.requests = Counter()  # (endpoint, method, status) -> count
+        self.duration = {}         # endpoint -> Histogram of seconds
+        self.query_count = {}      # endpoint -> Histogram of queries per request
+        self.sql_seconds = Counter()
+        self.render_seconds = Counter()
+        self.hash_seconds = Counter()
+        self.slow_profiles = 0
+
+    def record(self, endpoint, method, status, elapsed, stats):
+        with self._lock:
+            self.requests[(endpoint, method, str(status))] += 1
+            self.duration.setdefault(endpoint, Histogram(DURATION_BUCKETS)).observe(elapsed)
+            self.query_count.setdefault(endpoint, Histogram(QUERY_BUCKETS)).observe(stats.queries)
+            self.sql_seconds[endpoint] += stats.sql_time
+            self.render_seconds[endpoint] += stats.render_time
+            self.hash_seconds[endpoint] += stats.hash_time
+
+    def render(self, gauges=()):
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        def histogram(name, data):
+            for endpoint, h in sorted(data.items()):
+                running = 0
+                for bound, count in zip(list(h.buckets) + ['+Inf'], h.counts):
+                    running += count
+                    lines.append(f'{name}_bucket{{endpoint="{_label(endpoint)}",le="{bound}"}} {running}')
+                lines.append(f'{name}_sum{{endpoint="{_label(endpoint)}"}} {h.sum:.6f}')
+                lines.append(f'{name}_count{{endpoint="{_label(endpoint)}"}} {running}')
+
+        with self._lock:
+            family('http_requests_total', 'counter', 'Requests by endpoint, method and status.')
+            for (endpoint, method, status), n in sorted(self.requests.items()):
+                lines.append(f'http_requests_total{{endpoint="{_label(endpoint)}",method="{method}",'
+                             f'status="{status}"}} {n}')
+            family('http_request_duration_seconds', 'histogram', 'Wall time per request.')
+            histogram('http_request_duration_seconds', self.duration)
+            family('http_request_queries', 'histogram', 'SQL statements executed per request.')
+            histogram('http_request_queries', self.query_count)
+            for name, data, help_text in (
+                    ('http_request_sql_seconds_total', self.sql_seconds, 'Time spent executing SQL.'),
+                    ('http_request_render_seconds_total', self.render_seconds, 'Time spent rendering templates.'),
+                    ('http_request_hash_seconds_total', self.hash_seconds, 'Time spent waiting on password hashing.')):
+                family(name, 'counter', help_text)
+                for endpoint, seconds in sorted(data.items()):
+                    lines.append(f'{name}{{endpoint="{_label(endpoint)}"}} {seconds:.6f}')
+            family('profiler_slow_requests_total', 'counter', 'Slow requests written out by the profiler.')
+            lines.append(f'profiler_slow_requests_total {self.slow_profiles}')
+        for name, kind, value, help_text in gauges:
+            family(name, kind, help_text)
+            lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+def _label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+metrics = Metrics()
+
+# ----------------------------------------------------
+# SQL AND RENDER HOOKS
+# ----------------------------------------------------
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current()
+    if stats is not None:
+        stats._marks.append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    stats = current()
+    if stats is not None and stats._marks:
+        stats.sql_time += time.perf_counter() - stats._marks.pop()
+        stats.queries += 1
+
+def _before_render(sender, template, context, **extra):
+    stats = current()
+    if stats is not None:
+        stats._marks.append(time.perf_counter())
+
+def _rendered(sender, template, context, **extra):
+    stats = current()
+    if stats is not None and stats._marks:
+        stats.render_time += time.perf_counter() - stats._marks.pop()
+
+def instrument_engine(engine):
+    if not event.contains(engine, 'before_cursor_execute', _before_cursor_execute):
+        event.listen(engine, 'before_cursor_execute', _before_cursor_execute)
+        event.listen(engine, 'after_cursor_execute', _after_cursor_execute)
+
+# ----------------------------------------------------
+# SAMPLING PROFILER
+# ----------------------------------------------------
+def _fold(frame):
+    # "module:function;module:function;..." from the outermost frame in
+    parts = []
+    while frame is not None:
+        code = frame.f_code
+        parts.append(f'{os.path.basename(code.co_filename)}:{code.co_name}')
+        frame = frame.f_back
+    return ';'.join(reversed(parts))
+
+class Profiler:
+    def __init__(self, interval, slow_ms, out_dir):
+        self.interval = interval
+        self.slow = slow_ms / 1000.0
+        self.out_dir = out_dir
+        self.enabled = False
+        self._thread = None
+        self._lock = threading.Lock()
+
+    def set_enabled(self, enabled):
+        with self._lock:
+            self.enabled = enabled
+            if enabled and (self._thread is None or not self._thread.is_alive()):
+                self._thread = threading.Thread(target=self._run, name='profiler', daemon=True)
+                self._thread.start()
+
+    def _run(self):
+        while self.enabled:
+            time.sleep(self.interval)
+            if not _active:
+                continue
+            frames = sys._current_frames()
+            for thread_id, stats in list(_active.items()):
+                frame = frames.get(thread_id)
+                if frame is not None and stats.samples is not None:
+                    stats.samples[_fold(frame)] += 1
+
+    def start_request(self, stats):
+        if self.enabled:
+            stats.samples = Counter()
+
+    def finish_request(self, stats, endpoint, elapsed):
+        # write the request's samples out if it was slow; returns the path or None
+        if not stats.samples or elapsed < self.slow:
+            return None
+        os.makedirs(self.out_dir, exist_ok=True)
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{int(elapsed * 1000)}ms-{endpoint}.folded"
+        path = os.path.join(self.out_dir, name.replace('/', '_'))
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, count in stats.samples.most_common():
+                f.write(f'{stack} {count}\n')
+        with metrics._lock:
+            metrics.slow_profiles += 1
+        return path
+
+profiler = Profiler(config.PROFILER_INTERVAL, config.PROFILER_SLOW_MS, config.PROFILER_DIR)
+
+# ----------------------------------------------------
+# FLASK WIRING
+# ----------------------------------------------------
+def install(app, engine, gauges=None):
+    # Hook the app and engine up and add /metrics and /admin/profiler.
+    # gauges: optional callable returning extra [(name, kind, value, help)] for /metrics.
+    from flask import request, Response, abort, flash, redirect, url_for, before_render_template, template_rendered
+    from flask_login import login_required, current_user
+
+    instrument_engine(engine)
+    before_render_template.connect(_before_render, app)
+    template_rendered.connect(_rendered, app)
+    if config.PROFILER:
+        profiler.set_enabled(True)
+
+    @app.before_request
+    def _start_request():
+        stats = RequestStats()
+        _local.stats = stats
+        profiler.start_request(stats)
+        _active[threading.get_ident()] = stats
+
+    @app.after_request
+    def _finish_request(response):
+        stats = current()
+        if stats is None:
+            return response
+        elapsed = time.perf_counter() - stats.started
+        response.headers['Server-Timing'] = ', '.join([
+            f'db;dur={stats.sql_time * 1000:.1f};desc="{stats.queries} queries"',
+            f'render;dur={stats.render_time * 1000:.1f}',
+            f'hash;dur={stats.hash_time * 1000:.1f}',
+            f'total;dur={elapsed * 1000:.1f}'])
+        endpoint = request.endpoint or 'unmatched'
+        metrics.record(endpoint, request.method, response.status_code, elapsed, stats)
+        if stats.queries > config.SLOW_QUERY_COUNT:
+            log.warning('%s %s ran %d queries (%.1f ms SQL)', request.method, request.path, stats.queries,
+                        stats.sql_time * 1000)
+        path = profiler.finish_request(stats, endpoint, elapsed)
+        if path:
+            log.warning('%s %s took %.0f ms, stacks in %s', request.method, request.path, elapsed * 1000, path)
+        return response
+
+    @app.teardown_request
+    def _end_request(exc=None):
+        _active.pop(threading.get_ident(), None)
+        _local.stats = None
+
+    @app.route('/metrics')
+    def metrics_endpoint():
+        # pool, latency and route figures are not public: no token, no metrics
+        if not config.METRICS_TOKEN or not hmac.compare_digest(request.headers.get('Authorization', ''),
+                                                               f'Bearer {config.METRICS_TOKEN}'):
+            abort(403)
+        return Response(metrics.render(gauges() if gauges else ()), mimetype='text/plain; version=0.0.4')
+
+    @app.route('/admin/profiler', methods=['POST'])
+    @login_required
+    def toggle_profiler():
+        if not current_user.is_admin:
+            abort(403)
+        profiler.set_enabled(request.form.get('enabled') == '1')
+        flash(f"Profiler {'on' if profiler.enabled else 'off'}", 'info')
+        return redirect(url_for('admin_dashboard'))
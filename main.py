@@ -1,96 +1,312 @@
-import sqlite3
+import argparse
+import codecs
 import csv
-import os
+import sqlite3
+import sys
+import time
 from getpass import getpass
-
-DB = "bus_main.db"
+from sqlalchemy import select, insert
+from models import SessionLocal, engine, User, Bus, Booking
+from auth import hash_password, is_hashed
+import auth
+import aggregates
+import catalog
+import migrations
+import queries
+import reservations
+import seatmap
+import reports
+import utils
+
+# Command line front end on the same database and data layer as the web app
+# (config.SQLALCHEMY_DATABASE_URI / DATABASE_URL).
+#
+#   python main.py                                   interactive menu
+#   python main.py add-bus --name N --route R --seats 40 --fare 500
+#   python main.py import buses.csv [--upsert]       ("-" reads stdin)
+#   python main.py export -o bookings.csv [--gzip]   (stdout by default)
+#   python main.py book bookings.csv                 (user,bus_id,seats,passenger_name[,...])
+#   python main.py report --month 2026-10 --format json -o report.json
+#   python main.py migrate-legacy --db bus_main.db   (data from the old CLI-only database)
+#
+# Batch commands print how many rows they handled, the elapsed time and rows/s.
+
+BOOK_CHUNK_ROWS = 500
+
+def open_input(path):
+    # binary stream for a path, or stdin for "-"
+    return sys.stdin.buffer if path == '-' else open(path, 'rb')
+
+def open_output(path, binary=False):
+    if path in (None, '-'):
+        return sys.stdout.buffer if binary else sys.stdout
+    return open(path, 'wb') if binary else open(path, 'w', newline='', encoding='utf-8')
+
+def report_rate(label, rows, started):
+    elapsed = time.perf_counter() - started
+    rate = rows / elapsed if elapsed > 0 else 0.0
+    print(f"{label}: {rows} rows in {elapsed:.2f}s ({rate:,.0f} rows/s)", file=sys.stderr)
 
 # ----------------------------------------------------
 # DATABASE SETUP
 # ----------------------------------------------------
 def init_db():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE,
-        password TEXT,
-        is_admin INTEGER DEFAULT 0
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS buses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        name TEXT,
-        route TEXT,
-        total_seats INTEGER,
-        available_seats INTEGER,
-        fare INTEGER
-    )
-    """)
-
-    cur.execute("""
-    CREATE TABLE IF NOT EXISTS bookings (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER,
-        bus_id INTEGER,
-        seats INTEGER,
-        passenger_name TEXT,
-        FOREIGN KEY(user_id) REFERENCES users(id),
-        FOREIGN KEY(bus_id) REFERENCES buses(id)
-    )
-    """)
-    
-    # Create default admin if not exists
-    cur.execute("SELECT * FROM users WHERE username='admin'")
-    if not cur.fetchone():
-        cur.execute("INSERT INTO users(username, password, is_admin) VALUES (?,?,?)",
-                    ('admin', 'admin123', 1))
-        conn.commit()
-        print("Default admin created (admin / admin123)")
-    
-    conn.commit()
-    conn.close()
+    migrations.check()
+    session = SessionLocal()
+    try:
+        # Create default admin if not exists
+        if not queries.get_user_by_name(session, 'admin'):
+            session.add(User(username='admin', password=hash_password('admin123'), is_admin=True))
+            session.commit()
+            print("Default admin created (admin / admin123)")
+    finally:
+        session.close()
+
+# ----------------------------------------------------
+# BATCH COMMANDS
+# ----------------------------------------------------
+def cmd_add_bus(args):
+    started = time.perf_counter()
+    session = SessionLocal()
+    try:
+        bus = Bus(name=args.name, route=args.route, total_seats=args.seats, available_seats=args.seats,
+                  fare=args.fare, depart_time=args.depart_time or '')
+        session.add(bus)
+        session.commit()
+        print(f"Bus {bus.id} added")
+    finally:
+        session.close()
+    report_rate('add-bus', 1, started)
+
+def cmd_import(args):
+    started = time.perf_counter()
+    stream = open_input(args.file)
+    try:
+        result = utils.import_buses_csv(stream, upsert=args.upsert, chunk_rows=args.chunk_rows)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    print(f"Import finished: {result}")
+    for line, message in result.errors:
+        print(f"  line {line}: {message}", file=sys.stderr)
+    report_rate('import', result.inserted + result.updated + result.failed, started)
+    return 1 if result.failed else 0
+
+def cmd_export(args):
+    started = time.perf_counter()
+    rows = -1  # header line
+    out = open_output(args.output, binary=args.gzip)
+    try:
+        chunks = utils.iter_bookings_csv()
+        if args.gzip:
+            def counted(chunks):
+                nonlocal rows
+                for chunk in chunks:
+                    rows += chunk.count('\n')
+                    yield chunk
+            for data in utils.gzip_chunks(counted(chunks)):
+                out.write(data)
+        else:
+            for chunk in chunks:
+                rows += chunk.count('\n')
+                out.write(chunk)
+    finally:
+        if args.output not in (None, '-'):
+            out.close()
+    report_rate('export', max(rows, 0), started)
+
+def _booking_request(row, user_ids):
+    # one CSV row -> (user_id, bus_id, trip_id, seats, name, phone, seat numbers); raises ValueError
+    user = (row.get('user') or '').strip()
+    user_id = int(row['user_id']) if (row.get('user_id') or '').strip() else user_ids.get(user)
+    if user_id is None:
+        raise ValueError(f"unknown user {user!r}")
+    seat_numbers = seatmap.parse_seats(row.get('seat_numbers') or '')
+    seats = len(set(seat_numbers)) if seat_numbers else int(row.get('seats') or 1)
+    if seats <= 0:
+        raise ValueError("seats must be positive")
+    trip = (row.get('trip_id') or '').strip()
+    return (user_id, int(row['bus_id']), int(trip) if trip else None, seats,
+            (row.get('passenger_name') or user or 'Passenger').strip(), row.get('passenger_phone') or '',
+            seat_numbers)
+
+def _book_chunk(requests, errors):
+    # All bookings of the chunk in one transaction, each in its own savepoint:
+    # a booking that cannot get its seats rolls back only itself.
+    def body(session):
+        reservations.begin_write(session)
+        booked, failed = 0, []
+        for line, r in requests:
+            try:
+                with session.begin_nested():
+                    reservations.tx_book(session, r[1], r[0], r[3], r[4], r[5], r[6], trip_id=r[2])
+                booked += 1
+            except reservations.SeatsUnavailable:
+                failed.append((line, f"seats not available on bus {r[1]}" + (f" trip {r[2]}" if r[2] else '')))
+        return booked, failed
+    booked, failed = reservations.run_in_transaction(body)
+    errors.extend(failed)
+    return booked
+
+def cmd_book(args):
+    started = time.perf_counter()
+    stream = open_input(args.file)
+    session = SessionLocal()
+    try:
+        user_ids = dict(session.execute(select(User.username, User.id)).all())
+    finally:
+        session.close()
+    booked, errors, chunk = 0, [], []
+    try:
+        reader = csv.DictReader(codecs.iterdecode(stream, 'utf-8-sig'))
+        for row in reader:
+            try:
+                chunk.append((reader.line_num, _booking_request(row, user_ids)))
+            except (KeyError, ValueError) as exc:
+                errors.append((reader.line_num, f"bad row: {exc}"))
+                continue
+            if len(chunk) >= args.chunk_rows:
+                booked += _book_chunk(chunk, errors)
+                chunk = []
+        if chunk:
+            booked += _book_chunk(chunk, errors)
+    finally:
+        if stream is not sys.stdin.buffer:
+            stream.close()
+    if booked:
+        catalog.invalidate(routes=False)
+    print(f"{booked} bookings made, {len(errors)} rejected")
+    for line, message in sorted(errors)[:utils.MAX_REPORTED_ERRORS]:
+        print(f"  line {line}: {message}", file=sys.stderr)
+    report_rate('book', booked + len(errors), started)
+    return 1 if errors else 0
+
+def cmd_report(args):
+    started = time.perf_counter()
+    start, end = reports.month_range(args.month) if args.month else (None, None)
+    report = reports.build_report(start, end)
+    text = report.to_json() if args.format == 'json' else report.to_csv()
+    out = open_output(args.output)
+    try:
+        out.write(text if text.endswith('\n') else text + '\n')
+    finally:
+        if args.output not in (None, '-'):
+            out.close()
+    report_rate('report', sum(report.bookings), started)
+
+def cmd_migrate_legacy(args):
+    # Copy users, buses and bookings from the database the CLI used to keep
+    # on its own (bus_main.db) into the shared one. Plaintext passwords are
+    # hashed on the way; users that already exist are matched by name.
+    started = time.perf_counter()
+    old = sqlite3.connect(args.db)
+    try:
+        users = old.execute("SELECT id, username, password, is_admin FROM users").fetchall()
+        buses = old.execute("SELECT id, name, route, total_seats, available_seats, fare FROM buses").fetchall()
+        bookings = old.execute("SELECT user_id, bus_id, seats, passenger_name FROM bookings").fetchall()
+    finally:
+        old.close()
+    with engine.begin() as conn:
+        existing = dict(conn.execute(select(User.username, User.id)).all())
+        user_map = {}
+        for old_id, username, password, is_admin in users:
+            if username not in existing:
+                existing[username] = conn.execute(insert(User).values(
+                    username=username, password=password if is_hashed(password) else hash_password(password or ''),
+                    is_admin=bool(is_admin))).inserted_primary_key[0]
+            user_map[old_id] = existing[username]
+        bus_map = {}
+        for old_id, name, route, total, available, fare in buses:
+            bus_map[old_id] = conn.execute(insert(Bus).values(
+                name=name or 'Unnamed', route=route or '', total_seats=total or 0,
+                available_seats=available or 0, fare=fare or 0, depart_time='')).inserted_primary_key[0]
+        rows = [{'user_id': user_map.get(u), 'bus_id': bus_map.get(b), 'seats': s or 1, 'passenger_name': p or ''}
+                for u, b, s, p in bookings]
+        if rows:
+            conn.execute(insert(Booking), rows)
+    aggregates.rebuild()
+    catalog.invalidate()
+    print(f"Migrated {len(users)} users, {len(buses)} buses, {len(bookings)} bookings from {args.db}")
+    report_rate('migrate-legacy', len(users) + len(buses) + len(bookings), started)
+
+def build_parser():
+    parser = argparse.ArgumentParser(description='Bus reservation system command line')
+    sub = parser.add_subparsers(dest='command')
+
+    p = sub.add_parser('add-bus', help='add one bus')
+    p.add_argument('--name', required=True)
+    p.add_argument('--route', required=True)
+    p.add_argument('--seats', type=int, default=40)
+    p.add_argument('--fare', type=int, default=0)
+    p.add_argument('--depart-time')
+    p.set_defaults(func=cmd_add_bus)
+
+    p = sub.add_parser('import', help='import buses from CSV (name,route,total_seats,fare,depart_time,extra)')
+    p.add_argument('file', help='CSV file, or - for stdin')
+    p.add_argument('--upsert', action='store_true', help='update buses with the same name and depart_time')
+    p.add_argument('--chunk-rows', type=int, default=utils.IMPORT_CHUNK_ROWS)
+    p.set_defaults(func=cmd_import)
+
+    p = sub.add_parser('export', help='export bookings as CSV')
+    p.add_argument('-o', '--output', help='file (default stdout)')
+    p.add_argument('--gzip', action='store_true')
+    p.set_defaults(func=cmd_export)
+
+    p = sub.add_parser('book', help='make bookings from CSV (user or user_id, bus_id, seats, passenger_name, '
+                                    'optional trip_id, passenger_phone, seat_numbers)')
+    p.add_argument('file', help='CSV file, or - for stdin')
+    p.add_argument('--chunk-rows', type=int, default=BOOK_CHUNK_ROWS, help='bookings per transaction')
+    p.set_defaults(func=cmd_book)
+
+    p = sub.add_parser('report', help='demand and revenue report')
+    p.add_argument('--month', help='YYYY-MM (default: all bookings)')
+    p.add_argument('--format', choices=['csv', 'json'], default='csv')
+    p.add_argument('-o', '--output', help='file (default stdout)')
+    p.set_defaults(func=cmd_report)
+
+    p = sub.add_parser('migrate-legacy', help='copy data from the old CLI database')
+    p.add_argument('--db', default='bus_main.db')
+    p.set_defaults(func=cmd_migrate_legacy)
+    return parser
 
 # ----------------------------------------------------
 # USER LOGIN & REGISTRATION
 # ----------------------------------------------------
 def register_user():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
     username = input("Enter username: ")
     password = getpass("Enter password: ")
 
+    session = SessionLocal()
     try:
-        cur.execute("INSERT INTO users(username, password, is_admin) VALUES (?,?,0)",
-                    (username, password))
-        conn.commit()
+        if queries.get_user_by_name(session, username):
+            print("Username already exists!")
+            return
+        session.add(User(username=username, password=hash_password(password), is_admin=False))
+        session.commit()
         print("User registered successfully!")
-    except Exception:
-        print("Username already exists!")
-
-    conn.close()
+    finally:
+        session.close()
 
 
 def login():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
     username = input("Username: ")
     password = getpass("Password: ")
 
-    cur.execute("SELECT id, is_admin FROM users WHERE username=? AND password=?",
-                (username, password))
-    user = cur.fetchone()
-    conn.close()
+    session = SessionLocal()
+    try:
+        user = auth.authenticate(session, username, password)
+    except auth.Throttled:
+        print("Too many attempts, try again later.")
+        return None
+    except auth.Busy:
+        print("Server busy, please try again.")
+        return None
+    finally:
+        session.close()
 
     if user:
         print("Login successful!")
-        return {"id": user[0], "username": username, "is_admin": user[1]}
+        return {"id": user.id, "username": user.username, "is_admin": user.is_admin}
     else:
         print("Invalid credentials.")
         return None
@@ -99,32 +315,30 @@ def login():
 # ADMIN FUNCTIONS
 # ----------------------------------------------------
 def add_bus():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
     name = input("Bus name: ")
     route = input("Route: ")
     seats = int(input("Total seats: "))
     fare = int(input("Ticket fare: "))
 
-    cur.execute("INSERT INTO buses(name, route, total_seats, available_seats, fare) VALUES (?,?,?,?,?)",
-                (name, route, seats, seats, fare))
-    conn.commit()
-    conn.close()
+    session = SessionLocal()
+    try:
+        session.add(Bus(name=name, route=route, total_seats=seats, available_seats=seats, fare=fare))
+        session.commit()
+    finally:
+        session.close()
     print("Bus added successfully!")
 
 
 def view_buses():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
-    cur.execute("SELECT * FROM buses")
-    buses = cur.fetchall()
-    conn.close()
+    session = SessionLocal()
+    try:
+        buses = queries.list_buses(session)
+    finally:
+        session.close()
 
     print("\n--- Available Buses ---")
     for b in buses:
-        print(f"ID: {b[0]} | {b[1]} | {b[2]} | Seats: {b[4]}/{b[3]} | Fare: {b[5]}")
+        print(f"ID: {b.id} | {b.name} | {b.route} | Seats: {b.available_seats}/{b.total_seats} | Fare: {b.fare}")
     print()
 
 
@@ -132,36 +346,32 @@ def delete_bus():
     view_buses()
     bus_id = int(input("Enter Bus ID to delete: "))
 
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
-    cur.execute("DELETE FROM buses WHERE id=?", (bus_id,))
-    conn.commit()
-    conn.close()
-
-    print("Bus deleted!")
+    # soft delete; its bookings are cancelled and refunded
+    result = reservations.delete_bus(bus_id)
+    if result is None:
+        print("Bus not found!")
+    else:
+        print(f"Bus deleted! {result[0]} bookings cancelled, {result[1]} refunded.")
 
 
 def export_bookings_csv():
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
-    cur.execute("""
-    SELECT bookings.id, users.username, buses.name, bookings.seats, bookings.passenger_name
-    FROM bookings
-    JOIN users ON bookings.user_id = users.id
-    JOIN buses ON bookings.bus_id = buses.id
-    """)
-    data = cur.fetchall()
-    conn.close()
-
-    with open("bookings_export.csv", "w", newline='') as f:
-        writer = csv.writer(f)
-        writer.writerow(["BookingID", "User", "Bus", "Seats", "Passenger"])
-        writer.writerows(data)
-
+    # streamed from the shared bookings tables, same generator as the web export
+    utils.write_bookings_csv("bookings_export.csv")
     print("Bookings exported to bookings_export.csv")
 
+
+def booking_report():
+    # demand/revenue report over the shared bookings tables, like the export
+    month = input("Month (YYYY-MM, blank for all): ").strip()
+    try:
+        start, end = reports.month_range(month) if month else (None, None)
+    except ValueError:
+        print("Month must be YYYY-MM")
+        return
+    path = "bookings_report.json" if input("Format (csv/json): ").strip().lower() == 'json' else "bookings_report.csv"
+    reports.write_report(reports.build_report(start, end), path)
+    print(f"Report written to {path}")
+
 # ----------------------------------------------------
 # USER FUNCTIONS
 # ----------------------------------------------------
@@ -171,48 +381,43 @@ def book_seat(user):
     seats = int(input("How many seats? "))
     name = input("Passenger Name: ")
 
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
-    cur.execute("SELECT available_seats FROM buses WHERE id=?", (bus_id,))
-    available = cur.fetchone()
+    if seats <= 0:
+        print("Invalid seat count!")
+        return
 
-    if not available or seats > available[0]:
+    # same booking transaction as the web app: seats can never be oversold
+    if reservations.book_seats(bus_id, user["id"], seats, name) is None:
         print("Not enough seats available!")
-        conn.close()
         return
 
-    # Deduct seats
-    cur.execute("UPDATE buses SET available_seats = available_seats - ? WHERE id=?", (seats, bus_id))
-
-    # Store booking
-    cur.execute("INSERT INTO bookings(user_id, bus_id, seats, passenger_name) VALUES (?,?,?,?)",
-                (user["id"], bus_id, seats, name))
-
-    conn.commit()
-    conn.close()
-
     print("Seat booked successfully!")
 
 
 def view_my_bookings(user):
-    conn = sqlite3.connect(DB)
-    cur = conn.cursor()
-
-    cur.execute("""
-    SELECT bookings.id, buses.name, buses.route, bookings.seats, bookings.passenger_name 
-    FROM bookings 
-    JOIN buses ON bookings.bus_id = buses.id
-    WHERE user_id=?
-    """, (user["id"],))
-    bookings = cur.fetchall()
-    conn.close()
+    session = SessionLocal()
+    try:
+        bookings = queries.user_bookings(session, user["id"])
+    finally:
+        session.close()
 
     print("\n--- My Bookings ---")
     for bk in bookings:
-        print(f"BookingID: {bk[0]} | Bus: {bk[1]} | Route: {bk[2]} | Seats: {bk[3]} | Passenger: {bk[4]}")
+        print(f"BookingID: {bk.id} | Bus: {bk.bus_name or ''} | Seats: {bk.seats} | Passenger: {bk.passenger_name}"
+              f" | {bk.status}")
     print()
 
+
+def cancel_booking(user):
+    view_my_bookings(user)
+    booking_id = int(input("Enter Booking ID to cancel: "))
+
+    refund = reservations.cancel_booking(booking_id, user["id"])
+    if refund is None:
+        print("Booking not found!")
+        return
+
+    print(f"Booking cancelled! {refund} refunded.")
+
 # ----------------------------------------------------
 # MENUS
 # ----------------------------------------------------
@@ -223,7 +428,8 @@ def admin_menu(user):
         print("2. View Buses")
         print("3. Delete Bus")
         print("4. Export Bookings CSV")
-        print("5. Logout")
+        print("5. Bookings Report")
+        print("6. Logout")
 
         ch = input("Enter choice: ")
 
@@ -236,6 +442,8 @@ def admin_menu(user):
         elif ch == '4':
             export_bookings_csv()
         elif ch == '5':
+            booking_report()
+        elif ch == '6':
             break
         else:
             print("Invalid choice")
@@ -247,7 +455,8 @@ def user_menu(user):
         print("1. View Buses")
         print("2. Book Seat")
         print("3. View My Bookings")
-        print("4. Logout")
+        print("4. Cancel Booking")
+        print("5. Logout")
 
         ch = input("Enter choice: ")
 
@@ -258,6 +467,8 @@ def user_menu(user):
         elif ch == '3':
             view_my_bookings(user)
         elif ch == '4':
+            cancel_booking(user)
+        elif ch == '5':
             break
         else:
             print("Invalid choice")
@@ -265,9 +476,7 @@ def user_menu(user):
 # ----------------------------------------------------
 # MAIN PROGRAM
 # ----------------------------------------------------
-def main():
-    init_db()
-
+def interactive():
     print("\n======= BUS RESERVATION SYSTEM =======")
 
     while True:
@@ -282,7 +491,7 @@ def main():
         elif choice == '2':
             user = login()
             if user:
-                if user["is_admin"] == 1:
+                if user["is_admin"]:
                     admin_menu(user)
                 else:
                     user_menu(user)
@@ -292,5 +501,13 @@ def main():
         else:
             print("Invalid choice")
 
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    init_db()
+    if args.command is None:
+        interactive()
+        return 0
+    return args.func(args) or 0
+
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
@@ -0,0 +1,250 @@
+import argparse
+import sys
+from datetime import date
+from sqlalchemy import inspect, select, func
+from sqlalchemy.exc import IntegrityError
+from models import engine, init_db, Base, SchemaVersion
+import models
+import config
+
+# Versioned schema migrations. The columns and indexes each feature adds to
+# existing tables are its upgrade step in models.py; the migrations below
+# apply those steps and record in schema_version which migrations a database
+# has had. Every step checks before it acts (a missing column, table or
+# index), so a migration interrupted half way - MySQL DDL is not
+# transactional - is simply run again.
+#
+# Indexes are built online where the database can: CREATE INDEX
+# CONCURRENTLY on PostgreSQL, ALGORITHM=INPLACE, LOCK=NONE on MySQL (which
+# fails instead of locking the table if InnoDB cannot do it in place).
+# SQLite has no online build and holds its write lock while it runs; writers
+# wait up to SQLITE_BUSY_TIMEOUT_MS.
+#
+# The web app only checks the version when it starts (check, run by
+# app.start before the first request is served); it never runs DDL while
+# serving requests. An empty database is created at the current
+# version; one that is behind is an error unless MIGRATE_ON_START=1.
+#
+#   python migrations.py status
+#   python migrations.py upgrade
+#   python migrations.py --explain     # query plans of the views' queries
+
+class SchemaOutOfDate(Exception):
+    pass
+
+def _exists(table, index=None):
+    insp = inspect(engine)
+    if not insp.has_table(table):
+        return False
+    if index:
+        return index in {i['name'] for i in insp.get_indexes(table)} | \
+            {u['name'] for u in insp.get_unique_constraints(table)}
+    return True
+
+def create_tables(names, log):
+    tables = [Base.metadata.tables[n] for n in names if not _exists(n)]
+    if tables:
+        Base.metadata.create_all(engine, tables=tables)
+        log(f"  created {', '.join(t.name for t in tables)}")
+    return [t.name for t in tables]
+
+def create_index(table_name, index_name, log):
+    # the models' index of that name, built online where the dialect can
+    if _exists(table_name, index=index_name):
+        return
+    index = next(i for i in Base.metadata.tables[table_name].indexes if i.name == index_name)
+    quote = engine.dialect.identifier_preparer.quote
+    columns = ', '.join(quote(c.name) for c in index.columns)
+    unique = 'UNIQUE ' if index.unique else ''
+    dialect = engine.dialect.name
+    if dialect in ('mysql', 'mariadb'):
+        ddl = (f"ALTER TABLE {quote(table_name)} ADD {unique}INDEX {quote(index_name)} ({columns}), "
+               f"ALGORITHM=INPLACE, LOCK=NONE")
+    elif dialect == 'postgresql':
+        ddl = f"CREATE {unique}INDEX CONCURRENTLY IF NOT EXISTS {quote(index_name)} ON {quote(table_name)} ({columns})"
+    else:
+        ddl = f"CREATE {unique}INDEX IF NOT EXISTS {quote(index_name)} ON {quote(table_name)} ({columns})"
+    # CONCURRENTLY refuses to run inside a transaction
+    with engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        conn.exec_driver_sql(ddl)
+    log(f"  created index {index_name}")
+
+def _online_indexes(log):
+    # every models index missing from an existing table that already has its columns
+    insp = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        if not insp.has_table(table.name):
+            continue
+        columns = {c['name'] for c in insp.get_columns(table.name)}
+        for index in table.indexes:
+            if all(c.name in columns for c in index.columns):
+                create_index(table.name, index.name, log)
+
+# Migrations
+
+def _catch_up(log):
+    # Migration 1 brings a database made by any earlier release up to date:
+    # the tables features added, then the models' upgrade steps for columns
+    # and indexes on tables that already existed. Indexes whose columns are
+    # there are built online first, so the steps only find them done; the
+    # one on bookings.trip_id is built by its step, with the column.
+    create_tables([t.name for t in Base.metadata.sorted_tables], log)
+    _online_indexes(log)
+    models.upgrade_tables(log)
+
+def _hot_query_indexes(log):
+    # Declared on tables that already existed, so create_all never built them
+    # there. --explain shows each view using one of these or a primary key.
+    create_index('bookings', 'ix_bookings_booked_at', log)       # admin bookings pages, report date ranges
+    create_index('bookings', 'ix_bookings_bus_booked_at', log)   # admin bookings by bus, cancelling a bus
+    create_index('bookings', 'ix_bookings_user_booked_at', log)  # /my_bookings, admin bookings by user
+    create_index('bookings', 'ix_bookings_trip_id', log)         # bookings of a trip
+    create_index('buses', 'ix_buses_name_depart_time', log)      # CSV import upsert lookups
+
+def _trip_ids_never_reused(log):
+    # the trips upgrade step rebuilds trips with AUTOINCREMENT on SQLite and
+    # starts its sequence past archived ids; the other steps find nothing to do
+    models.upgrade_tables(log)
+
+MIGRATIONS = [
+    (1, 'tables and columns added before versioned migrations', _catch_up),
+    (2, 'indexes the hot queries use', _hot_query_indexes),
+    (3, 'trip ids are never reused after archiving', _trip_ids_never_reused),
+]
+HEAD = MIGRATIONS[-1][0]
+
+def current_version():
+    # None for an empty database, 0 for one made before versioned migrations
+    insp = inspect(engine)
+    if not insp.has_table('schema_version'):
+        return 0 if insp.has_table('users') else None
+    with engine.connect() as conn:
+        return conn.execute(select(func.max(SchemaVersion.version))).scalar() or 0
+
+def _stamp(version, description):
+    try:
+        with engine.begin() as conn:
+            conn.execute(SchemaVersion.__table__.insert(), {'version': version, 'description': description})
+    except IntegrityError:
+        pass  # another process applied it at the same time
+
+def create(log=print):
+    # a new database: the models' schema, recorded as every migration applied
+    init_db()
+    for version, description, _ in MIGRATIONS:
+        _stamp(version, description)
+    log(f"created schema at version {HEAD}")
+
+def upgrade(log=print):
+    # apply what is missing; returns the versions applied
+    version = current_version()
+    if version is None:
+        create(log)
+        return []
+    create_tables(['schema_version'], log)
+    applied = []
+    for number, description, migrate in MIGRATIONS:
+        if number > version:
+            log(f"migration {number}: {description}")
+            migrate(log)
+            _stamp(number, description)
+            applied.append(number)
+    return applied
+
+def check():
+    # At startup: create an empty database, accept one at (or, mid-deploy,
+    # past) HEAD, upgrade with MIGRATE_ON_START=1, otherwise refuse to run.
+    version = current_version()
+    if version is None:
+        create(log=lambda msg: None)
+    elif version < HEAD:
+        if not config.MIGRATE_ON_START:
+            raise SchemaOutOfDate(f"database schema is at version {version}, this code needs {HEAD}; "
+                                  f"run `python migrations.py upgrade` (or set MIGRATE_ON_START=1)")
+        upgrade(log=lambda msg: None)
+
+# Query plans
+
+def _explain_targets(session):
+    # (view, fn(session)) for the queries the pages run, with ids from the data
+    import queries
+    import search
+    from models import Bus, Booking, Trip, User
+    today = date.today()
+    bus_id = session.execute(select(func.min(Bus.id))).scalar() or 1
+    trip = session.execute(select(Trip.id, Trip.route).limit(1)).first()
+    user = session.execute(select(User.id, User.username).join(Booking, Booking.user_id == User.id).limit(1)).first()
+    user_id, username = (user.id, user.username) if user else (1, 'admin')
+    stops = search.parse_stops(session.execute(select(Bus.route).where(Bus.id == bus_id)).scalar() or 'a - b')
+    after = (session.execute(select(func.max(Booking.booked_at))).scalar(), 1 << 30)
+    return [
+        ('/ and /buses', lambda s: queries.list_buses(s)),
+        ('/search (route index load + buses)', lambda s: search.search_buses(stops[0], stops[-1], today.isoformat())),
+        ('/search (trips of a day)', lambda s: queries.trips_on(s, [trip.route if trip else 'a - b'], today)),
+        ('/book/<id>', lambda s: queries.get_bus_with_free_seats(s, bus_id)),
+        ('/book/<id>/trip/<id>', lambda s: queries.get_trip_with_free_seats(s, trip.id if trip else 1)),
+        ('/hold/<id>', lambda s: queries.get_hold(s, 1)),
+        ('/my_bookings', lambda s: queries.user_bookings(s, user_id)),
+        ('/admin bookings, first page', lambda s: queries.bookings_page(s)),
+        ('/admin bookings, next page', lambda s: queries.bookings_page(s, after=after if after[0] else None)),
+        ('/admin bookings, by bus', lambda s: queries.bookings_page(s, bus_id=bus_id)),
+        ('/admin bookings, by user', lambda s: queries.bookings_page(s, username=username)),
+        ('/admin sales summary', lambda s: queries.sales_summary(s, today)),
+        ('/admin schedules', lambda s: queries.list_schedules(s)),
+        ('login / load_user', lambda s: (queries.get_user_by_name(s, username), queries.get_user(s, user_id))),
+    ]
+
+def _plan(conn, statement, parameters):
+    dialect = engine.dialect.name
+    prefix = 'EXPLAIN QUERY PLAN ' if dialect == 'sqlite' else 'EXPLAIN '
+    rows = conn.exec_driver_sql(prefix + statement, parameters).all()
+    if dialect == 'sqlite':
+        return [row[-1] for row in rows]
+    return [' | '.join('' if v is None else str(v) for v in row) for row in rows]
+
+def explain(out=sys.stdout):
+    # Runs each view's queries once, captures the SELECTs they send and prints
+    # the database's plan for each. On SQLite "SCAN <table>" without an index
+    # is a full table scan.
+    from sqlalchemy import event
+    from models import SessionLocal
+    import catalog
+    catalog.invalidate()  # the route index must be loaded, not served from memory
+    captured = []
+    def capture(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith('SELECT'):
+            captured.append((statement, parameters))
+    session = SessionLocal()
+    try:
+        targets = _explain_targets(session)
+        event.listen(engine, 'before_cursor_execute', capture)
+        try:
+            for view, fn in targets:
+                captured.clear()
+                fn(session)
+                print(f"== {view}", file=out)
+                with engine.connect() as conn:
+                    for statement, parameters in list(captured):
+                        print('  ' + ' '.join(statement.split()), file=out)
+                        for line in _plan(conn, statement, parameters):
+                            print('    ' + line, file=out)
+        finally:
+            event.remove(engine, 'before_cursor_execute', capture)
+    finally:
+        session.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Schema migrations')
+    parser.add_argument('command', nargs='?', choices=['status', 'upgrade'], default='status')
+    parser.add_argument('--explain', action='store_true', help='print the query plans of the views')
+    args = parser.parse_args()
+    if args.explain:
+        explain()
+    elif args.command == 'upgrade':
+        applied = upgrade()
+        print(f"applied {', '.join(map(str, applied))}" if applied else f"up to date (version {HEAD})")
+    else:
+        version = current_version()
+        print('empty database' if version is None else f"version {version} of {HEAD}")
+        for number, description, _ in MIGRATIONS:
+            print(f"  {'x' if version and number <= version else ' '} {number} {description}")
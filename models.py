@@ -1,13 +1,107 @@
 from sqlalchemy import (
-    create_engine, Column, Integer, String, Boolean, ForeignKey, DateTime, Text
+    create_engine, Column, Integer, String, Boolean, ForeignKey, Date, DateTime, Text, LargeBinary, Index,
+    UniqueConstraint
 )
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker
+from sqlalchemy import event, inspect, select, true, MetaData, Table
+from sqlalchemy.schema import CreateColumn
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, deferred, scoped_session
 from datetime import datetime
+import threading
+import time
 import config
 
+class PoolMetrics:
+    # checkout counts and time spent waiting for a pooled connection, for pool sizing
+    BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0)
+
+    def __init__(self):
+        self.checkouts = 0
+        self.timeouts = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.wait_buckets = [0] * (len(self.BUCKETS) + 1)
+        self._lock = threading.Lock()
+
+    def record(self, wait, timed_out=False):
+        with self._lock:
+            if timed_out:
+                self.timeouts += 1
+                return
+            self.checkouts += 1
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            i = 0
+            while i < len(self.BUCKETS) and wait > self.BUCKETS[i]:
+                i += 1
+            self.wait_buckets[i] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return {'checkouts': self.checkouts, 'timeouts': self.timeouts, 'wait_total': self.wait_total,
+                    'wait_max': self.wait_max, 'wait_buckets': list(zip(self.BUCKETS + (float('inf'),), self.wait_buckets))}
+
+class MeteredQueuePool(QueuePool):
+    # QueuePool that times every checkout (queue wait plus any new connect)
+    def __init__(self, *args, **kw):
+        self.metrics = kw.pop('metrics', None) or PoolMetrics()
+        super().__init__(*args, **kw)
+
+    def recreate(self):
+        pool = super().recreate()
+        pool.metrics = self.metrics
+        return pool
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            conn = super()._do_get()
+        except Exception:
+            self.metrics.record(time.perf_counter() - start, timed_out=True)
+            raise
+        self.metrics.record(time.perf_counter() - start)
+        return conn
+
+def _sqlite_pragmas(dbapi_conn, record):
+    cur = dbapi_conn.cursor()
+    cur.execute(f"PRAGMA journal_mode={config.SQLITE_JOURNAL_MODE}")
+    cur.execute(f"PRAGMA synchronous={config.SQLITE_SYNCHRONOUS}")
+    cur.execute(f"PRAGMA busy_timeout={int(config.SQLITE_BUSY_TIMEOUT_MS)}")
+    cur.execute(f"PRAGMA mmap_size={int(config.SQLITE_MMAP_SIZE)}")
+    cur.close()
+
+def make_engine(url):
+    # One place for engine tuning. SQLite gets WAL/synchronous/busy_timeout/mmap
+    # pragmas on every new connection; MySQL gets a sized, pre-pinged,
+    # recycled pool. Both (except in-memory SQLite) use MeteredQueuePool.
+    pool_args = dict(poolclass=MeteredQueuePool, pool_size=config.DB_POOL_SIZE,
+                     max_overflow=config.DB_MAX_OVERFLOW, pool_timeout=config.DB_POOL_TIMEOUT)
+    if url.startswith('sqlite'):
+        if url in ('sqlite://', 'sqlite:///:memory:'):
+            pool_args = {}
+        eng = create_engine(url, echo=False, future=True,
+                            connect_args={'check_same_thread': False,
+                                          'timeout': config.SQLITE_BUSY_TIMEOUT_MS / 1000},
+                            **pool_args)
+        event.listen(eng, 'connect', _sqlite_pragmas)
+        return eng
+    return create_engine(url, echo=False, future=True, pool_recycle=config.DB_POOL_RECYCLE,
+                         pool_pre_ping=config.DB_POOL_PRE_PING, **pool_args)
+
+def pool_status(eng=None):
+    pool = (eng or engine).pool
+    status = {'status': pool.status()}
+    if isinstance(pool, QueuePool):
+        status.update(size=pool.size(), checked_out=pool.checkedout(), overflow=pool.overflow())
+    if isinstance(pool, MeteredQueuePool):
+        status.update(pool.metrics.snapshot())
+    return status
+
 Base = declarative_base()
-engine = create_engine(config.SQLALCHEMY_DATABASE_URI, echo=False, future=True)
+engine = make_engine(config.SQLALCHEMY_DATABASE_URI)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, future=True)
+# one session per thread; the web app removes it at the end of each request
+db_session = scoped_session(SessionLocal)
 
 class User(Base):
     __tablename__ = "users"
@@ -27,8 +121,13 @@ class Bus(Base):
     fare = Column(Integer, default=0)
     depart_time = Column(String(50), nullable=True)
     extra = Column(Text, nullable=True)
+    seat_map = deferred(Column(LargeBinary, nullable=True))  # taken-seat bitset, see seatmap.py
+    is_active = Column(Boolean, default=True, nullable=False)  # deleted buses stay for their bookings' history
     bookings = relationship("Booking", back_populates="bus")
 
+    # upsert key for CSV imports
+    __table_args__ = (Index('ix_buses_name_depart_time', 'name', 'depart_time'),)
+
 class Booking(Base):
     __tablename__ = "bookings"
     id = Column(Integer, primary_key=True)
@@ -38,9 +137,237 @@ class Booking(Base):
     booked_at = Column(DateTime, default=datetime.utcnow)
     passenger_name = Column(String(120), nullable=False)
     passenger_phone = Column(String(50), nullable=True)
+    seat_numbers = Column(Text, nullable=True)  # e.g. "4,5,6"
+    trip_id = Column(Integer, nullable=True)  # dated departure; no FK, trips get archived
+    status = Column(String(20), default='active', nullable=False)  # active / cancelled
+    cancelled_at = Column(DateTime, nullable=True)
+    refund_amount = Column(Integer, nullable=True)
 
     user = relationship("User", back_populates="bookings")
     bus = relationship("Bus", back_populates="bookings")
 
+    # (x, booked_at) lets the admin listing seek by (booked_at, id) within a
+    # bus or user without sorting; the id tiebreak comes from the primary key
+    __table_args__ = (
+        Index('ix_bookings_booked_at', 'booked_at'),
+        Index('ix_bookings_bus_booked_at', 'bus_id', 'booked_at'),
+        Index('ix_bookings_user_booked_at', 'user_id', 'booked_at'),
+        Index('ix_bookings_trip_id', 'trip_id'),
+    )
+
+class SeatHold(Base):
+    # seats taken off a bus for a limited time before the booking is confirmed
+    __tablename__ = "seat_holds"
+    id = Column(Integer, primary_key=True)
+    bus_id = Column(Integer, ForeignKey('buses.id'), nullable=False, index=True)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=True)
+    seats = Column(Integer, nullable=False)
+    seat_numbers = Column(Text, nullable=True)
+    passenger_name = Column(String(120), nullable=False)
+    passenger_phone = Column(String(50), nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    expires_at = Column(DateTime, nullable=False)
+    status = Column(String(20), default='held', nullable=False)  # held / confirmed / released / expired
+    booking_id = Column(Integer, ForeignKey('bookings.id'), nullable=True)
+    trip_id = Column(Integer, nullable=True)
+
+    __table_args__ = (Index('ix_seat_holds_status_expires_at', 'status', 'expires_at'),)
+
+# Dated departures. A Bus is the vehicle (name, route, capacity, fare); each
+# Trip is one departure of it on a service date with its own seat inventory
+# and seat map, so the same bus can run every day. Trips are generated in
+# bulk from Schedules (see trips.py). The route is copied onto the trip so a
+# day's search is one range on (route, service_date) that never touches
+# other days; trips of past days move to trips_archive.
+
+class Schedule(Base):
+    __tablename__ = "schedules"
+    id = Column(Integer, primary_key=True)
+    bus_id = Column(Integer, ForeignKey('buses.id'), nullable=False, index=True)
+    depart_time = Column(String(5), nullable=False)  # "HH:MM"
+    weekdays = Column(String(7), default='0123456', nullable=False)  # Monday=0
+    start_date = Column(Date, nullable=False)
+    end_date = Column(Date, nullable=True)
+    is_active = Column(Boolean, default=True, nullable=False)
+
+class Trip(Base):
+    __tablename__ = "trips"
+    id = Column(Integer, primary_key=True)
+    bus_id = Column(Integer, ForeignKey('buses.id'), nullable=False)
+    schedule_id = Column(Integer, nullable=True)
+    route = Column(String(200), nullable=False)  # copy of Bus.route
+    service_date = Column(Date, nullable=False)
+    depart_at = Column(DateTime, nullable=False)
+    total_seats = Column(Integer, nullable=False)
+    available_seats = Column(Integer, nullable=False)
+    seat_map = deferred(Column(LargeBinary, nullable=True))
+
+    __table_args__ = (
+        Index('ix_trips_route_service_date', 'route', 'service_date'),
+        Index('ix_trips_service_date', 'service_date'),
+        UniqueConstraint('bus_id', 'depart_at', name='uq_trips_bus_depart_at'),
+        # ids of archived trips must never be handed out again: bookings and
+        # trips_archive keep them (SQLite reuses the highest rowid otherwise)
+        {'sqlite_autoincrement': True},
+    )
+
+class TripArchive(Base):
+    # same columns as trips; bookings keep pointing at archived trip ids
+    __tablename__ = "trips_archive"
+    id = Column(Integer, primary_key=True)
+    bus_id = Column(Integer, nullable=False, index=True)
+    schedule_id = Column(Integer, nullable=True)
+    route = Column(String(200), nullable=False)
+    service_date = Column(Date, nullable=False, index=True)
+    depart_at = Column(DateTime, nullable=False)
+    total_seats = Column(Integer, nullable=False)
+    available_seats = Column(Integer, nullable=False)
+    seat_map = Column(LargeBinary, nullable=True)
+
+# Sales aggregates, kept in step with bookings inside the booking
+# transaction (see aggregates.py) so the dashboard never scans bookings.
+
+class SalesDaily(Base):
+    __tablename__ = "sales_daily"
+    bus_id = Column(Integer, primary_key=True)
+    day = Column(Date, primary_key=True)  # booking date
+    bookings = Column(Integer, default=0, nullable=False)
+    seats = Column(Integer, default=0, nullable=False)
+    revenue = Column(Integer, default=0, nullable=False)
+
+    __table_args__ = (Index('ix_sales_daily_day', 'day'),)
+
+class SalesTotal(Base):
+    __tablename__ = "sales_totals"
+    bus_id = Column(Integer, primary_key=True)
+    bookings = Column(Integer, default=0, nullable=False)
+    seats = Column(Integer, default=0, nullable=False)
+    revenue = Column(Integer, default=0, nullable=False)
+
+class IdempotencyKey(Base):
+    # result of a write made under a client's Idempotency-Key, written in the
+    # same transaction as the write itself (see idempotency.py)
+    __tablename__ = "idempotency_keys"
+    id = Column(Integer, primary_key=True)
+    user_id = Column(Integer, nullable=False)
+    key = Column(String(64), nullable=False)
+    scope = Column(String(32), nullable=False)  # which operation the key was used for
+    response = Column(Text, nullable=False)     # JSON
+    expires_at = Column(DateTime, nullable=False, index=True)
+
+    __table_args__ = (UniqueConstraint('user_id', 'key', name='uq_idempotency_keys_user_key'),)
+
+class SchemaVersion(Base):
+    # one row per migration applied to this database (see migrations.py)
+    __tablename__ = "schema_version"
+    version = Column(Integer, primary_key=True, autoincrement=False)
+    description = Column(String(200), nullable=False)
+    applied_at = Column(DateTime, default=datetime.utcnow, nullable=False)
+
+def make_async_engine(url):
+    # Async counterpart of make_engine for the JSON API (api_async.py). Needs
+    # aiosqlite / aiomysql; same pool settings and SQLite pragmas.
+    from sqlalchemy.ext.asyncio import create_async_engine
+    url = url.replace('sqlite://', 'sqlite+aiosqlite://', 1).replace('mysql+pymysql://', 'mysql+aiomysql://', 1)
+    if url.startswith('sqlite'):
+        eng = create_async_engine(url, echo=False, connect_args={'timeout': config.SQLITE_BUSY_TIMEOUT_MS / 1000})
+        event.listen(eng.sync_engine, 'connect', _sqlite_pragmas)
+        return eng
+    return create_async_engine(url, echo=False, pool_size=config.DB_POOL_SIZE, max_overflow=config.DB_MAX_OVERFLOW,
+                               pool_timeout=config.DB_POOL_TIMEOUT, pool_recycle=config.DB_POOL_RECYCLE,
+                               pool_pre_ping=config.DB_POOL_PRE_PING)
+
+# Changes to tables that already exist. create_all only creates missing
+# tables, so each feature that adds a column or index to an existing table
+# adds an upgrade step below. Steps check before they act and run in order
+# on every init_db, so a database made by any earlier release catches up.
+
+def _has(conn, table, column=None, index=None):
+    insp = inspect(conn)
+    if column:
+        return column in {c['name'] for c in insp.get_columns(table)}
+    return index in {i['name'] for i in insp.get_indexes(table)}
+
+def add_column(conn, table_name, column, log):
+    # column is a detached Column, so a step keeps meaning what it meant
+    # when it was written whatever the models say later
+    if _has(conn, table_name, column=column.name):
+        return
+    Table(table_name, MetaData(), column)
+    ddl = CreateColumn(column).compile(dialect=conn.dialect)
+    conn.exec_driver_sql(f"ALTER TABLE {conn.dialect.identifier_preparer.quote(table_name)} ADD COLUMN {ddl}")
+    log(f"  added column {table_name}.{column.name}")
+
+def create_index(conn, table_name, index_name, log):
+    # the models' index of that name
+    if _has(conn, table_name, index=index_name):
+        return
+    next(i for i in Base.metadata.tables[table_name].indexes if i.name == index_name).create(conn)
+    log(f"  created index {index_name}")
+
+def _seat_maps(conn, log):
+    add_column(conn, 'buses', Column('seat_map', LargeBinary, nullable=True), log)
+    add_column(conn, 'bookings', Column('seat_numbers', Text, nullable=True), log)
+
+def _booking_list_indexes(conn, log):
+    for name in ('ix_bookings_booked_at', 'ix_bookings_bus_booked_at', 'ix_bookings_user_booked_at'):
+        create_index(conn, 'bookings', name, log)
+
+def _bus_import_index(conn, log):
+    create_index(conn, 'buses', 'ix_buses_name_depart_time', log)
+
+def _cancellation(conn, log):
+    add_column(conn, 'buses', Column('is_active', Boolean, server_default=true(), nullable=False), log)
+    add_column(conn, 'bookings', Column('status', String(20), server_default='active', nullable=False), log)
+    add_column(conn, 'bookings', Column('cancelled_at', DateTime, nullable=True), log)
+    add_column(conn, 'bookings', Column('refund_amount', Integer, nullable=True), log)
+
+def _trips(conn, log):
+    add_column(conn, 'bookings', Column('trip_id', Integer, nullable=True), log)
+    add_column(conn, 'seat_holds', Column('trip_id', Integer, nullable=True), log)
+    create_index(conn, 'bookings', 'ix_bookings_trip_id', log)
+    _trip_ids_never_reused(conn, log)
+
+def _trip_ids_never_reused(conn, log):
+    # SQLite only: trips made before sqlite_autoincrement is rebuilt with it
+    # (a table cannot be altered to it), and the sequence starts past every
+    # id already used, archived ones included. MySQL and PostgreSQL never
+    # reuse the ids of deleted rows.
+    if conn.dialect.name != 'sqlite':
+        return
+    sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'trips'").scalar()
+    if 'AUTOINCREMENT' not in sql.upper():
+        trips = Base.metadata.tables['trips']
+        conn.exec_driver_sql('ALTER TABLE trips RENAME TO trips_old')
+        for index in trips.indexes:
+            conn.exec_driver_sql(f'DROP INDEX IF EXISTS {index.name}')
+        trips.create(conn)
+        columns = ', '.join(c.name for c in trips.columns)
+        conn.exec_driver_sql(f'INSERT INTO trips ({columns}) SELECT {columns} FROM trips_old')
+        conn.exec_driver_sql('DROP TABLE trips_old')
+        log('  rebuilt trips with AUTOINCREMENT')
+    used = conn.exec_driver_sql('SELECT max(m) FROM (SELECT max(id) AS m FROM trips '
+                                'UNION ALL SELECT max(id) FROM trips_archive)').scalar() or 0
+    seq = conn.exec_driver_sql("SELECT seq FROM sqlite_sequence WHERE name = 'trips'").scalar() or 0
+    if used > seq:
+        conn.exec_driver_sql("DELETE FROM sqlite_sequence WHERE name = 'trips'")
+        conn.exec_driver_sql("INSERT INTO sqlite_sequence (name, seq) VALUES ('trips', ?)", (used,))
+
+def _sales_aggregates(conn, log):
+    # the aggregate tables start empty; fill them from existing bookings once
+    if conn.execute(select(SalesTotal.bus_id).limit(1)).first() is None and \
+            conn.execute(select(Booking.id).where(Booking.status == 'active').limit(1)).first() is not None:
+        import aggregates
+        log(f"  sales aggregates rebuilt ({aggregates.rebuild(conn)} bus-days)")
+
+UPGRADE_STEPS = [_seat_maps, _booking_list_indexes, _bus_import_index, _cancellation, _trips, _sales_aggregates]
+
+def upgrade_tables(log=lambda msg: None):
+    for step in UPGRADE_STEPS:
+        with engine.begin() as conn:
+            step(conn, log)
+
 def init_db():
+    # missing tables, then the upgrade steps for the ones that already existed
     Base.metadata.create_all(engine)
+    upgrade_tables()
@@ -0,0 +1,250 @@
+from datetime import date, datetime
+from typing import NamedTuple, Optional
+from sqlalchemy import select, or_, and_, func
+from models import Bus, Booking, User, SeatHold, Trip, Schedule, SalesDaily, SalesTotal
+import seatmap
+
+# Read model for the views. Each function runs one query that selects only
+# the columns its page renders and returns immutable NamedTuples (no
+# __dict__, no session attached), so templates can never trigger lazy loads
+# or DetachedInstanceError after the session is closed.
+
+class BusRow(NamedTuple):
+    id: int
+    name: str
+    route: str
+    total_seats: int
+    available_seats: int
+    fare: int
+    depart_time: Optional[str]
+
+class TripRow(NamedTuple):
+    id: int
+    bus_id: int
+    name: str
+    route: str
+    service_date: date
+    depart_at: datetime
+    total_seats: int
+    available_seats: int
+    fare: int
+
+class ScheduleRow(NamedTuple):
+    id: int
+    bus_id: int
+    bus_name: str
+    depart_time: str
+    weekdays: str
+    start_date: date
+    end_date: Optional[date]
+    is_active: bool
+
+class BookingRow(NamedTuple):
+    id: int
+    bus_name: Optional[str]
+    seats: int
+    seat_numbers: Optional[str]
+    passenger_name: str
+    booked_at: datetime
+    status: str
+    refund_amount: Optional[int]
+
+class AdminBookingRow(NamedTuple):
+    id: int
+    username: Optional[str]
+    bus_name: Optional[str]
+    seats: int
+    seat_numbers: Optional[str]
+    passenger_name: str
+    booked_at: datetime
+    status: str
+
+class HoldRow(NamedTuple):
+    id: int
+    bus_id: int
+    bus_name: Optional[str]
+    user_id: int
+    seats: int
+    seat_numbers: Optional[str]
+    passenger_name: str
+    expires_at: datetime
+    status: str
+    booking_id: Optional[int]
+    trip_id: Optional[int]
+
+class SalesRow(NamedTuple):
+    bus_id: int
+    name: str
+    route: str
+    seats_total: int  # capacity on sale today: the day's trips, or the undated bus
+    seats_free: int
+    day_bookings: int
+    day_seats: int
+    day_revenue: int
+    bookings: int
+    seats: int
+    revenue: int
+
+class UserRow(NamedTuple):
+    id: int
+    username: str
+    password: str
+    is_admin: bool
+
+_BUS_COLUMNS = (Bus.id, Bus.name, Bus.route, Bus.total_seats, Bus.available_seats, Bus.fare, Bus.depart_time)
+_TRIP_COLUMNS = (Trip.id, Trip.bus_id, Bus.name, Trip.route, Trip.service_date, Trip.depart_at, Trip.total_seats,
+                 Trip.available_seats, Bus.fare)
+_USER_COLUMNS = (User.id, User.username, User.password, User.is_admin)
+
+def _rows(session, cls, stmt):
+    return [cls._make(r) for r in session.execute(stmt)]
+
+def _first(session, cls, stmt):
+    row = session.execute(stmt).first()
+    return cls._make(row) if row else None
+
+# Buses
+
+# deleted buses are only soft-deleted (is_active false) and never listed or sold
+
+def list_buses(session):
+    return _rows(session, BusRow, select(*_BUS_COLUMNS).where(Bus.is_active == True).order_by(Bus.id))
+
+def get_bus(session, bus_id):
+    return _first(session, BusRow, select(*_BUS_COLUMNS).where(Bus.id == bus_id))
+
+def get_bus_with_free_seats(session, bus_id):
+    # (BusRow, [free seat numbers]) or (None, [])
+    row = session.execute(select(*_BUS_COLUMNS, Bus.seat_map)
+                          .where(Bus.id == bus_id, Bus.is_active == True)).first()
+    if not row:
+        return None, []
+    bus = BusRow._make(row[:-1])
+    bits = seatmap.load(row.seat_map, bus.total_seats, bus.available_seats)
+    return bus, seatmap.free_seats(bits, bus.total_seats)
+
+def buses_by_ids(session, ids, date=None):
+    stmt = select(*_BUS_COLUMNS).where(Bus.id.in_(ids), Bus.is_active == True)
+    if date:
+        stmt = stmt.where(Bus.depart_time.startswith(date, autoescape=True))
+    return _rows(session, BusRow, stmt.order_by(Bus.id))
+
+# Trips
+
+def trips_on(session, routes, service_date):
+    # one day's trips on the given routes, a range scan on ix_trips_route_service_date
+    stmt = (select(*_TRIP_COLUMNS).join(Bus, Trip.bus_id == Bus.id)
+            .where(Trip.route.in_(routes), Trip.service_date == service_date, Bus.is_active == True)
+            .order_by(Trip.depart_at, Trip.id))
+    return _rows(session, TripRow, stmt)
+
+def get_trip_with_free_seats(session, trip_id):
+    # (TripRow, [free seat numbers]) or (None, [])
+    row = session.execute(select(*_TRIP_COLUMNS, Trip.seat_map).join(Bus, Trip.bus_id == Bus.id)
+                          .where(Trip.id == trip_id, Bus.is_active == True)).first()
+    if not row:
+        return None, []
+    trip = TripRow._make(row[:-1])
+    bits = seatmap.load(row.seat_map, trip.total_seats, trip.available_seats)
+    return trip, seatmap.free_seats(bits, trip.total_seats)
+
+def list_schedules(session):
+    stmt = (select(Schedule.id, Schedule.bus_id, Bus.name, Schedule.depart_time, Schedule.weekdays,
+                   Schedule.start_date, Schedule.end_date, Schedule.is_active)
+            .join(Bus, Schedule.bus_id == Bus.id).where(Bus.is_active == True).order_by(Schedule.id))
+    return _rows(session, ScheduleRow, stmt)
+
+# Sales
+
+def sales_summary(session, day):
+    # One row per active bus from the aggregate tables (and that day's trips
+    # for occupancy); never touches bookings.
+    daily = select(SalesDaily).where(SalesDaily.day == day).subquery()
+    trips = (select(Trip.bus_id, func.sum(Trip.total_seats).label('total'),
+                    func.sum(Trip.available_seats).label('available'))
+             .where(Trip.service_date == day).group_by(Trip.bus_id).subquery())
+    zero = lambda c: func.coalesce(c, 0)
+    stmt = (select(Bus.id, Bus.name, Bus.route,
+                   func.coalesce(trips.c.total, Bus.total_seats), func.coalesce(trips.c.available, Bus.available_seats),
+                   zero(daily.c.bookings), zero(daily.c.seats), zero(daily.c.revenue),
+                   zero(SalesTotal.bookings), zero(SalesTotal.seats), zero(SalesTotal.revenue))
+            .outerjoin(daily, daily.c.bus_id == Bus.id)
+            .outerjoin(trips, trips.c.bus_id == Bus.id)
+            .outerjoin(SalesTotal, SalesTotal.bus_id == Bus.id)
+            .where(Bus.is_active == True)
+            .order_by(Bus.id))
+    return _rows(session, SalesRow, stmt)
+
+def sales_by_route(rows):
+    # roll sales_summary rows up per route: [(route, day_seats, day_revenue, seats, revenue)]
+    routes = {}
+    for r in rows:
+        acc = routes.setdefault(r.route, [0, 0, 0, 0])
+        acc[0] += r.day_seats; acc[1] += r.day_revenue; acc[2] += r.seats; acc[3] += r.revenue
+    return [(route,) + tuple(acc) for route, acc in sorted(routes.items())]
+
+# Users
+
+def get_user(session, user_id):
+    return _first(session, UserRow, select(*_USER_COLUMNS).where(User.id == user_id))
+
+def get_user_by_name(session, username):
+    return _first(session, UserRow, select(*_USER_COLUMNS).where(User.username == username))
+
+# Bookings
+
+def user_bookings(session, user_id):
+    stmt = (select(Booking.id, Bus.name, Booking.seats, Booking.seat_numbers, Booking.passenger_name,
+                   Booking.booked_at, Booking.status, Booking.refund_amount)
+            .outerjoin(Bus, Booking.bus_id == Bus.id)
+            .where(Booking.user_id == user_id)
+            .order_by(Booking.booked_at.desc(), Booking.id.desc()))
+    return _rows(session, BookingRow, stmt)
+
+BOOKINGS_PAGE_SIZE = 50
+
+def parse_cursor(value):
+    # "<booked_at iso>_<id>" -> (datetime, id); raises ValueError on junk
+    if not value:
+        return None
+    booked_at, booking_id = value.rsplit('_', 1)
+    return datetime.fromisoformat(booked_at), int(booking_id)
+
+def bookings_page(session, after=None, bus_id=None, username=None, date_from=None, date_to=None,
+                  limit=BOOKINGS_PAGE_SIZE):
+    # Newest-first keyset page over (booked_at, id): one joined query that
+    # seeks past the last row of the previous page instead of using OFFSET,
+    # so every page costs the same however deep it is. Returns (rows, cursor
+    # for the next page or None).
+    stmt = (select(Booking.id, User.username, Bus.name, Booking.seats, Booking.seat_numbers,
+                   Booking.passenger_name, Booking.booked_at, Booking.status)
+            .outerjoin(User, Booking.user_id == User.id)
+            .outerjoin(Bus, Booking.bus_id == Bus.id))
+    if after:
+        stmt = stmt.where(or_(Booking.booked_at < after[0],
+                              and_(Booking.booked_at == after[0], Booking.id < after[1])))
+    if bus_id:
+        stmt = stmt.where(Booking.bus_id == bus_id)
+    if username:
+        stmt = stmt.where(User.username == username)
+    if date_from:
+        stmt = stmt.where(Booking.booked_at >= date_from)
+    if date_to:
+        stmt = stmt.where(Booking.booked_at < date_to)
+    rows = _rows(session, AdminBookingRow,
+                 stmt.order_by(Booking.booked_at.desc(), Booking.id.desc()).limit(limit + 1))
+    next_after = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_after = f"{rows[-1].booked_at.isoformat()}_{rows[-1].id}"
+    return rows, next_after
+
+# Holds
+
+def get_hold(session, hold_id):
+    stmt = (select(SeatHold.id, SeatHold.bus_id, Bus.name, SeatHold.user_id, SeatHold.seats,
+                   SeatHold.seat_numbers, SeatHold.passenger_name, SeatHold.expires_at, SeatHold.status,
+                   SeatHold.booking_id, SeatHold.trip_id)
+            .outerjoin(Bus, SeatHold.bus_id == Bus.id)
+            .where(SeatHold.id == hold_id))
+    return _first(session, HoldRow, stmt)
@@ -0,0 +1,345 @@
+import random
+import time
+from datetime import datetime, timedelta
+from sqlalchemy import select, update, func
+from sqlalchemy.exc import OperationalError
+from models import SessionLocal, Bus, Booking, SeatHold, Trip
+import seatmap
+import aggregates
+import events
+import catalog
+import config
+
+# Booking engine. Seats are claimed with a single conditional UPDATE
+# (available_seats >= n) so two concurrent bookings can never oversell a bus;
+# that statement also takes the row's write lock, so the seat map read and
+# written right after it in the same transaction cannot change underneath us.
+# The booking row is inserted in that transaction too. No SELECT ... FOR
+# UPDATE, no application lock.
+
+class SeatsUnavailable(Exception):
+    pass
+
+class Conflict(Exception):
+    # lost a race to another transaction; run_in_transaction starts over
+    pass
+
+def run_in_transaction(fn, retries=None, session_factory=SessionLocal):
+    # Run fn(session) in its own transaction and commit. Lock timeouts
+    # ("database is locked" on SQLite, deadlocks on MySQL) surface as
+    # OperationalError; those and Conflict are retried in a fresh transaction
+    # with jittered backoff, anything else is rolled back and re-raised.
+    retries = config.BOOKING_MAX_RETRIES if retries is None else retries
+    attempt = 0
+    while True:
+        session = session_factory()
+        try:
+            result = fn(session)
+            session.commit()
+            return result
+        except (OperationalError, Conflict):
+            session.rollback()
+            attempt += 1
+            if attempt > retries:
+                raise
+            time.sleep(random.uniform(0, 0.01 * (2 ** attempt)))
+        except Exception:
+            session.rollback()
+            raise
+        finally:
+            session.close()
+
+def begin_write(session):
+    # Start session's transaction as a writer. On SQLite this takes the write
+    # lock up front and makes pysqlite leave the transaction to us, so
+    # savepoints (session.begin_nested) nest inside it instead of committing.
+    if session.get_bind().dialect.name == 'sqlite':
+        session.connection().exec_driver_sql('BEGIN IMMEDIATE')
+
+def _inventory(bus_id, trip_id):
+    # Seats of a dated departure live on its Trip, those of an undated bus on
+    # the Bus row itself; both have the same inventory columns. Returns
+    # (model, primary key, conditions that make it bookable).
+    if trip_id is None:
+        return Bus, bus_id, [Bus.is_active == True]
+    bus_live = select(Bus.id).where(Bus.id == bus_id, Bus.is_active == True).exists()
+    return Trip, trip_id, [Trip.bus_id == bus_id, bus_live]
+
+def reserve_seats(session, bus_id, seats, seat_numbers=None, trip_id=None):
+    # Take `seats` seats (or exactly `seat_numbers`) on the bus, or on one of
+    # its trips, and return the assigned seat numbers. Raises SeatsUnavailable;
+    # the caller's transaction must then be rolled back.
+    model, key, live = _inventory(bus_id, trip_id)
+    result = session.execute(
+        update(model)
+        .where(model.id == key, model.available_seats >= seats, *live)
+        .values(available_seats=model.available_seats - seats)
+        .execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        raise SeatsUnavailable()
+    events.touch(session, bus_id, trip_id)
+    row = session.execute(
+        select(model.total_seats, model.available_seats, model.seat_map).where(model.id == key)
+    ).one()
+    bits = seatmap.load(row.seat_map, row.total_seats, row.available_seats + seats)
+    picked = seatmap.reserve(bits, row.total_seats, seats, seat_numbers)
+    if picked is None:
+        raise SeatsUnavailable()
+    new_bits, numbers = picked
+    session.execute(
+        update(model).where(model.id == key).values(seat_map=seatmap.dump(new_bits, row.total_seats))
+        .execution_options(synchronize_session=False)
+    )
+    return numbers
+
+def _unnamed_seats(session, bus_id, trip_id, bits):
+    # Taken seats that no live booking or hold names: the ones seatmap.load
+    # filled in for bookings made before seat maps, which have no numbers.
+    named = set()
+    for model, live in ((Booking, Booking.status == 'active'), (SeatHold, SeatHold.status == 'held')):
+        target = [model.trip_id == trip_id] if trip_id is not None else [model.bus_id == bus_id,
+                                                                         model.trip_id.is_(None)]
+        for numbers in session.execute(select(model.seat_numbers)
+                                       .where(live, model.seat_numbers.is_not(None), *target)).scalars():
+            named.update(seatmap.parse_seats(numbers))
+    return [s for s in seatmap.taken_seats(bits) if s not in named]
+
+def release_seats(session, bus_id, seats, seat_numbers, trip_id=None):
+    # Put seats back on sale: the increment takes the row lock, then the
+    # seats are cleared from the map under it. Seats of an archived trip
+    # have nowhere to go and are dropped. Seats without numbers (bookings
+    # made before seat maps) free that many of the unnamed taken seats; the
+    # caller has already marked the released rows as no longer live.
+    model, key = (Bus, bus_id) if trip_id is None else (Trip, trip_id)
+    session.execute(
+        update(model).where(model.id == key).values(available_seats=model.available_seats + seats)
+        .execution_options(synchronize_session=False)
+    )
+    events.touch(session, bus_id, trip_id)
+    row = session.execute(
+        select(model.total_seats, model.available_seats, model.seat_map).where(model.id == key)
+    ).first()
+    if row is None or row.seat_map is None:
+        return
+    bits = seatmap.release(seatmap.load(row.seat_map, row.total_seats), seat_numbers)
+    unnumbered = seats - len(seat_numbers)
+    if unnumbered > 0:
+        bits = seatmap.release(bits, _unnamed_seats(session, bus_id, trip_id, bits)[:unnumbered])
+    session.execute(
+        update(model).where(model.id == key).values(seat_map=seatmap.dump(bits, row.total_seats))
+        .execution_options(synchronize_session=False)
+    )
+
+def release_many(session, rows):
+    # rows: (bus_id, trip_id, seats, seat_numbers) of bookings/holds being
+    # given back; one release_seats per bus or trip however many rows there are
+    per_target = {}
+    for bus_id, trip_id, seats, numbers in rows:
+        if bus_id is None:
+            continue
+        entry = per_target.setdefault((bus_id, trip_id), [0, []])
+        entry[0] += seats or 0
+        entry[1].extend(seatmap.parse_seats(numbers))
+    for (bus_id, trip_id), (seats, numbers) in per_target.items():
+        release_seats(session, bus_id, seats, numbers, trip_id)
+
+# Transaction bodies. Each takes a session and leaves committing to the
+# caller, so the same code runs under run_in_transaction here and under
+# AsyncSession.run_sync in the JSON API.
+
+def tx_book(session, bus_id, user_id, seats, passenger_name, passenger_phone='', seat_numbers=None, trip_id=None):
+    numbers = reserve_seats(session, bus_id, seats, seat_numbers, trip_id)
+    booking = Booking(user_id=user_id, bus_id=bus_id, trip_id=trip_id, seats=seats,
+                      passenger_name=passenger_name, passenger_phone=passenger_phone,
+                      seat_numbers=seatmap.format_seats(numbers))
+    session.add(booking)
+    session.flush()
+    aggregates.record_booking(session, booking)
+    return booking.id
+
+def tx_hold(session, bus_id, user_id, seats, passenger_name, passenger_phone='', seat_numbers=None, ttl=None,
+            trip_id=None):
+    # returns (hold_id, seat numbers, expires_at)
+    numbers = reserve_seats(session, bus_id, seats, seat_numbers, trip_id)
+    expires_at = datetime.utcnow() + timedelta(seconds=config.HOLD_TTL_SECONDS if ttl is None else ttl)
+    hold = SeatHold(bus_id=bus_id, trip_id=trip_id, user_id=user_id, seats=seats, seat_numbers=seatmap.format_seats(numbers),
+                    passenger_name=passenger_name, passenger_phone=passenger_phone, expires_at=expires_at)
+    session.add(hold)
+    session.flush()
+    return hold.id, numbers, expires_at
+
+def _claim_hold(session, hold_id, user_id, new_status, unexpired):
+    # Move a hold out of 'held' with one conditional UPDATE, so confirm and
+    # release can never both win. Returns the hold, or None.
+    q = update(SeatHold).where(SeatHold.id == hold_id, SeatHold.status == 'held')
+    if user_id is not None:
+        q = q.where(SeatHold.user_id == user_id)
+    if unexpired:
+        q = q.where(SeatHold.expires_at > datetime.utcnow())
+    if session.execute(q.values(status=new_status)).rowcount != 1:
+        return None
+    return session.get(SeatHold, hold_id)
+
+def tx_confirm(session, hold_id, user_id=None):
+    # turn a live hold into a Booking; returns the booking id or None
+    hold = _claim_hold(session, hold_id, user_id, 'confirmed', unexpired=True)
+    if hold is None:
+        return None
+    booking = Booking(user_id=hold.user_id, bus_id=hold.bus_id, trip_id=hold.trip_id, seats=hold.seats,
+                      passenger_name=hold.passenger_name, passenger_phone=hold.passenger_phone,
+                      seat_numbers=hold.seat_numbers)
+    session.add(booking)
+    session.flush()
+    aggregates.record_booking(session, booking)
+    hold.booking_id = booking.id
+    return booking.id
+
+def tx_release(session, hold_id, user_id=None):
+    # give a held hold's seats back; returns the bus id or None
+    hold = _claim_hold(session, hold_id, user_id, 'released', unexpired=False)
+    if hold is None:
+        return None
+    release_seats(session, hold.bus_id, hold.seats, seatmap.parse_seats(hold.seat_numbers), hold.trip_id)
+    return hold.bus_id
+
+# Cancellation is set-based: the affected bookings are read once, flipped to
+# 'cancelled' with one UPDATE per bus (or per chunk of ids) that also computes
+# the refund from the fare, and seats go back with one release per bus. A
+# booking made or cancelled concurrently shows up as a rowcount mismatch and
+# the whole transaction is retried.
+
+CANCEL_CHUNK = 500
+
+def _refund(percent):
+    # whole rupees, rounded down; the same sum tx_cancel reports
+    fare = select(Bus.fare).where(Bus.id == Booking.bus_id).scalar_subquery()
+    return func.coalesce(fare, 0) * Booking.seats * percent // 100
+
+def tx_cancel(session, booking_ids=None, bus_id=None, user_id=None, refund_percent=100):
+    # Cancel active bookings by id or every active booking on a bus (only the
+    # user's own if user_id is given). Returns (bookings cancelled, total refund).
+    active = [Booking.status == 'active']
+    if user_id is not None:
+        active.append(Booking.user_id == user_id)
+    if bus_id is not None:
+        batches = [active + [Booking.bus_id == bus_id]]
+    else:
+        ids = sorted(set(booking_ids or ()))
+        batches = [active + [Booking.id.in_(ids[i:i + CANCEL_CHUNK])] for i in range(0, len(ids), CANCEL_CHUNK)]
+    rows = []
+    for where in batches:
+        rows.extend(session.execute(
+            select(Booking.bus_id, Booking.trip_id, Booking.seats, Booking.seat_numbers, Booking.booked_at, Bus.fare)
+            .outerjoin(Bus, Booking.bus_id == Bus.id).where(*where)
+        ).all())
+    if not rows:
+        return 0, 0
+    values = dict(status='cancelled', cancelled_at=datetime.utcnow(), refund_amount=_refund(refund_percent))
+    cancelled = sum(session.execute(update(Booking).where(*where).values(**values)
+                                    .execution_options(synchronize_session=False)).rowcount
+                    for where in batches)
+    if cancelled != len(rows):
+        raise Conflict()
+    release_many(session, ((r.bus_id, r.trip_id, r.seats, r.seat_numbers) for r in rows))
+    aggregates.record(session, ((r.bus_id, r.booked_at, -1, -r.seats, -r.seats * (r.fare or 0)) for r in rows))
+    return cancelled, sum((r.fare or 0) * r.seats * refund_percent // 100 for r in rows)
+
+def tx_edit_bus(session, bus_id, name, route, total_seats=None, fare=None, depart_time=None):
+    # Rename, reprice or resize a bus (None keeps a value). Seats sold so far
+    # come from the map; the recomputed counts are written with a compare-and-
+    # set on what was read, so a booking committed in between raises Conflict
+    # (and is retried) instead of being overwritten. Returns False if no bus.
+    row = session.execute(select(Bus.total_seats, Bus.available_seats, Bus.seat_map, Bus.fare)
+                          .where(Bus.id == bus_id)).first()
+    if row is None:
+        return False
+    total = total_seats or row.total_seats
+    available, seat_map = seatmap.resize(row.seat_map, row.total_seats, row.available_seats, total)
+    values = dict(name=name, route=route, total_seats=total, available_seats=available, seat_map=seat_map,
+                  fare=row.fare if fare is None else fare)
+    if depart_time is not None:
+        values['depart_time'] = depart_time
+    same_map = Bus.seat_map.is_(None) if row.seat_map is None else Bus.seat_map == row.seat_map
+    result = session.execute(
+        update(Bus).where(Bus.id == bus_id, Bus.total_seats == row.total_seats,
+                          Bus.available_seats == row.available_seats, same_map)
+        .values(**values).execution_options(synchronize_session=False)
+    )
+    if result.rowcount != 1:
+        raise Conflict()
+    # trips carry a copy of the route for the (route, service_date) index
+    session.execute(update(Trip).where(Trip.bus_id == bus_id).values(route=route)
+                    .execution_options(synchronize_session=False))
+    events.touch(session, bus_id)
+    return True
+
+def tx_deactivate_bus(session, bus_id):
+    # Soft delete: take the bus off sale, release its live holds and cancel its
+    # bookings with a full refund. The row stays so history keeps its name.
+    # Returns (bookings cancelled, total refund) or None if already inactive.
+    if session.execute(update(Bus).where(Bus.id == bus_id, Bus.is_active == True)
+                       .values(is_active=False)).rowcount != 1:
+        return None
+    held = session.execute(
+        select(SeatHold.id, SeatHold.bus_id, SeatHold.trip_id, SeatHold.seats, SeatHold.seat_numbers)
+        .where(SeatHold.bus_id == bus_id, SeatHold.status == 'held')
+    ).all()
+    if held:
+        released = session.execute(
+            update(SeatHold).where(SeatHold.bus_id == bus_id, SeatHold.status == 'held')
+            .values(status='released').execution_options(synchronize_session=False)
+        ).rowcount
+        if released != len(held):
+            raise Conflict()
+        release_many(session, ((h.bus_id, h.trip_id, h.seats, h.seat_numbers) for h in held))
+    return tx_cancel(session, bus_id=bus_id, refund_percent=100)
+
+def cancel_booking(booking_id, user_id=None, refund_percent=None):
+    # Returns the refund, or None if the booking is not active (or not the user's).
+    percent = config.CANCEL_REFUND_PERCENT if refund_percent is None else refund_percent
+    cancelled, refund = run_in_transaction(
+        lambda session: tx_cancel(session, booking_ids=[booking_id], user_id=user_id, refund_percent=percent))
+    if not cancelled:
+        return None
+    catalog.invalidate(routes=False)
+    return refund
+
+def cancel_bookings(booking_ids=None, bus_id=None, refund_percent=100):
+    # operator bulk cancel (route disruption); returns (bookings cancelled, total refund)
+    result = run_in_transaction(
+        lambda session: tx_cancel(session, booking_ids=booking_ids, bus_id=bus_id, refund_percent=refund_percent))
+    if result[0]:
+        catalog.invalidate(routes=False)
+    return result
+
+def delete_bus(bus_id):
+    # soft delete, see tx_deactivate_bus; returns (bookings cancelled, total refund) or None
+    result = run_in_transaction(lambda session: tx_deactivate_bus(session, bus_id))
+    if result is not None:
+        catalog.invalidate()
+    return result
+
+def edit_bus(bus_id, name, route, total_seats=None, fare=None, depart_time=None):
+    if not run_in_transaction(lambda session: tx_edit_bus(session, bus_id, name, route, total_seats, fare,
+                                                          depart_time)):
+        return False
+    catalog.invalidate()
+    return True
+
+def book_seats(bus_id, user_id, seats, passenger_name, passenger_phone='', seat_numbers=None, retries=None,
+               trip_id=None):
+    # Returns the new booking id, or None if the seats are not available.
+    if seat_numbers:
+        seats = len(set(seat_numbers))
+    if seats <= 0:
+        return None
+    try:
+        booking_id = run_in_transaction(
+            lambda session: tx_book(session, bus_id, user_id, seats, passenger_name, passenger_phone, seat_numbers,
+                                    trip_id),
+            retries)
+    except SeatsUnavailable:
+        return None
+    catalog.invalidate(routes=False)
+    return booking_id
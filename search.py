@@ -0,0 +1,119 @@
+import re
+from datetime import date
+import threading
+import time
+from sqlalchemy import select
+from models import SessionLocal, Bus
+from catalog import catalogue
+import queries
+import config
+
+# Origin/destination search over Bus.route.
+# Routes are free text ("Delhi - Agra - Jaipur", "Pune to Mumbai via Lonavala"),
+# so they are split into normalized stops and indexed stop -> {bus_id: position}.
+# A query intersects the two posting lists and keeps buses that reach the
+# origin before the destination.
+
+_STOP_SEPARATORS = re.compile(r'\s*(?:->|→|–|—|-|,|;|/|\|)\s*|\s+(?:to|via)\s+', re.I)
+
+def normalize_stop(name):
+    return ' '.join((name or '').lower().split())
+
+def parse_stops(route):
+    return [s for s in (normalize_stop(p) for p in _STOP_SEPARATORS.split(route or '')) if s]
+
+class RouteIndex:
+    def __init__(self, buses):
+        # buses: iterable of (bus_id, route)
+        self.postings = {}
+        self.routes = {}
+        self.size = 0
+        for bus_id, route in buses:
+            self.size += 1
+            self.routes[bus_id] = route
+            for position, stop in enumerate(parse_stops(route)):
+                self.postings.setdefault(stop, {}).setdefault(bus_id, position)
+
+    def lookup(self, origin=None, destination=None):
+        # bus ids serving origin -> destination, in id order; either end may be omitted
+        origin, destination = normalize_stop(origin), normalize_stop(destination)
+        if not origin and not destination:
+            return []
+        if not destination or not origin:
+            return sorted(self.postings.get(origin or destination, ()))
+        a = self.postings.get(origin)
+        b = self.postings.get(destination)
+        if not a or not b:
+            return []
+        # keys-view intersection runs in C and walks the shorter list; only
+        # the few common buses need their stop order checked
+        hits = [bus_id for bus_id in a.keys() & b.keys() if a[bus_id] < b[bus_id]]
+        hits.sort()
+        return hits
+
+_index = None
+_index_key = None
+_index_lock = threading.Lock()
+
+def _load_routes():
+    session = SessionLocal()
+    try:
+        return session.execute(select(Bus.id, Bus.route).where(Bus.is_active == True)).all()
+    finally:
+        session.close()
+
+def get_index():
+    # Rebuilt when buses are added/edited/deleted/imported in this process
+    # (catalogue route_version) or after the catalogue TTL, for other writers.
+    global _index, _index_key
+    key = catalogue.route_version
+    with _index_lock:
+        if _index is None or _index_key[0] != key or _index_key[1] < time.monotonic():
+            _index = RouteIndex(_load_routes())
+            _index_key = (key, time.monotonic() + config.CATALOGUE_CACHE_TTL)
+        return _index
+
+SEARCH_LIMIT = 200
+
+def search_buses(origin=None, destination=None, date=None, limit=SEARCH_LIMIT):
+    # Matching buses with fresh seat counts, fetched by primary key. `date`
+    # (YYYY-MM-DD) matches the start of the free-form depart_time.
+    ids = get_index().lookup(origin, destination)
+    if not ids:
+        return []
+    session = SessionLocal()
+    try:
+        rows = []
+        # chunk the id list to stay under bind parameter limits
+        for i in range(0, len(ids), 500):
+            rows.extend(queries.buses_by_ids(session, ids[i:i + 500], date))
+            if len(rows) >= limit:
+                break
+        return rows[:limit]
+    finally:
+        session.close()
+
+def search_trips(origin=None, destination=None, service_date=None, limit=SEARCH_LIMIT):
+    # Dated departures on one day (a date or YYYY-MM-DD string). The route
+    # index gives the matching buses' routes; trips are then read with the
+    # (route, service_date) index, so only that day's rows are touched.
+    if isinstance(service_date, str):
+        try:
+            service_date = date.fromisoformat(service_date)
+        except ValueError:
+            return []
+    if service_date is None:
+        return []
+    index = get_index()
+    routes = sorted({index.routes[bus_id] for bus_id in index.lookup(origin, destination)})
+    if not routes:
+        return []
+    session = SessionLocal()
+    try:
+        rows = []
+        for i in range(0, len(routes), 500):
+            rows.extend(queries.trips_on(session, routes[i:i + 500], service_date))
+        rows.sort(key=lambda t: (t.depart_at, t.id))
+        return rows[:limit]
+    finally:
+        session.close()
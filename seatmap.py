@@ -0,0 +1,96 @@
+# Per-bus seat maps.
+# A seat map is a bitset where bit i set means seat i+1 is taken. It is kept
+# as a Python int while working on it (bit ops run a machine word at a time)
+# and stored little-endian in Bus.seat_map. A NULL map means the bus predates
+# seat maps: the first total_seats - available_seats seats count as taken.
+
+def load(blob, total, available=None):
+    if blob is None:
+        taken = total - (total if available is None else available)
+        return (1 << max(0, taken)) - 1
+    return int.from_bytes(blob, 'little')
+
+def dump(bits, total):
+    length = max((total + 7) // 8, (bits.bit_length() + 7) // 8)
+    return bits.to_bytes(length, 'little')
+
+def mask(total):
+    return (1 << total) - 1
+
+def taken_count(bits):
+    return bits.bit_count()
+
+def available_count(bits, total):
+    # seats left after a resize; seats booked beyond the new total still count as sold
+    return max(0, total - taken_count(bits))
+
+def resize(blob, total, available, new_total):
+    # (available seats, stored map) of a bus or trip whose capacity changes
+    # from total to new_total
+    bits = load(blob, total, available)
+    return available_count(bits, new_total), dump(bits, new_total)
+
+def _numbers(bits):
+    seats = []
+    while bits:
+        low = bits & -bits
+        seats.append(low.bit_length())
+        bits ^= low
+    return seats
+
+def free_seats(bits, total):
+    return _numbers(~bits & mask(total))
+
+def taken_seats(bits):
+    return _numbers(bits)
+
+def _runs(free, n):
+    # bit i set in the result <=> seats i+1 .. i+n are all free
+    run, length = free, 1
+    while length * 2 <= n:
+        run &= run >> length
+        length *= 2
+    if length < n:
+        run &= run >> (n - length)
+    return run
+
+def reserve(bits, total, n=None, seats=None):
+    # Pick seats and return (new_bits, seat_numbers), or None if they are not
+    # available. With explicit seat numbers those exact seats are taken;
+    # otherwise the first block of n contiguous free seats, falling back to
+    # the n lowest free seats when no such block exists.
+    free = ~bits & mask(total)
+    if seats:
+        wanted = 0
+        for s in seats:
+            if s < 1 or s > total:
+                return None
+            wanted |= 1 << (s - 1)
+        if wanted & ~free or (n is not None and n != len(set(seats))):
+            return None
+        return bits | wanted, sorted(set(seats))
+    if not n or n < 1 or free.bit_count() < n:
+        return None
+    run = _runs(free, n)
+    if run:
+        start = (run & -run).bit_length() - 1
+        wanted = ((1 << n) - 1) << start
+    else:
+        wanted, rest = 0, free
+        for _ in range(n):
+            low = rest & -rest
+            wanted |= low
+            rest ^= low
+    return bits | wanted, _numbers(wanted)
+
+def release(bits, seats):
+    for s in seats:
+        bits &= ~(1 << (s - 1))
+    return bits
+
+def parse_seats(text):
+    # "3, 4,7" -> [3, 4, 7]; raises ValueError on junk
+    return [int(p) for p in (text or '').replace(' ', '').split(',') if p]
+
+def format_seats(seats):
+    return ','.join(str(s) for s in seats)
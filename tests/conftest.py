@@ -0,0 +1,52 @@
+import os
+import sys
+import tempfile
+import pytest
+
+# config reads the environment at import: point the app at a throwaway
+# database before anything imports models
+_dir = tempfile.mkdtemp(prefix='bus-tests-')
+os.environ['DATABASE_URL'] = 'sqlite:///' + os.path.join(_dir, 'test.db')
+os.environ['PASSWORD_HASH_METHOD'] = 'pbkdf2:sha256:1000'  # cheap hashes
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from models import Base, engine, init_db, SessionLocal, User, Bus
+import idempotency
+import catalog
+
+@pytest.fixture
+def db():
+    # a fresh schema per test, with two users and a 5-seat bus (id 1)
+    Base.metadata.drop_all(engine)
+    init_db()
+    idempotency.cache._entries.clear()
+    catalog.invalidate()
+    session = SessionLocal()
+    session.add_all([User(username='alice', password='x'), User(username='bob', password='x'),
+                     Bus(name='B1', route='Delhi - Agra', total_seats=5, available_seats=5, fare=100)])
+    session.commit()
+    session.close()
+    yield
+    engine.dispose()
+
+@pytest.fixture
+def baseline_db():
+    # the schema of the first release: users, buses and bookings only, with
+    # one user, a 10-seat bus and a booking of its first two seats
+    Base.metadata.drop_all(engine)
+    with engine.begin() as conn:
+        conn.exec_driver_sql("CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR(80) NOT NULL UNIQUE, "
+                             "password VARCHAR(256) NOT NULL, is_admin BOOLEAN)")
+        conn.exec_driver_sql("CREATE TABLE buses (id INTEGER PRIMARY KEY, name VARCHAR(120) NOT NULL, "
+                             "route VARCHAR(200) NOT NULL, total_seats INTEGER, available_seats INTEGER, "
+                             "fare INTEGER, depart_time VARCHAR(50), extra TEXT)")
+        conn.exec_driver_sql("CREATE TABLE bookings (id INTEGER PRIMARY KEY, user_id INTEGER REFERENCES users (id), "
+                             "bus_id INTEGER REFERENCES buses (id), seats INTEGER, booked_at DATETIME, "
+                             "passenger_name VARCHAR(120) NOT NULL, passenger_phone VARCHAR(50))")
+        conn.exec_driver_sql("INSERT INTO users VALUES (1, 'alice', 'x', 0)")
+        conn.exec_driver_sql("INSERT INTO buses VALUES (1, 'B1', 'Delhi - Agra', 10, 8, 100, NULL, NULL)")
+        conn.exec_driver_sql("INSERT INTO bookings VALUES (1, 1, 1, 2, '2026-01-05 10:00:00', 'alice', '')")
+    idempotency.cache._entries.clear()
+    catalog.invalidate()
+    yield
+    engine.dispose()
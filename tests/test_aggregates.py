@@ -0,0 +1,43 @@
+from sqlalchemy import delete, select
+from models import engine, init_db, SessionLocal, Bus, SalesDaily, SalesTotal
+import aggregates
+import holds
+import reservations
+
+def _tables():
+    with engine.connect() as conn:
+        daily = {(r.bus_id, r.day): (r.bookings, r.seats, r.revenue) for r in conn.execute(select(SalesDaily))
+                 if (r.bookings, r.seats, r.revenue) != (0, 0, 0)}
+        totals = {r.bus_id: (r.bookings, r.seats, r.revenue) for r in conn.execute(select(SalesTotal))
+                  if (r.bookings, r.seats, r.revenue) != (0, 0, 0)}
+    return daily, totals
+
+def _sales():
+    with SessionLocal() as session:
+        session.add(Bus(name='B2', route='Agra - Delhi', total_seats=5, available_seats=5, fare=30))
+        session.commit()
+    first = reservations.book_seats(1, 1, 2, 'alice')
+    reservations.book_seats(2, 2, 3, 'bob')
+    reservations.book_seats(1, 2, 1, 'bob')
+    holds.confirm_hold(holds.create_hold(2, 1, 1, 'alice')[0], 1)
+    reservations.cancel_booking(first, 1)
+
+def test_incremental_aggregates_equal_a_rebuild(db):
+    _sales()
+    incremental = _tables()
+    assert incremental[1] == {1: (1, 1, 100), 2: (2, 4, 120)}
+    assert aggregates.verify() == []
+    aggregates.rebuild()
+    assert _tables() == incremental
+
+def test_init_db_backfills_empty_aggregates(db):
+    _sales()
+    expected = _tables()
+    with engine.begin() as conn:
+        conn.execute(delete(SalesDaily))
+        conn.execute(delete(SalesTotal))
+    init_db()
+    assert _tables() == expected
+    reservations.book_seats(1, 1, 1, 'alice')
+    init_db()  # not rebuilt again: the new sale is counted once
+    assert _tables()[1][1] == (2, 2, 200)
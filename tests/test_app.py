@@ -0,0 +1,29 @@
+import os
+import subprocess
+import sys
+
+import app
+import holds
+import migrations
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def test_import_touches_no_database_and_starts_no_thread(tmp_path):
+    # sqlite creates the file on first connect, so a missing file means no query ran
+    path = tmp_path / 'never.db'
+    env = dict(os.environ, DATABASE_URL='sqlite:///' + str(path))
+    script = 'import threading, app; print(sorted(t.name for t in threading.enumerate()))'
+    out = subprocess.run([sys.executable, '-c', script], cwd=ROOT, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    assert out.strip() == "['MainThread']"
+    assert not path.exists()
+
+def test_first_request_checks_schema_and_starts_reaper(db, monkeypatch):
+    calls = []
+    monkeypatch.setattr(app, '_started', False)
+    monkeypatch.setattr(migrations, 'check', lambda: calls.append('check'))
+    monkeypatch.setattr(holds, 'start_reaper', lambda: calls.append('reaper'))
+    client = app.app.test_client()
+    client.get('/logout')
+    client.get('/logout')
+    assert calls == ['check', 'reaper']
@@ -0,0 +1,72 @@
+import threading
+import pytest
+from werkzeug.security import generate_password_hash
+from models import SessionLocal, User
+import auth
+import config
+
+def _set_password(value):
+    with SessionLocal() as session:
+        session.get(User, 1).password = value
+        session.commit()
+
+def _stored():
+    with SessionLocal() as session:
+        return session.get(User, 1).password
+
+def test_login_checks_the_password(db):
+    _set_password(auth.hash_password('secret'))
+    with SessionLocal() as session:
+        assert auth.authenticate(session, 'alice', 'secret').id == 1
+        assert auth.authenticate(session, 'alice', 'wrong') is None
+        assert auth.authenticate(session, 'nobody', 'secret') is None
+
+def test_old_hashes_and_plaintext_are_replaced_on_login(db):
+    for old in (generate_password_hash('secret', method='pbkdf2:sha256:500'), 'secret'):
+        _set_password(old)
+        with SessionLocal() as session:
+            assert auth.authenticate(session, 'alice', 'secret') is not None
+        assert _stored().startswith(config.PASSWORD_HASH_METHOD + '$')
+        assert not auth.needs_rehash(_stored())
+    current = _stored()
+    with SessionLocal() as session:
+        auth.authenticate(session, 'alice', 'secret')
+    assert _stored() == current
+
+def test_hashing_stays_on_the_auth_pool(db, monkeypatch):
+    _set_password(generate_password_hash('secret', method='pbkdf2:sha256:500'))
+    auth._reference_hash.cache_clear()
+    threads = []
+    hash_password = auth.hash_password
+    monkeypatch.setattr(auth, 'hash_password', lambda pw: threads.append(threading.current_thread().name)
+                        or hash_password(pw))
+    with SessionLocal() as session:
+        assert auth.authenticate(session, 'alice', 'secret') is not None
+        assert auth.authenticate(session, 'nobody', 'secret') is None
+    assert threads and all(name.startswith('auth') for name in threads)
+
+def test_token_bucket_throttles_per_key():
+    bucket = auth.TokenBucket(rate=0, burst=2)
+    assert bucket.allow('a') and bucket.allow('a')
+    assert not bucket.allow('a')
+    assert bucket.allow('b')
+
+def test_throttled_before_any_hashing(db, monkeypatch):
+    monkeypatch.setattr(auth, 'user_buckets', auth.TokenBucket(rate=0, burst=1))
+    monkeypatch.setattr(auth, 'run', lambda *a: pytest.fail('hashed while throttled'))
+    with SessionLocal() as session:
+        auth.user_buckets.allow('alice')
+        with pytest.raises(auth.Throttled):
+            auth.authenticate(session, 'Alice', 'secret')
+
+def test_saturated_pool_is_busy_not_queued():
+    release = threading.Event()
+    held = [auth.submit(release.wait) for _ in range(config.AUTH_WORKERS + config.AUTH_QUEUE)]
+    try:
+        with pytest.raises(auth.Busy):
+            auth.submit(lambda: None)
+    finally:
+        release.set()
+    for future in held:
+        future.result(5)
+    assert auth.run(lambda: 42) == 42
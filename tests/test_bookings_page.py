@@ -0,0 +1,46 @@
+import pytest
+from datetime import datetime, timedelta
+from sqlalchemy import inspect
+from models import engine, init_db, SessionLocal, Booking
+import queries
+
+def _bookings(n, start=datetime(2026, 1, 1)):
+    with SessionLocal() as session:
+        for i in range(n):
+            # pairs share a timestamp, so the id tiebreak matters
+            session.add(Booking(user_id=1 + i % 2, bus_id=1, seats=1, passenger_name=f'p{i}',
+                                booked_at=start + timedelta(hours=i // 2)))
+        session.commit()
+
+def _walk(session, **filters):
+    ids, after = [], None
+    while True:
+        rows, cursor = queries.bookings_page(session, after=after, limit=3, **filters)
+        ids += [r.id for r in rows]
+        if cursor is None:
+            return ids
+        after = queries.parse_cursor(cursor)
+
+def test_pages_cover_every_booking_once_newest_first(db):
+    _bookings(10)
+    with SessionLocal() as session:
+        ids = _walk(session)
+        expected = [b.id for b in session.query(Booking).order_by(Booking.booked_at.desc(), Booking.id.desc())]
+    assert ids == expected and len(ids) == 10
+
+def test_filters_apply_to_every_page(db):
+    _bookings(10)
+    with SessionLocal() as session:
+        assert len(_walk(session, username='bob')) == 5
+        assert len(_walk(session, date_from=datetime(2026, 1, 1, 2), date_to=datetime(2026, 1, 1, 4))) == 4
+
+def test_cursor_round_trip():
+    assert queries.parse_cursor('2026-01-01T05:00:00_7') == (datetime(2026, 1, 1, 5), 7)
+    assert queries.parse_cursor(None) is None
+    with pytest.raises(ValueError):
+        queries.parse_cursor('junk')
+
+def test_init_db_adds_listing_indexes_to_old_tables(baseline_db):
+    init_db()
+    assert {'ix_bookings_booked_at', 'ix_bookings_bus_booked_at', 'ix_bookings_user_booked_at'} <= \
+        {i['name'] for i in inspect(engine).get_indexes('bookings')}
@@ -0,0 +1,76 @@
+from sqlalchemy import update
+from models import SessionLocal, Bus, Booking
+import reservations
+
+def _bus(**values):
+    with SessionLocal() as session:
+        session.execute(update(Bus).where(Bus.id == 1).values(**values))
+        session.commit()
+
+def test_refund_is_rounded_down_and_stored_as_reported(db):
+    _bus(fare=55)
+    booking_id = reservations.book_seats(1, 1, 1, 'alice')
+    assert reservations.cancel_booking(booking_id, 1, refund_percent=50) == 27
+    with SessionLocal() as session:
+        booking = session.get(Booking, booking_id)
+        assert (booking.status, booking.refund_amount) == ('cancelled', 27)
+        assert booking.cancelled_at is not None
+        assert session.get(Bus, 1).available_seats == 5
+
+def test_cancel_only_once_and_only_own(db):
+    booking_id = reservations.book_seats(1, 1, 2, 'alice')
+    assert reservations.cancel_booking(booking_id, 2) is None
+    assert reservations.cancel_booking(booking_id, 1, refund_percent=100) == 200
+    assert reservations.cancel_booking(booking_id, 1) is None
+
+def test_bulk_cancel_and_delete_bus(db):
+    ids = [reservations.book_seats(1, 1, 1, f'p{i}') for i in range(3)]
+    assert reservations.cancel_bookings(booking_ids=ids[:2], refund_percent=10) == (2, 20)
+    assert reservations.delete_bus(1) == (1, 100)
+    assert reservations.delete_bus(1) is None
+    with SessionLocal() as session:
+        bus = session.get(Bus, 1)
+        assert (bus.is_active, bus.available_seats) == (False, 5)
+    assert reservations.book_seats(1, 1, 1, 'alice') is None
+
+def _legacy_booking():
+    # a bus of 10 with a booking of 2 made before seat maps: no seat numbers, no map
+    _bus(total_seats=10, available_seats=8, seat_map=None)
+    with SessionLocal() as session:
+        session.add(Booking(id=1, user_id=1, bus_id=1, seats=2, passenger_name='alice'))
+        session.commit()
+
+def test_cancelled_legacy_booking_frees_its_seats(db):
+    _legacy_booking()
+    assert reservations.book_seats(1, 1, 1, 'bob') is not None
+    assert reservations.cancel_booking(1, 1) is not None
+    with SessionLocal() as session:
+        assert session.get(Bus, 1).available_seats == 9
+    assert reservations.book_seats(1, 1, 9, 'carol') is not None
+    reservations.edit_bus(1, 'B1', 'Delhi - Agra')
+    with SessionLocal() as session:
+        assert session.get(Bus, 1).available_seats == 0
+
+def test_legacy_seats_freed_are_not_someone_elses(db):
+    _legacy_booking()
+    assert reservations.book_seats(1, 1, 1, 'bob', seat_numbers=[1]) is None  # the legacy booking's
+    named = reservations.book_seats(1, 1, 2, 'bob', seat_numbers=[5, 6])
+    reservations.cancel_booking(1, 1)
+    with SessionLocal() as session:
+        assert session.get(Bus, 1).available_seats == 8
+    # seats 5 and 6 stay taken, 1 and 2 are free again
+    assert reservations.book_seats(1, 1, 1, 'carol', seat_numbers=[5]) is None
+    assert reservations.book_seats(1, 1, 2, 'carol', seat_numbers=[1, 2]) is not None
+    assert named is not None
+
+def test_cancel_redirects_to_the_users_list(db):
+    import migrations
+    migrations.upgrade(log=lambda msg: None)
+    from app import app
+    booking_id = reservations.book_seats(1, 2, 1, 'bob')
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '2'
+    response = client.post(f'/booking/{booking_id}/cancel', headers={'Referer': 'https://elsewhere.example/'})
+    assert response.status_code == 302
+    assert response.location.endswith('/my_bookings')
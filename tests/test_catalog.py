@@ -0,0 +1,48 @@
+from models import SessionLocal, Bus
+from catalog import CatalogueCache
+import catalog
+import reservations
+
+def test_cache_serves_until_invalidated():
+    cache = CatalogueCache(ttl=60, max_entries=4)
+    loads = []
+    loader = lambda: loads.append(1) or len(loads)
+    assert cache.get('k', loader) == 1
+    assert cache.get('k', loader) == 1
+    cache.invalidate()
+    assert cache.get('k', loader) == 2
+    assert cache.stats()['hits'] == 1 and cache.stats()['misses'] == 2
+
+def test_expired_entry_reloads():
+    cache = CatalogueCache(ttl=0, max_entries=4)
+    assert cache.get('k', lambda: 1) == 1
+    assert cache.get('k', lambda: 2) == 2
+
+def test_value_loaded_across_an_invalidation_is_not_kept():
+    cache = CatalogueCache(ttl=60, max_entries=4)
+    def loader():
+        cache.invalidate()  # a write lands while the catalogue is being read
+        return 'stale'
+    assert cache.get('k', loader) == 'stale'
+    assert cache.get('k', lambda: 'fresh') == 'fresh'
+
+def test_oldest_entries_are_dropped():
+    cache = CatalogueCache(ttl=60, max_entries=2)
+    for key in 'abc':
+        cache.get(key, lambda: key)
+    assert cache.stats()['entries'] == 2
+    assert cache.get('a', lambda: 'reloaded') == 'reloaded'
+
+def test_booking_invalidates_seats_but_not_routes(db):
+    assert catalog.list_buses()[0].available_seats == 5
+    routes = catalog.catalogue.route_version
+    reservations.book_seats(1, 1, 2, 'alice')
+    assert catalog.list_buses()[0].available_seats == 3
+    assert catalog.catalogue.route_version == routes
+
+def test_bus_edit_invalidates_routes(db):
+    catalog.list_buses()
+    routes = catalog.catalogue.route_version
+    reservations.edit_bus(1, 'B1', 'Delhi - Jaipur')
+    assert catalog.catalogue.route_version == routes + 1
+    assert catalog.list_buses()[0].route == 'Delhi - Jaipur'
@@ -0,0 +1,55 @@
+import json
+import pytest
+from models import SessionLocal
+import events
+import reservations
+
+@pytest.fixture
+def feed(monkeypatch):
+    # a feed with one listener and no flusher thread, so the test reads what is marked
+    feed = events.AvailabilityFeed(60)
+    sub = events.Subscription(4)
+    feed._subscribers.add(sub)
+    monkeypatch.setattr(events, 'feed', feed)
+    return feed, sub
+
+def test_sale_is_published_only_after_commit(db, feed):
+    feed, _ = feed
+    with SessionLocal() as session:
+        reservations.reserve_seats(session, 1, 2)
+        assert feed._dirty_buses == set()
+        session.commit()
+    assert feed._dirty_buses == {1}
+    assert feed._read(feed._dirty_buses, set()) == {'buses': {1: [3, 5]}, 'trips': {}}
+
+def test_rollback_publishes_nothing(db, feed):
+    feed, _ = feed
+    with SessionLocal() as session:
+        reservations.reserve_seats(session, 1, 2)
+        session.rollback()
+        # a later commit in the same session does not pick up the rolled back change
+        session.commit()
+    assert feed._dirty_buses == set()
+    assert feed._dirty_trips == set()
+
+def test_slow_subscriber_gets_resync():
+    sub = events.Subscription(2)
+    for i in range(3):
+        sub.put({'buses': {1: [i, 5]}, 'trips': {}})
+    assert sub.get(timeout=0) is events.RESYNC
+    assert sub.get(timeout=0) is None
+    sub.put({'buses': {}, 'trips': {}})
+    assert sub.get(timeout=0) == {'buses': {}, 'trips': {}}
+
+def test_sse_stream_format():
+    sub = events.Subscription(4)
+    sub.put({'buses': {1: [3, 5]}, 'trips': {}})
+    sub.put(events.RESYNC)
+    stream = events.sse_stream(sub, heartbeat=0)
+    assert next(stream) == 'retry: 3000\n\n'
+    data = next(stream)
+    assert data.startswith('data: ') and data.endswith('\n\n')
+    assert events._parse(data[6:]) == {'buses': {1: [3, 5]}, 'trips': {}}
+    assert json.loads(data[6:]) == {'buses': {'1': [3, 5]}, 'trips': {}}
+    assert next(stream) == 'event: resync\ndata: {}\n\n'
+    assert next(stream) == ': keepalive\n\n'
@@ -0,0 +1,24 @@
+import csv
+import gzip
+import io
+import reservations
+import utils
+
+def test_export_streams_in_chunks(db):
+    for i in range(5):
+        reservations.book_seats(1, 1, 1, f'p{i}')
+    chunks = list(utils.iter_bookings_csv(chunk_rows=2))
+    assert len(chunks) == 3
+    rows = list(csv.reader(io.StringIO(''.join(chunks))))
+    assert rows[0] == utils.EXPORT_HEADER
+    assert [r[4] for r in rows[1:]] == [f'p{i}' for i in range(5)]
+    assert rows[1][1:4] == ['alice', 'B1', '1'] and rows[1][8] == 'active'
+
+def test_empty_export_is_just_the_header(db):
+    assert utils.export_bookings_csv().splitlines() == [','.join(utils.EXPORT_HEADER)]
+
+def test_gzip_stream_decompresses_to_the_csv(db, tmp_path):
+    reservations.book_seats(1, 1, 2, 'alice')
+    path = tmp_path / 'bookings.csv.gz'
+    utils.write_bookings_csv(path, compress=True)
+    assert gzip.decompress(path.read_bytes()).decode('utf-8') == utils.export_bookings_csv()
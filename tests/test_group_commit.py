@@ -0,0 +1,35 @@
+import pytest
+from models import SessionLocal, Bus, SeatHold
+from group_commit import GroupCommitWriter
+import reservations
+
+def _hold(seat_numbers):
+    return lambda session: reservations.tx_hold(session, 1, 1, len(seat_numbers), 'alice',
+                                                seat_numbers=seat_numbers)[0]
+
+def _fail(session):
+    reservations.tx_hold(session, 1, 1, 1, 'alice', seat_numbers=[5])
+    raise ValueError('body failed after writing')
+
+def test_failed_request_rolls_back_only_its_savepoint(db):
+    writer = GroupCommitWriter(max_batch=10, wait=0.5, max_queue=10, refresh=0)
+    futures = [writer.submit(1, None, 1, _hold([1])),
+               writer.submit(1, None, 1, _hold([1])),   # seat 1 is gone by now
+               writer.submit(1, None, 1, _fail),
+               writer.submit(1, None, 2, _hold([2, 3]))]
+    first, taken, failed, last = (f.exception(5) or f.result() for f in futures)
+    assert writer.snapshot()['batches'] == 1
+    assert writer.snapshot()['committed'] == 2
+    assert isinstance(taken, reservations.SeatsUnavailable)
+    assert isinstance(failed, ValueError)
+    with SessionLocal() as session:
+        assert session.get(Bus, 1).available_seats == 2
+        assert sorted(h.seat_numbers for h in session.query(SeatHold)) == ['1', '2,3']
+        assert {h.id for h in session.query(SeatHold)} == {first, last}
+
+def test_counter_rejects_sold_out_target(db):
+    writer = GroupCommitWriter(max_batch=10, wait=0, max_queue=10, refresh=60)
+    writer.run(1, None, 5, _hold([1, 2, 3, 4, 5]), timeout=5)
+    with pytest.raises(reservations.SeatsUnavailable):
+        writer.run(1, None, 1, _hold([1]), timeout=5)
+    assert writer.snapshot()['rejected'] == 1
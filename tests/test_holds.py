@@ -0,0 +1,54 @@
+import threading
+from datetime import datetime, timedelta
+from sqlalchemy import update
+from models import SessionLocal, Bus, Booking, SeatHold
+import holds
+
+def _available():
+    with SessionLocal() as session:
+        return session.get(Bus, 1).available_seats
+
+def test_concurrent_holds_never_oversell(db):
+    made = [None] * 10
+    start = threading.Barrier(10)
+    def worker(i):
+        start.wait()
+        made[i] = holds.create_hold(1, 1, 1, f'p{i}')
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(10)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    seats = [h[1][0] for h in made if h is not None]
+    assert sorted(seats) == [1, 2, 3, 4, 5]
+    assert _available() == 0
+
+def test_confirm_turns_a_hold_into_a_booking(db):
+    hold_id, numbers, _ = holds.create_hold(1, 1, 2, 'alice')
+    booking_id = holds.confirm_hold(hold_id, 1)
+    assert holds.confirm_hold(hold_id, 1) is None
+    assert holds.release_hold(hold_id, 1) is False
+    with SessionLocal() as session:
+        assert session.get(Booking, booking_id).seat_numbers == '1,2'
+    assert _available() == 3
+
+def test_only_the_owner_confirms_or_releases(db):
+    hold_id = holds.create_hold(1, 1, 2, 'alice')[0]
+    assert holds.confirm_hold(hold_id, 2) is None
+    assert holds.release_hold(hold_id, 2) is False
+    assert holds.release_hold(hold_id, 1) is True
+    assert _available() == 5
+
+def test_expired_holds_give_their_seats_back(db):
+    kept = holds.create_hold(1, 1, 1, 'alice')[0]
+    gone = holds.create_hold(1, 1, 2, 'alice')[0]
+    with SessionLocal() as session:
+        session.execute(update(SeatHold).where(SeatHold.id == gone)
+                        .values(expires_at=datetime.utcnow() - timedelta(seconds=1)))
+        session.commit()
+    assert holds.confirm_hold(gone, 1) is None
+    assert holds.sweep() == 1
+    assert holds.expire_holds([kept, gone]) == 0
+    assert _available() == 4
+    # the freed seats are the expired hold's, 2 and 3
+    assert holds.create_hold(1, 1, 2, 'alice')[1] == [2, 3]
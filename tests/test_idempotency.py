@@ -0,0 +1,46 @@
+import pytest
+from sqlalchemy import select, func
+from models import SessionLocal, Bus, SeatHold, Booking
+import holds
+import idempotency
+
+def _available():
+    with SessionLocal() as session:
+        return session.get(Bus, 1).available_seats
+
+def test_replayed_hold_takes_seats_once(db):
+    first = holds.create_hold(1, 1, 2, 'alice', idempotency_key='k1')
+    again = holds.create_hold(1, 1, 2, 'alice', idempotency_key='k1')
+    idempotency.cache._entries.clear()  # and once more from the database
+    stored = holds.create_hold(1, 1, 2, 'alice', idempotency_key='k1')
+    assert first == again == stored
+    assert _available() == 3
+    with SessionLocal() as session:
+        assert session.execute(select(func.count(SeatHold.id))).scalar() == 1
+
+def test_keys_are_per_user(db):
+    a = holds.create_hold(1, 1, 1, 'alice', idempotency_key='same')
+    b = holds.create_hold(1, 2, 1, 'bob', idempotency_key='same')
+    assert a[0] != b[0]
+    assert _available() == 3
+
+def test_failed_attempt_stores_nothing(db):
+    assert holds.create_hold(1, 1, 6, 'alice', idempotency_key='k2') is None
+    assert holds.create_hold(1, 1, 2, 'alice', idempotency_key='k2') is not None
+    assert _available() == 3
+
+def test_replayed_confirm_books_once(db):
+    hold_id = holds.create_hold(1, 1, 2, 'alice')[0]
+    booking_id = holds.confirm_hold(hold_id, 1, idempotency_key='c1')
+    idempotency.cache._entries.clear()
+    assert holds.confirm_hold(hold_id, 1, idempotency_key='c1') == booking_id
+    with SessionLocal() as session:
+        assert session.execute(select(func.count(Booking.id))).scalar() == 1
+
+def test_key_reused_for_another_operation(db):
+    hold_id = holds.create_hold(1, 1, 1, 'alice', idempotency_key='k3')[0]
+    with pytest.raises(idempotency.KeyReused):
+        holds.confirm_hold(hold_id, 1, idempotency_key='k3')
+    idempotency.cache._entries.clear()
+    with pytest.raises(idempotency.KeyReused):
+        holds.confirm_hold(hold_id, 1, idempotency_key='k3')
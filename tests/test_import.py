@@ -0,0 +1,60 @@
+import io
+from datetime import date, datetime
+from models import SessionLocal, Bus, Trip
+import events
+import reservations
+import seatmap
+import utils
+
+def _csv(*lines):
+    return io.BytesIO(('name,route,total_seats,fare,depart_time,extra\n' + '\n'.join(lines) + '\n').encode('utf-8'))
+
+def test_bad_rows_are_reported_and_skipped(db):
+    result = utils.import_buses_csv(_csv('X1,A - B,30,10,08:00,', 'X2,A - B,lots,10,,', 'X3,A - B,-1,10,,',
+                                         'X4,A - B,20,-5,,', 'X5,A - B,,,,'))
+    assert (result.inserted, result.failed) == (2, 3)
+    assert [line for line, _ in result.errors] == [3, 4, 5]
+    assert 'not a number' in result.errors[0][1]
+    with SessionLocal() as session:
+        assert session.query(Bus).filter(Bus.name == 'X5').one().total_seats == 40
+
+def test_chunks_commit_independently(db):
+    result = utils.import_buses_csv(_csv(*(f'C{i},A - B,10,1,,' for i in range(7))), chunk_rows=3)
+    assert result.inserted == 7
+    with SessionLocal() as session:
+        assert session.query(Bus).count() == 8
+
+def test_upsert_resizes_from_the_seat_map(db):
+    reservations.book_seats(1, 1, 1, 'alice', seat_numbers=[4])
+    reservations.book_seats(1, 1, 1, 'alice', seat_numbers=[1])
+    result = utils.import_buses_csv(_csv('B1,Delhi - Jaipur,3,120,,'), upsert=True)
+    assert (result.inserted, result.updated) == (0, 1)
+    with SessionLocal() as session:
+        bus = session.get(Bus, 1)
+        bits = seatmap.load(bus.seat_map, bus.total_seats)
+        assert (bus.total_seats, bus.route, bus.fare) == (3, 'Delhi - Jaipur', 120)
+        # seat 4 is beyond the new capacity but still sold: one seat left, not two
+        assert seatmap.taken_seats(bits) == [1, 4]
+        assert bus.available_seats == seatmap.available_count(bits, 3) == 1
+    assert reservations.book_seats(1, 1, 1, 'alice') is not None
+    assert reservations.book_seats(1, 1, 1, 'alice') is None
+
+def test_upsert_updates_trip_routes_and_skips_deleted_buses(db):
+    with SessionLocal() as session:
+        session.add(Bus(name='Gone', route='A - B', total_seats=5, available_seats=5, depart_time='', is_active=False))
+        session.add(Trip(bus_id=1, route='Delhi - Agra', service_date=date(2026, 1, 1),
+                         depart_at=datetime(2026, 1, 1, 9), total_seats=5, available_seats=5))
+        session.commit()
+    result = utils.import_buses_csv(_csv('B1,Delhi - Goa,5,100,,', 'Gone,A - B,5,1,,'), upsert=True)
+    assert (result.inserted, result.updated) == (1, 1)
+    with SessionLocal() as session:
+        assert session.query(Trip).one().route == 'Delhi - Goa'
+        assert session.query(Bus).filter(Bus.name == 'Gone').count() == 2
+
+def test_inserted_and_updated_buses_are_published(db, monkeypatch):
+    published = []
+    monkeypatch.setattr(events, 'publish', lambda bus_ids=(), trip_ids=(): published.extend(bus_ids))
+    utils.import_buses_csv(_csv('B1,Delhi - Agra,5,100,,', 'New,A - B,5,1,,'), upsert=True)
+    with SessionLocal() as session:
+        new_id = session.query(Bus).filter(Bus.name == 'New').one().id
+    assert sorted(published) == [1, new_id]
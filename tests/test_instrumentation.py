@@ -0,0 +1,36 @@
+from flask import Flask
+from flask_login import LoginManager
+from models import engine
+import config
+import instrumentation
+
+def _client():
+    app = Flask(__name__)
+    app.config['SECRET_KEY'] = 'test'
+    LoginManager(app)
+    instrumentation.install(app, engine, lambda: [('test_gauge', 'gauge', 7, 'A gauge.')])
+
+    @app.route('/ping')
+    def ping():
+        with engine.connect() as conn:
+            conn.exec_driver_sql('SELECT 1')
+        return 'pong'
+    return app.test_client()
+
+def test_requests_get_server_timing(db):
+    response = _client().get('/ping')
+    assert response.data == b'pong'
+    assert 'desc="1 queries"' in response.headers['Server-Timing']
+
+def test_metrics_need_the_token(db, monkeypatch):
+    client = _client()
+    client.get('/ping')
+    monkeypatch.setattr(config, 'METRICS_TOKEN', '')
+    assert client.get('/metrics').status_code == 403
+    monkeypatch.setattr(config, 'METRICS_TOKEN', 's3cret')
+    assert client.get('/metrics').status_code == 403
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+    response = client.get('/metrics', headers={'Authorization': 'Bearer s3cret'})
+    assert response.status_code == 200
+    text = response.data.decode()
+    assert 'test_gauge 7' in text and 'endpoint="ping"' in text
@@ -0,0 +1,39 @@
+from sqlalchemy import inspect
+from models import engine, Base, SessionLocal, Bus, SalesTotal
+import migrations
+import reservations
+
+def _quiet(msg):
+    pass
+
+def test_upgrade_brings_the_first_release_to_head(baseline_db):
+    assert migrations.current_version() == 0
+    assert migrations.upgrade(log=_quiet) == [1, 2, 3]
+    assert migrations.current_version() == migrations.HEAD
+    migrations.check()
+    insp = inspect(engine)
+    for table in Base.metadata.sorted_tables:
+        assert {c.name for c in table.columns} <= {c['name'] for c in insp.get_columns(table.name)}
+        assert {i.name for i in table.indexes} <= {i['name'] for i in insp.get_indexes(table.name)}
+    with engine.connect() as conn:
+        sql = conn.exec_driver_sql("SELECT sql FROM sqlite_master WHERE name = 'trips'").scalar()
+    assert 'AUTOINCREMENT' in sql.upper()
+    with SessionLocal() as session:
+        assert session.get(SalesTotal, 1).seats == 2  # backfilled from the old booking
+    assert migrations.upgrade(log=_quiet) == []
+
+def test_upgraded_legacy_booking_frees_its_seats(baseline_db):
+    migrations.upgrade(log=_quiet)
+    assert reservations.book_seats(1, 1, 1, 'alice') is not None
+    assert reservations.cancel_booking(1, 1) is not None
+    assert reservations.book_seats(1, 1, 9, 'alice') is not None
+    reservations.edit_bus(1, 'B1', 'Delhi - Agra')
+    with SessionLocal() as session:
+        bus = session.get(Bus, 1)
+        assert (bus.available_seats, bus.total_seats) == (0, 10)
+
+def test_empty_database_is_created_at_head(baseline_db):
+    Base.metadata.drop_all(engine)
+    assert migrations.current_version() is None
+    migrations.check()
+    assert migrations.current_version() == migrations.HEAD
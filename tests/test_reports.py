@@ -0,0 +1,40 @@
+import json
+from datetime import date, datetime
+import pytest
+from models import SessionLocal, Bus, Booking
+import reports
+
+def _bookings():
+    with SessionLocal() as session:
+        session.add(Bus(id=2, name='B2', route='Agra - Delhi', total_seats=5, available_seats=5, fare=30))
+        rows = [(1, 2, datetime(2026, 10, 1, 9), 'alice', 'active'),
+                (1, 1, datetime(2026, 10, 2, 9), 'bob', 'active'),
+                (2, 3, datetime(2026, 10, 3, 18), 'alice', 'active'),
+                (2, 4, datetime(2026, 10, 3, 18), 'carol', 'cancelled'),
+                (None, 1, datetime(2026, 10, 4, 7), 'dave', 'active'),
+                (1, 5, datetime(2026, 11, 1, 9), 'erin', 'active')]
+        for bus_id, seats, booked_at, name, status in rows:
+            session.add(Booking(user_id=1, bus_id=bus_id, seats=seats, booked_at=booked_at, passenger_name=name,
+                                status=status))
+        session.commit()
+
+@pytest.mark.parametrize('use_numpy', [False, pytest.param(True, marks=pytest.mark.skipif(
+    reports.np is None, reason='numpy not installed'))])
+def test_month_report(db, use_numpy):
+    _bookings()
+    report = reports.build_report(*reports.month_range('2026-10'), chunk_rows=2, use_numpy=use_numpy)
+    rows = report.route_rows()
+    # busiest first, ties by route name
+    assert [r[:4] for r in rows] == [('Agra - Delhi', 1, 3, 90), ('Delhi - Agra', 2, 3, 300),
+                                     (reports.UNKNOWN_ROUTE, 1, 1, 0)]
+    assert rows[0][4][18] == 3 and rows[1][4][9] == 3
+    assert report.top_passengers(2) == [('alice', [5, 2]), ('bob', [1, 1])]
+    totals = json.loads(report.to_json())['totals']
+    assert totals == {'bookings': 4, 'seats': 7, 'revenue': 390}
+
+def test_month_range_and_csv(db):
+    assert reports.month_range('2026-12') == (date(2026, 12, 1), date(2027, 1, 1))
+    _bookings()
+    lines = reports.build_report(use_numpy=False).to_csv().splitlines()
+    assert lines[0].startswith('route,bookings,seats,revenue,h00')
+    assert lines[1].startswith('Delhi - Agra,3,8,800,')
@@ -0,0 +1,34 @@
+import threading
+from sqlalchemy import select, func
+from models import SessionLocal, Bus, Booking
+import reservations
+
+def _parallel(n, fn):
+    results = [None] * n
+    start = threading.Barrier(n)
+    def worker(i):
+        start.wait()
+        results[i] = fn(i)
+    threads = [threading.Thread(target=worker, args=(i,)) for i in range(n)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return results
+
+def _taken_seats(session):
+    numbers = []
+    for value in session.execute(select(Booking.seat_numbers)).scalars():
+        numbers.extend(value.split(','))
+    return numbers
+
+def test_concurrent_bookings_never_oversell(db):
+    booked = _parallel(12, lambda i: reservations.book_seats(1, 1 + i % 2, 1 + i % 2, f'p{i}'))
+    with SessionLocal() as session:
+        bus = session.get(Bus, 1)
+        seats = session.execute(select(func.sum(Booking.seats))).scalar()
+        taken = _taken_seats(session)
+    assert any(b is None for b in booked)
+    assert seats <= 5
+    assert bus.available_seats == 5 - seats
+    assert len(taken) == len(set(taken)) == seats
@@ -0,0 +1,32 @@
+from models import SessionLocal, Bus
+from search import RouteIndex, parse_stops, search_buses
+import reservations
+
+def test_routes_split_into_normalized_stops():
+    assert parse_stops('Delhi - Agra -> Jaipur') == ['delhi', 'agra', 'jaipur']
+    assert parse_stops('Pune to  Mumbai via Lonavala') == ['pune', 'mumbai', 'lonavala']
+    assert parse_stops('') == []
+
+def test_lookup_keeps_direction():
+    index = RouteIndex([(1, 'Delhi - Agra - Jaipur'), (2, 'Jaipur - Agra - Delhi'), (3, 'Agra, Mathura')])
+    assert index.lookup('delhi', 'JAIPUR') == [1]
+    assert index.lookup('Jaipur', 'delhi') == [2]
+    assert index.lookup('agra', None) == [1, 2, 3]
+    assert index.lookup(None, 'mathura') == [3]
+    assert index.lookup('delhi', 'mathura') == []
+    assert index.lookup() == []
+
+def test_search_sees_new_routes_and_deleted_buses(db):
+    assert [b.id for b in search_buses('delhi', 'agra')] == [1]
+    with SessionLocal() as session:
+        session.add(Bus(name='B2', route='Delhi - Mathura - Agra', total_seats=5, available_seats=5))
+        session.commit()
+    reservations.edit_bus(1, 'B1', 'Delhi - Agra')  # any bus write moves the route version
+    assert [b.id for b in search_buses('delhi', 'agra')] == [1, 2]
+    reservations.delete_bus(1)
+    assert [b.id for b in search_buses('delhi', 'agra')] == [2]
+
+def test_search_returns_current_seat_counts(db):
+    search_buses('delhi', 'agra')
+    reservations.book_seats(1, 1, 2, 'alice')
+    assert search_buses('delhi', 'agra')[0].available_seats == 3
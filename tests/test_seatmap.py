@@ -0,0 +1,48 @@
+from sqlalchemy import inspect
+from models import engine, init_db, SessionLocal, Bus, Booking
+import reservations
+import seatmap
+
+def test_reserve_takes_first_contiguous_block():
+    bits = seatmap.load(None, 10, 8)  # seats 1 and 2 taken
+    bits |= 1 << 3                    # and seat 4
+    new_bits, numbers = seatmap.reserve(bits, 10, 3)
+    assert numbers == [5, 6, 7]
+    assert seatmap.taken_seats(new_bits) == [1, 2, 4, 5, 6, 7]
+
+def test_reserve_falls_back_to_lowest_free_seats():
+    bits = 0b1010101  # seats 1, 3, 5, 7 taken
+    assert seatmap.reserve(bits, 8, 3)[1] == [2, 4, 6]
+    assert seatmap.reserve(bits, 8, 5) is None
+
+def test_reserve_named_seats():
+    bits = seatmap.load(None, 5, 5)
+    bits, numbers = seatmap.reserve(bits, 5, seats=[4, 2])
+    assert numbers == [2, 4]
+    assert seatmap.reserve(bits, 5, seats=[4]) is None
+    assert seatmap.reserve(bits, 5, seats=[6]) is None
+    assert seatmap.free_seats(bits, 5) == [1, 3, 5]
+
+def test_release_and_round_trip():
+    bits = seatmap.release(0b1111, [2, 3])
+    assert seatmap.taken_seats(bits) == [1, 4]
+    assert seatmap.load(seatmap.dump(bits, 20), 20) == bits
+    assert seatmap.available_count(bits, 20) == 18
+
+def test_parse_and_format_seats():
+    assert seatmap.parse_seats('4,5, 6') == [4, 5, 6]
+    assert seatmap.parse_seats(None) == []
+    assert seatmap.format_seats([4, 5, 6]) == '4,5,6'
+
+def test_named_seat_taken_once(db):
+    assert reservations.book_seats(1, 1, 1, 'a', seat_numbers=[3]) is not None
+    assert reservations.book_seats(1, 2, 1, 'b', seat_numbers=[3]) is None
+    with SessionLocal() as session:
+        assert session.get(Bus, 1).available_seats == 4
+        assert session.get(Booking, 1).seat_numbers == '3'
+
+def test_init_db_adds_seat_map_columns_to_old_tables(baseline_db):
+    init_db()
+    insp = inspect(engine)
+    assert 'seat_map' in {c['name'] for c in insp.get_columns('buses')}
+    assert 'seat_numbers' in {c['name'] for c in insp.get_columns('bookings')}
@@ -0,0 +1,66 @@
+from datetime import date, datetime, time, timedelta
+from models import engine, init_db, SessionLocal, Bus, Schedule, Trip, TripArchive
+import reservations
+import trips
+
+def test_archived_trip_ids_are_not_reused(db):
+    today = date.today()
+    with SessionLocal() as session:
+        session.add(Schedule(bus_id=1, depart_time='09:00', weekdays='0123456', start_date=today - timedelta(days=30)))
+        session.commit()
+    assert trips.generate_trips(days=3, start=today - timedelta(days=20)) == 3
+    assert trips.archive_trips(before=today) == 3
+    assert trips.generate_trips(days=3, start=today - timedelta(days=10)) == 3
+    with SessionLocal() as session:
+        archived = {t.id for t in session.query(TripArchive)}
+        live = {t.id for t in session.query(Trip)}
+    assert not archived & live
+    assert trips.archive_trips(before=today) == 3
+    with SessionLocal() as session:
+        assert session.query(TripArchive).count() == 6
+        assert session.query(Trip).count() == 0
+
+def test_generation_can_be_rerun(db):
+    today = date.today()
+    with SessionLocal() as session:
+        session.add(Schedule(bus_id=1, depart_time='09:00', weekdays='0123456', start_date=today))
+        session.commit()
+    assert trips.generate_trips(days=5) == 5
+    assert trips.generate_trips(days=5) == 0
+    with SessionLocal() as session:
+        assert [t.available_seats for t in session.query(Trip)] == [5] * 5
+
+def test_old_trips_table_is_rebuilt_without_reusing_ids(db):
+    # a trips table from before AUTOINCREMENT, with trip 3 already archived
+    with engine.begin() as conn:
+        conn.exec_driver_sql('DROP TABLE trips')
+        conn.exec_driver_sql('CREATE TABLE trips (id INTEGER PRIMARY KEY, bus_id INTEGER NOT NULL, '
+                             'schedule_id INTEGER, route VARCHAR(200) NOT NULL, service_date DATE NOT NULL, '
+                             'depart_at DATETIME NOT NULL, total_seats INTEGER NOT NULL, '
+                             'available_seats INTEGER NOT NULL, seat_map BLOB)')
+        conn.exec_driver_sql("INSERT INTO trips VALUES (1, 1, NULL, 'Delhi - Agra', '2026-01-01', "
+                             "'2026-01-01 09:00:00', 5, 5, NULL)")
+        conn.exec_driver_sql("INSERT INTO trips_archive VALUES (3, 1, NULL, 'Delhi - Agra', '2025-12-01', "
+                             "'2025-12-01 09:00:00', 5, 5, NULL)")
+    init_db()
+    init_db()
+    with SessionLocal() as session:
+        assert session.query(Trip).one().id == 1
+        session.add(Trip(bus_id=1, route='Delhi - Agra', service_date=date(2026, 1, 2),
+                         depart_at=datetime(2026, 1, 2, 9), total_seats=5, available_seats=5))
+        session.commit()
+        assert max(t.id for t in session.query(Trip)) == 4
+
+def test_trip_bookings_use_the_trips_seats(db):
+    with SessionLocal() as session:
+        trip = Trip(bus_id=1, route='Delhi - Agra', service_date=date.today(),
+                    depart_at=datetime.combine(date.today(), time(9)), total_seats=2, available_seats=2)
+        session.add(trip)
+        session.commit()
+        trip_id = trip.id
+    assert reservations.book_seats(1, 1, 2, 'alice', trip_id=trip_id) is not None
+    assert reservations.book_seats(1, 1, 1, 'alice', trip_id=trip_id) is None
+    assert reservations.book_seats(2, 1, 1, 'alice', trip_id=trip_id) is None  # not that bus's trip
+    with SessionLocal() as session:
+        assert session.get(Trip, trip_id).available_seats == 0
+        assert session.get(Bus, 1).available_seats == 5
@@ -0,0 +1,103 @@
+from datetime import date, datetime, time, timedelta
+from sqlalchemy import select, insert, delete
+from models import engine, Bus, Schedule, Trip, TripArchive
+import catalog
+import config
+
+# Trip generation and archiving. Both are set-based: generation computes the
+# departures in Python, reads which of them already exist with one query per
+# chunk and inserts the rest with executemany; archiving is one INSERT ...
+# SELECT plus one DELETE. Both can be re-run safely.
+
+GENERATE_CHUNK = 5000
+
+def parse_weekdays(value):
+    # "0123456", "0,2,4" or "mon,wed,fri" -> "024" (Monday=0)
+    names = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+    days = set()
+    for part in (value or '').replace(',', ' ').split():
+        part = part.strip().lower()[:3]
+        if part in names:
+            days.add(names.index(part))
+        elif part.isdigit():
+            days.update(int(d) for d in part if int(d) < 7)
+        else:
+            raise ValueError(f'bad weekday {part!r}')
+    if not days:
+        raise ValueError('no weekdays given')
+    return ''.join(str(d) for d in sorted(days))
+
+def parse_time(value):
+    hour, minute = value.strip().split(':')
+    return time(int(hour), int(minute))
+
+def _departures(schedule, start, end):
+    # schedule: row of _SCHEDULE_COLUMNS
+    depart = parse_time(schedule.depart_time)
+    first = max(start, schedule.start_date)
+    last = min(end, schedule.end_date) if schedule.end_date else end
+    weekdays = {int(d) for d in schedule.weekdays}
+    day = first
+    while day <= last:
+        if day.weekday() in weekdays:
+            yield {'bus_id': schedule.bus_id, 'schedule_id': schedule.id, 'route': schedule.route,
+                   'service_date': day, 'depart_at': datetime.combine(day, depart),
+                   'total_seats': schedule.total_seats, 'available_seats': schedule.total_seats}
+        day += timedelta(days=1)
+
+_SCHEDULE_COLUMNS = (Schedule.id, Schedule.bus_id, Schedule.depart_time, Schedule.weekdays, Schedule.start_date,
+                     Schedule.end_date, Bus.route, Bus.total_seats)
+
+def _insert_missing(conn, rows):
+    # uq_trips_bus_depart_at would reject duplicates anyway; filtering first
+    # keeps one existing trip from failing the whole batch
+    bus_ids = list({r['bus_id'] for r in rows})
+    first, last = min(r['depart_at'] for r in rows), max(r['depart_at'] for r in rows)
+    existing = set(conn.execute(
+        select(Trip.bus_id, Trip.depart_at)
+        .where(Trip.bus_id.in_(bus_ids), Trip.depart_at >= first, Trip.depart_at <= last)
+    ).all())
+    rows = [r for r in rows if (r['bus_id'], r['depart_at']) not in existing]
+    if rows:
+        conn.execute(insert(Trip), rows)
+    return len(rows)
+
+def generate_trips(days=None, start=None, schedule_ids=None):
+    # Create the trips of active schedules for `days` days from `start`
+    # (today). Returns the number of trips created.
+    start = start or date.today()
+    end = start + timedelta(days=(config.TRIP_HORIZON_DAYS if days is None else days) - 1)
+    created = 0
+    with engine.begin() as conn:
+        q = (select(*_SCHEDULE_COLUMNS).join(Bus, Schedule.bus_id == Bus.id)
+             .where(Schedule.is_active == True, Bus.is_active == True))
+        if schedule_ids:
+            q = q.where(Schedule.id.in_(schedule_ids))
+        chunk = []
+        for schedule in conn.execute(q).all():
+            for row in _departures(schedule, start, end):
+                chunk.append(row)
+                if len(chunk) >= GENERATE_CHUNK:
+                    created += _insert_missing(conn, chunk)
+                    chunk = []
+        if chunk:
+            created += _insert_missing(conn, chunk)
+    if created:
+        catalog.invalidate(routes=False)
+    return created
+
+_ARCHIVE_COLUMNS = ('id', 'bus_id', 'schedule_id', 'route', 'service_date', 'depart_at', 'total_seats',
+                    'available_seats', 'seat_map')
+
+def archive_trips(before=None):
+    # Move trips that ran before `before` (default: TRIP_ARCHIVE_AFTER_DAYS
+    # ago) into trips_archive. Returns the number moved.
+    before = before or date.today() - timedelta(days=config.TRIP_ARCHIVE_AFTER_DAYS)
+    with engine.begin() as conn:
+        moved = conn.execute(
+            insert(TripArchive).from_select(
+                _ARCHIVE_COLUMNS,
+                select(*(Trip.__table__.c[name] for name in _ARCHIVE_COLUMNS)).where(Trip.service_date < before))
+        ).rowcount
+        conn.execute(delete(Trip).where(Trip.service_date < before))
+    return moved
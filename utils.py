@@ -1,47 +1,198 @@
-from werkzeug.security import generate_password_hash, check_password_hash
-from models import SessionLocal, Bus, Booking, User
+from models import SessionLocal, engine, Bus, Booking, User, Trip
+import catalog
+import events
+import auth
+import seatmap
+from sqlalchemy import select, insert, update, bindparam, func
+import codecs
 import csv
 import io
+import zlib
 
 def hash_password(pw):
-    return generate_password_hash(pw)
+    return auth.hash_password(pw)
 
 def verify_password(hash_pw, pw):
-    return check_password_hash(hash_pw, pw)
+    return auth.verify_password(hash_pw, pw)
 
 # File handling: export bookings to CSV
-def export_bookings_csv():
+EXPORT_CHUNK_ROWS = 1000
+EXPORT_HEADER = ['id','user','bus','seats','passenger_name','passenger_phone','booked_at','seat_numbers',
+                 'status','cancelled_at','refund_amount']
+
+def iter_bookings_csv(chunk_rows=EXPORT_CHUNK_ROWS):
+    # Yields the bookings CSV as text chunks of at most chunk_rows rows. One
+    # joined query streamed with a server-side cursor (yield_per), so memory
+    # stays flat however big the table is.
     session = SessionLocal()
-    bookings = session.query(Booking).all()
-    output = io.StringIO()
-    writer = csv.writer(output)
-    writer.writerow(['id','user','bus','seats','passenger_name','passenger_phone','booked_at'])
-    for b in bookings:
-        writer.writerow([b.id, b.user.username if b.user else '', b.bus.name if b.bus else '', b.seats, b.passenger_name, b.passenger_phone, b.booked_at])
-    session.close()
-    return output.getvalue()
+    try:
+        q = (select(Booking.id, User.username, Bus.name, Booking.seats, Booking.passenger_name,
+                    Booking.passenger_phone, Booking.booked_at, Booking.seat_numbers, Booking.status,
+                    Booking.cancelled_at, Booking.refund_amount)
+             .outerjoin(User, Booking.user_id == User.id)
+             .outerjoin(Bus, Booking.bus_id == Bus.id)
+             .order_by(Booking.id)
+             .execution_options(yield_per=chunk_rows))
+        output = io.StringIO()
+        writer = csv.writer(output)
+        writer.writerow(EXPORT_HEADER)
+        for rows in session.execute(q).partitions():
+            writer.writerows((r[0], r[1] or '', r[2] or '', r[3], r[4], r[5], r[6], r[7] or '', r[8],
+                              r[9] or '', '' if r[10] is None else r[10]) for r in rows)
+            yield output.getvalue()
+            output.seek(0); output.truncate()
+        if output.tell():
+            yield output.getvalue()
+    finally:
+        session.close()
+
+def gzip_chunks(chunks, level=6):
+    # compress a stream of text chunks on the fly into a gzip stream of bytes
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def write_bookings_csv(path, compress=False):
+    # stream the export into a file; used by the CLI and the desktop client
+    if compress:
+        with open(path, 'wb') as f:
+            for data in gzip_chunks(iter_bookings_csv()):
+                f.write(data)
+    else:
+        with open(path, 'w', newline='', encoding='utf-8') as f:
+            for chunk in iter_bookings_csv():
+                f.write(chunk)
+
+def export_bookings_csv():
+    # whole export as one string; prefer iter_bookings_csv for anything large
+    return ''.join(iter_bookings_csv())
 
 # Import buses from CSV. CSV columns: name,route,total_seats,fare,depart_time,extra
-def import_buses_csv(file_stream):
-    session = SessionLocal()
-    reader = csv.DictReader(io.StringIO(file_stream.read().decode('utf-8')))
-    added = 0
-    for row in reader:
+IMPORT_CHUNK_ROWS = 5000
+MAX_REPORTED_ERRORS = 100
+LOOKUP_CHUNK = 500  # names per IN (...) of the upsert lookup
+
+class ImportResult:
+    def __init__(self):
+        self.inserted = 0
+        self.updated = 0
+        self.failed = 0
+        self.errors = []  # (line number, message), first MAX_REPORTED_ERRORS only
+
+    def error(self, line, message):
+        self.failed += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((line, message))
+
+    def __str__(self):
+        return f"{self.inserted} added, {self.updated} updated, {self.failed} rejected"
+
+def _bus_values(row):
+    # validate one CSV row; raises ValueError with a readable message
+    def number(field, default):
+        value = (row.get(field) or '').strip()
+        if not value:
+            return default
         try:
-            total = int(row.get('total_seats', 40))
-        except:
-            total = 40
-        b = Bus(
-            name=row.get('name', 'Unnamed'),
-            route=row.get('route', ''),
-            total_seats=total,
-            available_seats=total,
-            fare=int(row.get('fare', 0)),
-            depart_time=row.get('depart_time', ''),
-            extra=row.get('extra', '')
-        )
-        session.add(b)
-        added += 1
-    session.commit()
-    session.close()
-    return added
+            return int(value)
+        except ValueError:
+            raise ValueError(f"{field} {value!r} is not a number")
+    total = number('total_seats', 40)
+    fare = number('fare', 0)
+    if total <= 0:
+        raise ValueError(f"total_seats must be positive, got {total}")
+    if fare < 0:
+        raise ValueError(f"fare must not be negative, got {fare}")
+    return {'name': (row.get('name') or '').strip() or 'Unnamed', 'route': row.get('route') or '',
+            'total_seats': total, 'available_seats': total, 'fare': fare,
+            'depart_time': row.get('depart_time') or '', 'extra': row.get('extra') or ''}
+
+def _write_chunk(conn, rows, upsert, result):
+    if upsert:
+        # last row wins for a key repeated inside the chunk
+        by_key = {(r['name'], r['depart_time']): r for r in rows}
+        # only live buses match; a row for a deleted bus adds a new one
+        existing = {}
+        names = list({k[0] for k in by_key})
+        for i in range(0, len(names), LOOKUP_CHUNK):
+            for bus_id, name, depart_time in conn.execute(
+                    select(Bus.id, Bus.name, Bus.depart_time)
+                    .where(Bus.name.in_(names[i:i + LOOKUP_CHUNK]), Bus.is_active == True)):
+                existing[(name, depart_time or '')] = bus_id
+        updates = [dict(r, b_id=existing[k]) for k, r in by_key.items() if k in existing]
+        rows = [r for k, r in by_key.items() if k not in existing]
+        if updates:
+            conn.execute(
+                update(Bus).where(Bus.id == bindparam('b_id')).values(
+                    route=bindparam('route'), fare=bindparam('fare'), extra=bindparam('extra')),
+                [{k: u[k] for k in ('b_id', 'route', 'fare', 'extra')} for u in updates])
+            # trips carry a copy of the route for the (route, service_date) index
+            conn.execute(update(Trip).where(Trip.bus_id == bindparam('b_id')).values(route=bindparam('route')),
+                         [{'b_id': u['b_id'], 'route': u['route']} for u in updates])
+            _resize(conn, {u['b_id']: u['total_seats'] for u in updates})
+            result.updated += len(updates)
+    changed = [u['b_id'] for u in updates] if upsert else []
+    if rows:
+        changed += _insert(conn, rows)
+        result.inserted += len(rows)
+    return changed
+
+def _resize(conn, totals):
+    # New capacities, recounted from each bus's seat map the way
+    # reservations.tx_edit_bus does. The UPDATE before this holds the rows'
+    # write locks, so the maps read here cannot change before they are
+    # written back.
+    ids, resized = list(totals), []
+    for i in range(0, len(ids), LOOKUP_CHUNK):
+        for row in conn.execute(select(Bus.id, Bus.total_seats, Bus.available_seats, Bus.seat_map)
+                                .where(Bus.id.in_(ids[i:i + LOOKUP_CHUNK]))):
+            if totals[row.id] != row.total_seats:
+                available, seat_map = seatmap.resize(row.seat_map, row.total_seats, row.available_seats,
+                                                     totals[row.id])
+                resized.append({'b_id': row.id, 'total_seats': totals[row.id], 'available_seats': available,
+                                'seat_map': seat_map})
+    if resized:
+        conn.execute(update(Bus).where(Bus.id == bindparam('b_id')).values(
+            total_seats=bindparam('total_seats'), available_seats=bindparam('available_seats'),
+            seat_map=bindparam('seat_map')), resized)
+
+def _insert(conn, rows):
+    # insert the rows; returns their ids
+    if conn.dialect.insert_executemany_returning:
+        return list(conn.execute(insert(Bus).returning(Bus.id), rows).scalars())
+    last = conn.execute(select(func.max(Bus.id))).scalar() or 0
+    conn.execute(insert(Bus), rows)
+    return list(conn.execute(select(Bus.id).where(Bus.id > last)).scalars())
+
+def import_buses_csv(file_stream, upsert=False, chunk_rows=IMPORT_CHUNK_ROWS):
+    # Streams the upload: lines are decoded incrementally and written in
+    # executemany batches of chunk_rows, each batch in its own transaction.
+    # Bad rows are reported in the result and skipped instead of aborting the
+    # file. With upsert=True a row whose name + depart_time matches an
+    # existing bus updates it in place.
+    result = ImportResult()
+    reader = csv.DictReader(codecs.iterdecode(file_stream, 'utf-8-sig'))
+    chunk, changed = [], []
+    try:
+        for row in reader:
+            try:
+                chunk.append(_bus_values(row))
+            except ValueError as exc:
+                result.error(reader.line_num, str(exc))
+                continue
+            if len(chunk) >= chunk_rows:
+                with engine.begin() as conn:
+                    changed += _write_chunk(conn, chunk, upsert, result)
+                chunk = []
+    except (UnicodeDecodeError, csv.Error) as exc:
+        result.error(reader.line_num + 1, f"unreadable input, import stopped: {exc}")
+    if chunk:
+        with engine.begin() as conn:
+            changed += _write_chunk(conn, chunk, upsert, result)
+    if result.inserted or result.updated:
+        catalog.invalidate()
+        events.publish(changed)
+    return result